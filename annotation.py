@@ -1,67 +1,190 @@
 import random
-import re
-from queue import Queue
+from collections import OrderedDict, deque
+from threading import Lock
+
+from expression import process_condition
+from plan import PlanNode
+from profiling import profiler
+from template import bubbled_join_condition, compile_template, condition_text, equals, key_list, property_text, when
+
+
+class AnnotationContext:
+    """State shared by the handlers while annotating a single plan.
+
+    Join conditions found in the scans below a join are queued here, so that a
+    join without conditions of its own can describe the one it applies. Every
+    annotate call gets its own context, which keeps concurrent calls apart."""
+
+    def __init__(self, misestimate_factor=10.0, alternatives=None):
+        self.join_conditions = deque()
+        # Every join condition queued and taken so far, and the times none was left
+        # to take, from which AnnotationCache tells what each subtree did to the queue
+        self.queued = []
+        self.taken = []
+        self.missed = 0
+
+        # For EXPLAIN ANALYZE plans, nodes whose row estimate is off by more
+        # than this factor are flagged
+        self.misestimate_factor = misestimate_factor
+
+        # Maps planner settings (see PLANNER_SETTINGS) to the plan chosen with
+        # that setting off, for comparing operators with their alternatives
+        self.alternatives = alternatives or {}
+
+        # Total cost of the plan being annotated, set by annotate
+        self.total_cost = None
+
+    def find_join_conditions(self, condition):
+        self.join_conditions.extend(condition.join_conditions)
+        self.queued.extend(condition.join_conditions)
+
+    def get_join_condition(self):
+        # None once every queued join condition has been used
+        if not self.join_conditions:
+            self.missed += 1
+            return None
+        join_condition = self.join_conditions.popleft()
+        self.taken.append(join_condition)
+        return join_condition
+
+    def mark(self):
+        # Where the join condition queue stands before a subtree is annotated
+        return len(self.join_conditions), len(self.queued), len(self.taken), self.missed
+
+    def options_key(self):
+        # What annotations depend on besides the plan and the queued join conditions.
+        # The cost and alternatives only matter when alternatives are compared.
+        if not self.alternatives:
+            return (self.misestimate_factor,)
+        return (self.misestimate_factor, self.total_cost,
+                tuple(sorted((setting, plan.subtree_hash) for setting, plan in self.alternatives.items())))
+
+
+class CachedSubtree:
+    """The annotations of a subtree, with what annotating it did to the join
+    condition queue: it took consumed, the conditions at the front of the queue,
+    and queued appended, of which it took the first own_taken itself. If it
+    emptied the queue (exhausted), it only applies when the queue held nothing
+    but consumed."""
+
+    __slots__ = ("annotations", "consumed", "appended", "own_taken", "missed", "exhausted")
+
+    def __init__(self, annotations, context, mark):
+        queue_length, queued, taken, missed = mark
+        taken_count = len(context.taken) - taken
+        # Conditions queued before the subtree are taken before any it queues itself
+        consumed_count = min(taken_count, queue_length)
+        self.annotations = tuple(annotations)
+        self.consumed = tuple(context.taken[taken:taken + consumed_count])
+        self.appended = tuple(context.queued[queued:])
+        self.own_taken = taken_count - consumed_count
+        self.missed = context.missed - missed
+        self.exhausted = self.own_taken > 0 or self.missed > 0
+
+    def applies_to(self, join_conditions):
+        if len(join_conditions) < len(self.consumed):
+            return False
+        if self.exhausted and len(join_conditions) != len(self.consumed):
+            return False
+        return all(queued == consumed for queued, consumed in zip(join_conditions, self.consumed))
+
+    def replay(self, context):
+        # Leaves context as annotating the subtree would have
+        for _ in self.consumed:
+            context.join_conditions.popleft()
+        context.join_conditions.extend(self.appended[self.own_taken:])
+        context.taken += self.consumed + self.appended[:self.own_taken]
+        context.queued += self.appended
+        context.missed += self.missed
+
+
+class AnnotationCache:
+    """LRU of the annotations of plan subtrees, keyed by PlanNode.subtree_hash.
+
+    Shared across annotate calls, so that annotating the plan of a slightly
+    edited query only annotates again the subtrees that changed. Besides its
+    own nodes, a subtree's annotations depend on the options of the context,
+    which are part of the key, and on the join conditions it takes from the
+    queue, which are kept with its annotations and compared on lookup."""
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def key(self, qep, options):
+        return (qep.subtree_hash, options)
+
+    def get(self, key, context):
+        """Returns the annotations of the subtree and applies what it did to the
+        join condition queue to context, or returns None if it was not annotated
+        with the conditions now queued."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is not None and not entry.applies_to(context.join_conditions):
+            entry = None
+        profiler.count("annotation_cache.hit" if entry is not None else "annotation_cache.miss")
+        if entry is None:
+            return None
+        entry.replay(context)
+        return entry.annotations
+
+    def put(self, key, annotations, context, mark):
+        # mark is context.mark() from before the subtree was annotated
+        entry = CachedSubtree(annotations, context, mark)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
 
 
-QEP_DATA_TYPE_SPECIFIER_REGEX = "::[^\(\)\,]*"
-
-RELATION_ATTRIBUTE_REGEX = "(?<!'|\")[a-zA-Z][\w.]*(?!'|\")"
-
-JOIN_CONDITION_REGEX = "[\w.]+ = [\w.]+"
-
-join_condition_queue = Queue()
-
-
-def remove_type_specifier(input_string):
-    if "numeric" in input_string:
-        input_string = input_string.replace("'", "")
-    return re.sub(QEP_DATA_TYPE_SPECIFIER_REGEX, '', input_string)
-
+def get_table_names(qep):
+    return list(qep.table_names)
 
-def add_relation_names(filters_string, table_name):
-    attributes_list = re.findall(RELATION_ATTRIBUTE_REGEX, filters_string)
-    tablename_attributes_list = [
-        attribute if "." in attribute else table_name + "." + attribute for attribute in attributes_list]
 
-    result = filters_string
-    for i in range(len(attributes_list)):
-        result = result.replace(
-            attributes_list[i], tablename_attributes_list[i])
+def get_relation_names(qep):
+    # Unlike get_table_names, returns the underlying relations rather than their aliases
+    return sorted({node.relation_name for node in qep.walk() if node.relation_name is not None})
 
-    return result
 
+##################################################################################################
+################################Template registry#################################################
+##################################################################################################
 
-def filter_splitter(filters_string):
-    # Filters/conditions are in the format "(condition1), (condition2), ..."
-    DELIMITER = ","
-    filters_list = filters_string.split(DELIMITER)
-    filters_list = [filter_string.strip()[1:-1]
-                    for filter_string in filters_list]
+# Maps Node Types to functions, compiled from the templates registered below
+NodeTypeMap = {}
 
-    return filters_list
 
+def register(node_types, *parts):
+    """Declares the annotation of one node type, or of each of a tuple of them,
+    as a sequence of template parts (see template.py), compiled here once."""
+    if isinstance(node_types, str):
+        node_types = (node_types,)
+    for node_type in node_types:
+        NodeTypeMap[node_type] = compile_template(node_type, parts)
 
-def find_join_conditions(filters_string):
-    join_conditions_list = re.findall(JOIN_CONDITION_REGEX, filters_string)
 
-    for join_condition in join_conditions_list:
-        join_condition_queue.put(join_condition)
+# Parts shared by many node types
+FILTER = condition_text("filter", "It is also filtered with the following condition(s): {}. ")
+INDEX_COND = condition_text("index_cond", ", with the following condition(s): {}. ", otherwise=". ")
+ALIAS = when("alias", ", that has an alias name: {alias}. ", otherwise=". ")
 
+JOIN_FILTER = condition_text("join_filter", "Before the join, filter with the following condition(s) is applied: {}. ",
+                             qualify=False, join_conditions=False)
+JOIN_RESULT_FILTER = condition_text("filter", "Join result is filtered with the following condition(s): {}. ",
+                                    qualify=False, join_conditions=False)
 
-def get_join_condition():
-    return join_condition_queue.get()
 
-
-def get_table_names(qep):
-    table_names = []
-    if "Plans" in qep:
-        for plan in qep["Plans"]:
-            table_names += get_table_names(plan)
-    elif "Alias" in qep:
-        table_names.append(qep["Alias"])
-    elif "Relation Name" in qep:
-        table_names.append(qep["Relation Name"])
-    return table_names
+def without_alternatives(qep, context):
+    # Guesses at why an operator was chosen are left out when the actual alternatives are shown
+    return not context.alternatives
 
 
 ##################################################################################################
@@ -69,216 +192,40 @@ def get_table_names(qep):
 ##################################################################################################
 
 
-def seq_scan(qep):
-
-    annotation = "A sequential scan is done on the relation "
-    filters = {
-        "table": get_table_names(qep),
-        "cond": []
-    }
-
-    if ("Relation Name" in qep):
-        table_name = qep['Relation Name']
-        annotation += f"{table_name}"
-
-    if ("Alias" in qep):
-        table_name = qep['Alias']
-        annotation += ", that has an alias name: "
-        annotation += f"{table_name}. "
-    else:
-        annotation += ". "
-
-    if ("Filter" in qep):
-        filter_string = remove_type_specifier(qep['Filter'])
-        filter_string = add_relation_names(filter_string, table_name)
-
-        find_join_conditions(filter_string)
-
-        annotation += f"It is also filtered with the following condition(s): {filter_string}. "
-        filters["cond"] += filter_splitter(filter_string)
-
-    annotation += "\n"
-    return [(annotation, filters)]
-
+register("Seq Scan",
+         "A sequential scan is done on the relation ",
+         when("relation_name", "{relation_name}"),
+         ALIAS,
+         FILTER)
 
-def index_scan(qep):
+register("Index Scan",
+         "An index scan is done using the index {index_name} on it's index table",
+         INDEX_COND,
+         "This scan is chosen as there is an index on {index_name}. ",
+         "Then, it accesses the relation {relation_name} table and retrieves rows matching with the index {index_name}. ",
+         FILTER)
 
-    annotation = f"An index scan is done using the index {qep['Index Name']} on it's index table"
-
-    filters = {
-        "table": get_table_names(qep),
-        "cond": []
-    }
-
-    if ("Alias" in qep):
-        table_name = qep['Alias']
-    elif ("Relation Name" in qep):
-        table_name = qep['Relation Name']
-
-    if ("Index Cond" in qep):
-        condition_string = remove_type_specifier(qep['Index Cond'])
-        condition_string = add_relation_names(condition_string, table_name)
-
-        find_join_conditions(condition_string)
-
-        annotation += f", with the following condition(s): {condition_string}. "
-        filters["cond"] += filter_splitter(condition_string)
-    else:
-        annotation += ". "
-
-    annotation += f"This scan is chosen as there is an index on {qep['Index Name']}. "
-
-    if ("Node Type" in qep == "Index Scan"):
-        annotation += f"Then, it accesses the relation {qep['Relation Name']} table and retrieves rows matching with the index {qep['Index Name']}. "
-
-    if ("Filter" in qep):
-        filter_string = remove_type_specifier(qep['Filter'])
-        filter_string = add_relation_names(filter_string, table_name)
-
-        find_join_conditions(filter_string)
-
-        annotation += f"It is also filtered with the following condition(s): {filter_string}. "
-        filters["cond"] += filter_splitter(filter_string)
-
-    annotation += "\n"
-    return [(annotation, filters)]
-
-
-def index_only_scan(qep):
-
-    annotation = f"An index scan is done using the index {qep['Index Name']} on it's index table"
-
-    filters = {
-        "table": get_table_names(qep),
-        "cond": []
-    }
-
-    if ("Alias" in qep):
-        table_name = qep['Alias']
-    elif ("Relation Name" in qep):
-        table_name = qep['Relation Name']
-
-    if ("Index Cond" in qep):
-        condition_string = remove_type_specifier(qep['Index Cond'])
-        condition_string = add_relation_names(condition_string, table_name)
-
-        find_join_conditions(condition_string)
-
-        annotation += f", with the following condition(s): {condition_string}. "
-        filters["cond"] += filter_splitter(condition_string)
-    else:
-        annotation += ". "
+register("Index Only Scan",
+         "An index scan is done using the index {index_name} on it's index table",
+         INDEX_COND,
+         "This scan is chosen as there is an index on {index_name}. ",
+         "Then, it retrieves rows matching with the index {index_name}. ",
+         FILTER)
 
-    annotation += f"This scan is chosen as there is an index on {qep['Index Name']}. "
+register("CTE Scan",
+         "A CTE scan is done sequentially on the materialized results named {cte_name}",
+         INDEX_COND,
+         FILTER)
 
-    if ("Node Type" in qep == "Index Only Scan"):
-        annotation += f"Then, it retrieves rows matching with the index {qep['Index Name']}. "
+register("Bitmap Index Scan",
+         "An index scan is done using the index {index_name} on it's index table to create a bitmap of satisfactory pages",
+         condition_text("index_cond", ", with the following condition(s): {}. ", otherwise=". ",
+                        qualify=False, join_conditions=False))
 
-    if ("Filter" in qep):
-        filter_string = remove_type_specifier(qep['Filter'])
-        filter_string = add_relation_names(filter_string, table_name)
-
-        find_join_conditions(filter_string)
-
-        annotation += f"It is also filtered with the following condition(s): {filter_string}. "
-        filters["cond"] += filter_splitter(filter_string)
-
-    annotation += "\n"
-    return [(annotation, filters)]
-
-
-def cte_scan(qep):
-
-    annotation = "A CTE scan is done sequentially on the materialized results "
-    filters = {
-        "table": get_table_names(qep),
-        "cond": []
-    }
-
-    if ("Alias" in qep):
-        table_name = qep['Alias']
-    elif ("Relation Name" in qep):
-        table_name = qep['Relation Name']
-
-    annotation += f"named {qep['CTE Name']}"
-
-    if ("Index Cond" in qep):
-        condition_string = remove_type_specifier(qep['Index Cond'])
-        condition_string = add_relation_names(condition_string, table_name)
-
-        find_join_conditions(condition_string)
-
-        annotation += f", with the following condition(s): {condition_string}. "
-        filters["cond"] += filter_splitter(condition_string)
-    else:
-        annotation += ". "
-
-    if ("Filter" in qep):
-        filter_string = remove_type_specifier(qep['Filter'])
-        filter_string = add_relation_names(filter_string, table_name)
-
-        find_join_conditions(filter_string)
-
-        annotation += f"It is also filtered with the following condition(s): {filter_string}. "
-        filters["cond"] += filter_splitter(filter_string)
-
-    annotation += "\n"
-    return [(annotation, filters)]
-
-
-def bitmap_index_scan(qep):
-
-    annotation = f"An index scan is done using the index {qep['Index Name']} on it's index table to create a bitmap of satisfactory pages"
-    filters = {
-        "table": get_table_names(qep),
-        "cond": []
-    }
-
-    if ("Index Cond" in qep):
-        condition_string = remove_type_specifier(qep['Index Cond'])
-
-        annotation += f", with the following condition(s): {condition_string}. "
-        filters["cond"] += filter_splitter(condition_string)
-    else:
-        annotation += ". "
-
-    annotation += "\n"
-    return [(annotation, filters)]
-
-
-def bitmap_heap_scan(qep):
-
-    annotation = "A bitmap heap scan is done using the bitmap created from bitmap index scan. "
-    filters = {
-        "table": get_table_names(qep),
-        "cond": []
-    }
-
-    if ("Alias" in qep):
-        table_name = qep['Alias']
-    elif ("Relation Name" in qep):
-        table_name = qep['Relation Name']
-
-    if ("Recheck Cond" in qep):
-        condition_string = remove_type_specifier(qep['Index Cond'])
-        condition_string = add_relation_names(condition_string, table_name)
-
-        find_join_conditions(condition_string)
-
-        annotation += f"Results are filtered with the following recheck condition(s): {condition_string}. "
-        filters["cond"] += filter_splitter(condition_string)
-
-    if ("Filter" in qep):
-        filter_string = remove_type_specifier(qep['Filter'])
-        filter_string = add_relation_names(filter_string, table_name)
-
-        find_join_conditions(filter_string)
-
-        annotation += f"It is also filtered with the following condition(s): {filter_string}. "
-        filters["cond"] += filter_splitter(filter_string)
-
-    annotation += "\n"
-    return [(annotation, filters)]
+register("Bitmap Heap Scan",
+         "A bitmap heap scan is done using the bitmap created from bitmap index scan. ",
+         condition_text("recheck_cond", "Results are filtered with the following recheck condition(s): {}. "),
+         FILTER)
 
 
 ##################################################################################################
@@ -288,393 +235,401 @@ def bitmap_heap_scan(qep):
 JOIN_NODE_TYPES = ("Nested Loop", "Hash Join", "Merge Join")
 
 
-def nested_loop_join(qep):
-
-    annotation = "A nested-loop join is done using the two relations. "
-    annotation += "This is chosen as the relation size involved is smaller. "
-    filters = {
-        "table": get_table_names(qep),
-        "cond": []
-    }
-
-    if ("Join Filter" in qep):
-        join_filter_string = remove_type_specifier(qep['Join Filter'])
-
-        annotation += f"Before the join, filter with the following condition(s) is applied: {join_filter_string}. "
-        filters["cond"] += filter_splitter(join_filter_string)
-
-    if ("Filter" in qep):
-        filter_string = remove_type_specifier(qep['Filter'])
-
-        annotation += f"Join result is filtered with the following condition(s): {filter_string}. "
-        filters["cond"] += filter_splitter(filter_string)
-
-    if not filters["cond"]:
-        bubbled_filter = get_join_condition()
-        filters["cond"].append(bubbled_filter)
-
-    annotation += "\n"
-    return [(annotation, filters)]
+register("Nested Loop",
+         "A nested-loop join is done using the two relations. ",
+         when(without_alternatives, "This is chosen as the relation size involved is smaller. "),
+         JOIN_FILTER,
+         JOIN_RESULT_FILTER,
+         bubbled_join_condition)
 
+register("Hash Join",
+         "A hash join is done using the two relations. ",
+         when(without_alternatives, "This is chosen as no indexes exist and the relations are not sorted. "),
+         condition_text("hash_cond", "The join is done with the following condition(s): {}. ",
+                        qualify=False, join_conditions=False),
+         JOIN_FILTER,
+         JOIN_RESULT_FILTER,
+         bubbled_join_condition)
 
-def hash_join(qep):
+register("Merge Join",
+         "A merge join is done using the two relations",
+         condition_text("merge_cond", ", with the following condition(s): {}. ", otherwise=". ",
+                        qualify=False, join_conditions=False),
+         JOIN_FILTER,
+         JOIN_RESULT_FILTER,
+         bubbled_join_condition)
 
-    annotation = "A hash join is done using the two relations. "
-    annotation += "This is chosen as no indexes exist and the relations are not sorted. "
-    filters = {
-        "table": get_table_names(qep),
-        "cond": []
-    }
 
-    if ("Hash Cond" in qep):
-        condition_string = remove_type_specifier(qep['Hash Cond'])
-
-        annotation += f"The join is done with the following condition(s): {condition_string}. "
-
-        filters["cond"] += filter_splitter(condition_string)
-
-    if ("Join Filter" in qep):
-        join_filter_string = remove_type_specifier(qep['Join Filter'])
-
-        annotation += f"Before the join, filter with the following condition(s) is applied: {join_filter_string}. "
-        filters["cond"] += filter_splitter(join_filter_string)
-
-    if ("Filter" in qep):
-        filter_string = remove_type_specifier(qep['Filter'])
-
-        annotation += f"Join result is filtered with the following condition(s): {filter_string}. "
-        filters["cond"] += filter_splitter(filter_string)
-
-    if not filters["cond"]:
-        bubbled_filter = get_join_condition()
-        filters["cond"].append(bubbled_filter)
-
-    annotation += "\n"
-    return [(annotation, filters)]
-
-
-def merge_join(qep):
-
-    annotation = "A merge join is done using the two relations"
-    filters = {
-        "table": get_table_names(qep),
-        "cond": []
-    }
-
-    if ("Merge Cond" in qep):
-        condition_string = remove_type_specifier(qep['Hash Cond'])
-
-        annotation += f", with the following condition(s): {condition_string}. "
-        filters["cond"] += filter_splitter(condition_string)
-    else:
-        annotation += ". "
-
-    if ("Join Filter" in qep):
-        join_filter_string = remove_type_specifier(qep['Join Filter'])
-
-        annotation += f"Before the join, filter with the following condition(s) is applied: {join_filter_string}. "
-        filters["cond"] += filter_splitter(join_filter_string)
-
-    if ("Filter" in qep):
-        filter_string = remove_type_specifier(qep['Filter'])
-
-        annotation += f"Join result is filtered with the following condition(s): {filter_string}. "
-        filters["cond"] += filter_splitter(filter_string)
-
-    if not filters["cond"]:
-        bubbled_filter = get_join_condition()
-        filters["cond"].append(bubbled_filter)
-
-    annotation += "\n"
-    return [(annotation, filters)]
-
-
-JoinTypeMap = {
-    "Hash Join": hash_join,
-    "Merge Join": merge_join,
-    "Nested Loop": nested_loop_join
-}
-
-
-def join(qep):
-
-    result = []
+##################################################################################################
+################################Parallel methods##################################################
+##################################################################################################
 
-    outer_relation_index = 0 if (
-        qep["Plans"][0]["Parent Relationship"] == "Outer") else 1
-    inner_relation_index = 1 - outer_relation_index
 
-    # Process left child (outer relation)
-    outer_relation_annotation = annotate(
-        qep["Plans"][outer_relation_index])
+def workers_launched(qep, context, conditions):
+    # Only known for plans from EXPLAIN ANALYZE
+    if qep.workers_launched is None or qep.workers_planned is None:
+        return ""
+    if qep.workers_launched < qep.workers_planned:
+        return (f"Only {qep.workers_launched} of the {qep.workers_planned} planned workers could be launched, "
+                "so the leader took on more of the work; max_parallel_workers or max_worker_processes "
+                "may be too low for the load. ")
+    return f"All {qep.workers_launched} planned workers were launched. "
 
-    # Process right child (inner relation)
-    inner_relation_annotation = annotate(
-        qep["Plans"][inner_relation_index])
 
-    current_join = JoinTypeMap[qep["Node Type"]]
-    current_join_annotation = current_join(qep)
+register("Gather",
+         "The rows of {workers_planned} parallel worker(s) running the plan below are gathered, in no particular order. ",
+         when(lambda qep, context: qep.get("Single Copy"), "Only a single worker runs the plan below. "),
+         workers_launched)
 
-    result += outer_relation_annotation
-    result += inner_relation_annotation
-    result += current_join_annotation
+register("Gather Merge",
+         "The sorted rows of {workers_planned} parallel worker(s) running the plan below are merged, keeping their order. ",
+         workers_launched)
 
-    return result
 
 ##################################################################################################
 ################################Utility methods###################################################
 ##################################################################################################
 
 
-def hash(qep):
-
-    result = []
-    filters = {
-        "table": get_table_names(qep),
-        "cond": []
-    }
-
-    scan_annotation = annotate(qep['Plans'][0])
-
-    hash_annotation = f"A hash is performed on the \"{qep['Plans'][0]['Relation Name']}\" relation"
-
-    if ("Alias" in qep):
-        table_name = qep['Alias']
-        hash_annotation += ", that has an alias name: "
-        hash_annotation += f"{table_name}. "
-    else:
-        hash_annotation += ". "
-
-    hash_annotation += "\n"
-
-    result += scan_annotation
-    result.append((hash_annotation, filters))
-
-    return result
-
-
-def aggregate(qep):
-
-    annotation = ''
-    filters = {
-        "table": get_table_names(qep),
-        "cond": []
-    }
-
-    if (qep['Strategy'] == 'Hashed'):
-
-        length = len(qep["Group Key"])
-
-        if (length > 1):
-            annotation += "The results are produced after hashing on the following keys: "
-            for key in qep["Group Key"]:
-                key_string = remove_type_specifier(qep['Group Key'])
-                annotation += key_string + ", "
-                filters["cond"] += filter_splitter(key_string)
-
+def sort_keys(qep, context, conditions):
+    # One sentence per sort key, the last key first
+    sentences = []
+    for key in reversed(qep.sort_key or ()):
+        conditions += process_condition(key).conjuncts
+        if key.endswith(" DESC"):
+            sentences.append(f"The results are sorted in descending order using the key(s), {key[:-len(' DESC')]}. ")
         else:
-            annotation += "The results are produced after hashing on the single key: "
-            key_string = remove_type_specifier(qep['Group Key'][0])
-            annotation += key_string
-            filters["cond"] += filter_splitter(key_string)
-
-        annotation += '.\n'
-
-        return annotate(qep['Plans'][0]) + [(annotation, filters)]
-
-    if (qep['Strategy'] == "Plain"):
-
-        annotation += annotate(qep['Plans'][0])
-        annotation += "The results are aggregated.\n"
-
-        return [(annotation, filters)]
+            sentences.append(f"The results are sorted in ascending order using the key(s), {key}. ")
+    return "".join(sentences)
+
+
+def sort_method(qep, context, conditions):
+    # Only known for plans from EXPLAIN ANALYZE; parallel workers report their own sorts
+    sorts = [qep.properties] + [worker for worker in qep.get("Workers", ()) if "Sort Method" in worker]
+    sorts = [sort for sort in sorts if "Sort Method" in sort]
+    if not sorts:
+        return ""
+
+    methods = sorted({sort["Sort Method"] for sort in sorts})
+    space_used = max(sort.get("Sort Space Used", 0) for sort in sorts)
+    text = f"It was done with {' and '.join(methods)}, using up to {space_used} kB. "
+    if any(sort.get("Sort Space Type") == "Disk" for sort in sorts):
+        text += "The sort spilled to disk; a larger work_mem would let it run in memory. "
+    return text
+
+
+def incremental_sort_groups(qep, context, conditions):
+    # Only known for plans from EXPLAIN ANALYZE
+    sentences = []
+    for key, description in (("Full-sort Groups", "sorted in full"), ("Pre-sorted Groups", "sorted on the remaining keys")):
+        groups = qep.get(key)
+        if groups:
+            methods = " and ".join(groups.get("Sort Methods Used", ())) or "an unknown method"
+            sentences.append(f"{groups['Group Count']} group(s) were {description}, with {methods}. ")
+    return "".join(sentences)
+
+
+def memoize_cache(qep, context, conditions):
+    # Only known for plans from EXPLAIN ANALYZE
+    hits = qep.get("Cache Hits")
+    misses = qep.get("Cache Misses")
+    if hits is None or misses is None or not hits + misses:
+        return ""
+
+    text = (f"The cache was hit {hits} time(s) out of {hits + misses} lookups "
+            f"({hits / (hits + misses):.0%} hit ratio). ")
+    evictions = qep.get("Cache Evictions", 0)
+    overflows = qep.get("Cache Overflows", 0)
+    if evictions or overflows:
+        text += (f"{evictions} cache entries were evicted and {overflows} did not fit, "
+                 "as the cache outgrew its share of work_mem. ")
+    elif hits < misses:
+        text += "Most lookups missed, so caching saved little work. "
+    return text
+
+
+def limit_rows(qep, context, conditions):
+    rows = str(int(qep.plan_rows))
+    conditions += process_condition(rows).conjuncts
+    return f"The results are limited by {rows} rows of data entry. "
+
+
+def hashed_input(qep, context, conditions):
+    # A Hash above a join hashes the joined rows of several relations
+    child = qep.children[0]
+    if child.relation_name is not None:
+        return f"A hash is performed on the \"{child.relation_name}\" relation"
+    if len(child.table_names) > 1:
+        return f"A hash is performed on the joined rows of {', '.join(child.table_names)}"
+    if child.table_names:
+        return f"A hash is performed on the rows of {child.table_names[0]}"
+    return "A hash is performed on the rows of its input"
+
+
+register("Hash",
+         hashed_input,
+         ALIAS)
+
+register("Aggregate",
+         when(equals("strategy", "Hashed"),
+              key_list("group_key", "The results are produced after hashing on the following keys: {}. ",
+                       single="The results are produced after hashing on the single key: {}. ")),
+         when(equals("strategy", "Plain"), "The results are aggregated. "),
+         when(equals("strategy", "Sorted"),
+              key_list("group_key", "It is grouped by the following keys: {}. "),
+              condition_text("filter", "It is also filtered with the following condition(s): {}. ",
+                             qualify=False, join_conditions=False)),
+         when(equals("strategy", "Mixed"), "The results are aggregated over several grouping sets. "))
+
+register("Group",
+         key_list("group_key", "The results are grouped by the following keys: {}. ",
+                  single="The results are grouped by the single key: {}. "))
+
+register("Unique", "Also, only unique values of the data is being kept. ")
+
+register("Sort", sort_keys, sort_method)
+
+register("Incremental Sort",
+         key_list("sort_key", "The results are sorted incrementally using the key(s) {}. "),
+         key_list("presorted_key", "As the rows already arrive sorted by {}, "
+                                   "each group of rows sharing those keys is sorted on its own. "),
+         incremental_sort_groups)
+
+register(("Memoize", "Result Cache"),
+         condition_text("cache_key", "The rows of the inner side are cached by the key(s) {}, "
+                                     "so that repeated lookups of a key do not rescan it. ",
+                        qualify=False, join_conditions=False),
+         memoize_cache,
+         property_text("Peak Memory Usage", "The cache peaked at {} kB of memory. "))
+
+register("Materialize",
+         "The rows of the plan below are materialized in memory (spilling to disk if needed), "
+         "so that rescanning them, e.g. as the inner side of a nested loop, does not run it again. ")
+
+register("WindowAgg",
+         "The window functions are computed over the rows of the plan below, "
+         "which arrive sorted by their partition and order keys. ",
+         property_text("Run Condition", "Rows stop being computed once this condition fails: {}. "))
+
+register("Result",
+         "The rows are computed directly, without reading a relation of their own, "
+         "e.g. constant expressions or a projection of the plan below. ",
+         condition_text("one_time_filter", "The rest of the plan only runs if this condition, "
+                                           "checked once, holds: {}. ",
+                        qualify=False, join_conditions=False))
+
+register("Limit", limit_rows)
+
+register("Append", "The results are being appended together. ")
+
+register("NotFound", "{node_type} is performed. ")
 
-    if (qep['Strategy'] == 'Sorted'):
 
-        annotation += annotate(qep['Plans'][0])
-
-        if ("Group Key" in qep):
-
-            annotation += "It is grouped by the following keys: "
+##################################################################################################
+################################Subplans##########################################################
+##################################################################################################
 
-            for key in qep['Group Key']:
+# SubPlans and InitPlans are not node types, but the Parent Relationship of the
+# first node of a subquery's plan
+SUBPLAN_RELATIONSHIPS = {
+    "InitPlan": "an initplan, run once before the node above it uses its result as a constant",
+    "SubPlan": "a subplan, run again for every row of the node above it that uses its result",
+}
 
-                key_string = remove_type_specifier(qep['Group Key'])
-                annotation += key_string + ", "
-                filters["cond"] += filter_splitter(key_string)
 
-            annotation = annotation[:-2] + "."
+def subplan(qep, context):
+    return f"This is {qep.subplan_name or qep.parent_relationship}, {SUBPLAN_RELATIONSHIPS[qep.parent_relationship]}. "
 
-        if ("Filter" in qep):
 
-            filter_string = remove_type_specifier(qep['Filter'])
+##################################################################################################
+################################Parallelism#######################################################
+##################################################################################################
 
-            annotation += f"It is also filtered with the following condition(s): {filter_string}."
-            filters["cond"] += filter_splitter(filter_string)
+# Worker row counts further apart than this factor are reported as uneven
+PARALLEL_SKEW_FACTOR = 2.0
 
-        annotation += "\n"
-        return [(annotation, filters)]
 
+def parallelism(qep, context):
+    annotation = ""
+    if qep.parallel_aware:
+        annotation += ("It is parallel aware: the processes under the Gather above "
+                       "share its work rather than each repeating all of it. ")
 
-def unique(qep):
+    # Per-worker rows are only in plans from EXPLAIN (ANALYZE, VERBOSE)
+    workers = [worker for worker in qep.get("Workers", ()) if "Actual Rows" in worker]
+    if workers and qep.is_analyzed:
+        worker_rows = {f"worker {worker['Worker Number']}": worker["Actual Rows"] * worker["Actual Loops"]
+                       for worker in workers}
+        leader_rows = max(qep.actual_rows * qep.actual_loops - sum(worker_rows.values()), 0.0)
+        annotation += "Its rows were split as leader: {:.0f}, {}. ".format(
+            leader_rows, ", ".join(f"{name}: {rows:.0f}" for name, rows in worker_rows.items()))
 
-    filters = {
-        "table": get_table_names(qep),
-        "cond": []
-    }
+        busiest = max(worker_rows.values())
+        least_busy = max(min(worker_rows.values()), 1.0)
+        if len(worker_rows) > 1 and busiest > PARALLEL_SKEW_FACTOR * least_busy:
+            annotation += (f"The split is uneven: the busiest worker returned {busiest / least_busy:.1f} times "
+                           "the rows of the least busy one. ")
 
-    annotation = annotate(qep['Plans'][0])
-    annotation += "Also, only unique values of the data is being kept."
+    return annotation
 
-    annotation += '\n'
-    return [(annotation, filters)]
 
+##################################################################################################
+################################Execution methods#################################################
+##################################################################################################
 
-def groupby(qep):
 
-    annotation = ''
-    filters = {
-        "table": get_table_names(qep),
-        "cond": []
-    }
+# Share of a node's time by which its children's times may exceed it before that is reported
+TIMING_TOLERANCE = 0.01
 
-    annotation += annotate(qep['Plans'][0])
-    length = len(qep['Group Key'])
 
-    if (length > 1):
-        annotation += "The results are grouped by the following keys: "
-        for key in qep["Group Key"]:
-            key_string = remove_type_specifier(qep['Group Key'])
-            annotation += key_string + ", "
-            filters["cond"] += filter_splitter(key_string)
+def execution(qep, context):
+    # Describes what actually happened at the node, for plans from EXPLAIN ANALYZE
+    if qep.actual_loops == 0:
+        return "This step was never executed. "
 
+    # Like Plan Rows, Actual Rows is an average per loop
+    annotation = f"It actually returned {int(qep.actual_rows)} row(s) against an estimate of {int(qep.plan_rows)}"
+    if qep.actual_loops > 1:
+        annotation += f", in each of {int(qep.actual_loops)} loops"
+    exclusive_time = qep.exclusive_time
+    # EXPLAIN rounds times to the microsecond, so the children may seem to take slightly longer
+    if exclusive_time >= -max(TIMING_TOLERANCE * qep.inclusive_time, 0.001):
+        annotation += f", and took {max(exclusive_time, 0.0):.3f} ms itself. "
     else:
-        key_string = remove_type_specifier(qep['Group Key'][0])
-        annotation += key_string
-        filters["cond"] += filter_splitter(key_string)
-
-    annotation += '.\n'
-    return [(annotation, filters)]
+        annotation += (f", and took {qep.inclusive_time:.3f} ms with the steps below it, which reported "
+                       f"{-exclusive_time:.3f} ms more than that, so its own time is unknown. ")
 
+    estimate_error = max(qep.actual_rows, 1.0) / max(qep.plan_rows, 1.0)
+    if estimate_error < 1.0:
+        estimate_error = 1.0 / estimate_error
 
-def limit(qep):
+    if estimate_error > context.misestimate_factor:
+        direction = "under" if qep.actual_rows > qep.plan_rows else "over"
+        annotation += f"The planner {direction}estimated the rows by a factor of {estimate_error:.1f}. "
 
-    filters = {
-        "table": get_table_names(qep),
-        "cond": []
-    }
-    annotation = annotate(qep['Plans'][0])
-    annotation += 'The results are limited by '
-    number_string = remove_type_specifier(qep['Plan Rows'])
-    annotation += str(qep['Plan Rows']) + " rows of data entry."
-    filters["cond"] += filter_splitter(number_string)
+    return annotation
 
-    annotation += '\n'
-    return [(annotation, filters)]
 
+##################################################################################################
+################################Alternative plans#################################################
+##################################################################################################
 
-def sort(qep):
-
-    annotation = ''
-    filters = {
-        "table": get_table_names(qep),
-        "cond": []
-    }
-
-    if ('Plans' in qep):
-        for x in qep['Plans']:
-            annotation += ' ' + annotate(x)
-
-    if (qep["Node Type"] == 'Sort'):
-
-        length = len(qep['Sort Key'])
-
-        while (length >= 1):
-
-            key = str(qep['Sort Key'][length-1])
-            key_string = remove_type_specifier(qep['Sort Key'][length-1])
-            filters["cond"] += filter_splitter(key_string)
-
-            if ('DESC' in key):
-                annotation += "The results are sorted in descending order using the key(s), "
-                annotation += key.replace('DESC', '.')
+# Planner setting that, when off, makes the planner avoid each node type
+PLANNER_SETTINGS = {
+    "Hash Join": "enable_hashjoin",
+    "Merge Join": "enable_mergejoin",
+    "Nested Loop": "enable_nestloop",
+    "Seq Scan": "enable_seqscan",
+    "Index Scan": "enable_indexscan",
+    "Index Only Scan": "enable_indexscan",
+    "Bitmap Heap Scan": "enable_bitmapscan",
+    "Materialize": "enable_material",
+    "Incremental Sort": "enable_incremental_sort",
+    "Gather Merge": "enable_gathermerge",
+    "Memoize": "enable_memoize",
+    # The name of Memoize before PostgreSQL 14
+    "Result Cache": "enable_resultcache",
+}
 
-            else:
-                annotation += "The results are sorted in ascending order using the key(s), "
-                annotation += key + '.'
 
-            length = length - 1
+def get_planner_settings(qep):
+    # Settings worth turning off to find alternatives to the operators in the plan
+    return sorted({PLANNER_SETTINGS[node.node_type] for node in qep.walk() if node.node_type in PLANNER_SETTINGS})
 
-    annotation += '\n'
-    return [(annotation, filters)]
 
+def alternative(qep, context):
+    setting = PLANNER_SETTINGS[qep.node_type]
+    alternative_plan = context.alternatives[setting]
 
-def append(qep):
-    filters = {
-        "table": get_table_names(qep),
-        "cond": []
-    }
+    # Operators only count if they are on the same relations: scans on theirs, joins on all those joined
+    relations = set(qep.table_names)
+    if any(node.node_type == qep.node_type and set(node.table_names) == relations for node in alternative_plan.walk()):
+        return f"The planner has no alternative to it: even with {setting} off, it still uses a {qep.node_type}. "
 
-    annotation = ''
+    extra_cost = alternative_plan.total_cost - context.total_cost
+    annotation = f"With {setting} off, the cheapest plan would cost {alternative_plan.total_cost:.2f} instead of {context.total_cost:.2f}"
+    if context.total_cost:
+        annotation += f" ({extra_cost / context.total_cost:+.0%})"
+    return annotation + ". "
 
-    if ('Plans' in qep):
-        for x in qep['Plans']:
-            annotation += ' ' + annotate(x)
 
-    if (qep["Node Type"] == "Append"):
+##################################################################################################
+################################Main method call##################################################
+##################################################################################################
 
-        annotation += "The results are being appended together."
 
-    annotation += '\n'
-    return [(annotation, filters)]
+def get_operation(qep):
+    # Node types without a template of their own are described generically
+    return NodeTypeMap.get(qep.node_type, NodeTypeMap['NotFound'])
 
 
-def notFound(qep):
+def get_children(qep):
+    # The outer relation of a join is annotated before the inner one
+    return sorted(qep.children, key=lambda child: child.parent_relationship != "Outer")
 
-    filters = {
-        "table": get_table_names(qep),
-        "cond": []
-    }
 
-    annotation = f"{qep['Node Type']} is performed."
-    if ('Plans' in qep):
-        for x in qep['Plans']:
-            annotation += ' ' + annotate(x)
+def append_to_own_annotation(annotations, text):
+    # The node's own annotation is the last one its handler returns
+    if not text:
+        return
+    annotation, filters = annotations[-1]
+    annotations[-1] = (annotation.rstrip() + " " + text + "\n", filters)
 
-    annotation += "\n"
-    return [(annotation, filters)]
 
+@profiler.timed("annotate")
+def annotate(qep, context=None, cache=None):
+    """Annotates every node of the plan, children before their parent.
 
-##################################################################################################
-################################Main method call##################################################
-##################################################################################################
+    The plan is walked iteratively in post-order, so deep plans do not run into
+    the recursion limit. qep is a PlanNode, or the decoded EXPLAIN JSON "Plan".
+    With an AnnotationCache, subtrees annotated before are taken from it whole."""
+    if isinstance(qep, dict):
+        qep = PlanNode.from_dict(qep)
 
-# Maps Node Types to functions
-NodeTypeMap = {
-    "Seq Scan": seq_scan,
-    "Index Scan": index_scan,
-    "Index Only Scan": index_only_scan,
-    "CTE Scan": cte_scan,
-    "Bitmap Heap Scan": bitmap_heap_scan,
-    "Bitmap Index Scan": bitmap_index_scan,
-    "Hash Join": join,
-    "Merge Join": join,
-    "Nested Loop": join,
-    "Hash": hash,
-    "Aggregate": aggregate,
-    "Sort": sort,
-    "Limit": limit,
-    "Group": groupby,
-    "Unique": unique,
-    "Append": append,
-    "NotFound": notFound
-}
+    if context is None:
+        context = AnnotationContext()
+    context.total_cost = qep.total_cost
+    options = context.options_key() if cache is not None else None
 
+    result = []
 
-def annotate(qep):
-    try:
-        operation = NodeTypeMap.get(qep["Node Type"])
-    except:
-        operation = NodeTypeMap.get('NotFound')
+    # Each entry is (node, None) until its children have been annotated, then (node, (its cache
+    # key, the join condition queue's mark, the index of its subtree's first annotation in result))
+    stack = [(qep, None)]
+    while stack:
+        node, subtree = stack.pop()
+
+        if subtree is None:
+            key = mark = None
+            if cache is not None:
+                key = cache.key(node, options)
+                annotations = cache.get(key, context)
+                if annotations is not None:
+                    result += annotations
+                    continue
+                mark = context.mark()
+            stack.append((node, (key, mark, len(result))))
+            stack.extend((child, None) for child in reversed(get_children(node)))
+            continue
+
+        operation = get_operation(node)
+        if profiler.enabled:
+            with profiler.timed_span("handler." + operation.__name__):
+                annotations = operation(node, context)
+        else:
+            annotations = operation(node, context)
+        if node.parent_relationship in SUBPLAN_RELATIONSHIPS:
+            append_to_own_annotation(annotations, subplan(node, context))
+        if PLANNER_SETTINGS.get(node.node_type) in context.alternatives:
+            append_to_own_annotation(annotations, alternative(node, context))
+        if node.parallel_aware or "Workers" in node.properties:
+            append_to_own_annotation(annotations, parallelism(node, context))
+        if node.is_analyzed:
+            append_to_own_annotation(annotations, execution(node, context))
+        result += annotations
+
+        key, mark, start = subtree
+        if key is not None:
+            cache.put(key, result[start:], context, mark)
 
-    return operation(qep)
+    return result
@@ -0,0 +1,305 @@
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from annotation import AnnotationContext, annotate
+from history import PlanHistory
+from plan_index import PlanIndex
+from plan_source import RecordingPlanSource, ReplayPlanSource
+from prepared import describe_parameter_plans, parameter_count
+
+
+SQL_FILE_EXTENSION = ".sql"
+
+# Connections all workers together open at most, by default half of PostgreSQL's default max_connections
+MAX_CONNECTIONS = 50
+
+# Each worker process holds its own plan source, set up by init_worker
+worker_plan_source = None
+worker_options = {}
+# With --dedupe, the plan shapes each worker has annotated already
+worker_fingerprints = set()
+
+
+##################################################################################################
+################################Reading queries###################################################
+##################################################################################################
+
+
+# Opening tag of a dollar-quoted string: $$ or $tag$, where the tag cannot start with a digit ($1 is a parameter)
+DOLLAR_QUOTE_REGEX = re.compile(r"\$(?:[A-Za-z_\x80-\uffff][\w\x80-\uffff]*)?\$")
+
+
+def is_identifier_char(char):
+    return char.isalnum() or char in "_$"
+
+
+def split_statements(sql_text):
+    """Splits a script into statements on semicolons that are outside of
+    string literals (including E'...' escapes and $tag$ dollar quotes),
+    quoted identifiers and comments."""
+    statements = []
+    current = []
+    i = 0
+    length = len(sql_text)
+
+    while i < length:
+        char = sql_text[i]
+
+        if char in ("'", '"'):
+            # In E'...' strings a backslash escapes the next character, the quote included
+            escapes = (char == "'" and i > 0 and sql_text[i - 1] in "eE"
+                       and not (i > 1 and is_identifier_char(sql_text[i - 2])))
+            end = i + 1
+            while end < length:
+                if escapes and sql_text[end] == "\\":
+                    end += 2
+                    continue
+                if sql_text[end] == char:
+                    break
+                end += 1
+            # A doubled quote inside a literal is read as the literal closing and another one opening
+            end = min(end + 1, length)
+            current.append(sql_text[i:end])
+            i = end
+            continue
+
+        # A $ inside an identifier, as in a$b, does not open a dollar quote
+        if char == "$" and not (i > 0 and is_identifier_char(sql_text[i - 1])):
+            match = DOLLAR_QUOTE_REGEX.match(sql_text, i)
+            if match:
+                tag = match.group()
+                end = sql_text.find(tag, match.end())
+                end = length if end == -1 else end + len(tag)
+                current.append(sql_text[i:end])
+                i = end
+                continue
+
+        if sql_text.startswith("--", i):
+            end = sql_text.find("\n", i)
+            i = length if end == -1 else end
+            continue
+        if sql_text.startswith("/*", i):
+            end = sql_text.find("*/", i + 2)
+            i = length if end == -1 else end + 2
+            continue
+        if char == ";":
+            statements.append("".join(current))
+            current = []
+        else:
+            current.append(char)
+        i += 1
+
+    statements.append("".join(current))
+    return [statement.strip() for statement in statements if statement.strip()]
+
+
+def collect_sql_files(paths):
+    sql_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, file_names in os.walk(path):
+                for file_name in file_names:
+                    if file_name.lower().endswith(SQL_FILE_EXTENSION):
+                        sql_files.append(os.path.join(root, file_name))
+        else:
+            sql_files.append(path)
+    return sorted(sql_files)
+
+
+def read_queries(paths):
+    # Yields (source file, statement index, query) for every statement found
+    for sql_file in collect_sql_files(paths):
+        with open(sql_file, encoding="utf-8") as f:
+            statements = split_statements(f.read())
+        for index, query in enumerate(statements):
+            yield (sql_file, index, query)
+
+
+def read_parameter_sets(path):
+    # One JSON list of parameter values per line
+    if not path:
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+##################################################################################################
+################################Worker methods####################################################
+##################################################################################################
+
+
+def create_plan_source(args):
+    # Replayed plans need no connection at all, nor psycopg2
+    if args.replay:
+        return ReplayPlanSource(args.replay)
+
+    from preprocessing import Preprocessing
+
+    history = PlanHistory(args.history) if args.history else None
+    # Each worker gets its share of the connections, which bounds how many alternatives it plans at once
+    source = Preprocessing(args.database, args.user, args.password, cache_dir=args.cache_dir, history=history,
+                           max_connections=max(args.max_connections // args.workers, 1))
+    if args.record:
+        source = RecordingPlanSource(source, args.record)
+    return source
+
+
+def init_worker(args):
+    global worker_plan_source
+    worker_plan_source = create_plan_source(args)
+    worker_options["analyze"] = args.analyze
+    worker_options["misestimate_factor"] = args.misestimate_factor
+    worker_options["alternatives"] = args.alternatives
+    worker_options["generic"] = args.generic
+    worker_options["parameter_sets"] = read_parameter_sets(args.parameters)
+    worker_options["dedupe"] = args.dedupe
+
+
+def annotate_query(job):
+    source, index, query = job
+    record = {
+        "source": source,
+        "index": index,
+        "query": query
+    }
+
+    try:
+        alternative_plans = None
+        if worker_options["generic"]:
+            # Only the parameter sets with as many values as the query has placeholders apply
+            count = parameter_count(query)
+            parameter_sets = [parameters for parameters in worker_options["parameter_sets"] if len(parameters) == count]
+            parsed_plan, custom_plans = worker_plan_source.getGenericQEPs(query, parameter_sets)
+            record["parameter_plans"] = describe_parameter_plans(parsed_plan, custom_plans, parameter_sets)
+        else:
+            parsed_plan = worker_plan_source.getQEP(query, analyze=worker_options["analyze"])
+
+        fingerprint = parsed_plan.shape_fingerprint()
+        record["plan_fingerprint"] = fingerprint
+        record["total_cost"] = parsed_plan.total_cost
+        # Workers take their queries in input order, so main has indexed this shape
+        # already and points the record at the query annotated for it
+        if worker_options["dedupe"] and fingerprint in worker_fingerprints:
+            return record
+
+        if worker_options["alternatives"]:
+            alternative_plans = worker_plan_source.getAlternativeQEPs(query, parsed_plan)
+        context = AnnotationContext(misestimate_factor=worker_options["misestimate_factor"],
+                                    alternatives=alternative_plans)
+        record["annotation"] = annotate(parsed_plan, context)
+        worker_fingerprints.add(fingerprint)
+    except Exception as e:
+        record["error"] = str(e)
+
+    return record
+
+
+##################################################################################################
+################################Main method call##################################################
+##################################################################################################
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Annotates the query execution plans of SQL statements without the GUI.")
+    parser.add_argument("inputs", nargs="+",
+                        help="SQL files or directories containing .sql files")
+    parser.add_argument("-o", "--output", required=True,
+                        help="JSONL file to write the annotations to")
+    parser.add_argument("-d", "--database", help="required unless --replay is given")
+    parser.add_argument("-u", "--user", help="required unless --replay is given")
+    parser.add_argument("-p", "--password", default=os.environ.get("PGPASSWORD", ""),
+                        help="defaults to the PGPASSWORD environment variable")
+    parser.add_argument("-w", "--workers", type=int,
+                        help="number of worker processes, each with its own connections; "
+                             "by default one per CPU, up to --max-connections")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="connections to the database all workers open at most, shared out between them")
+    parser.add_argument("--cache-dir",
+                        help="directory for the on-disk plan cache, shared by all workers")
+    parser.add_argument("--analyze", action="store_true",
+                        help="run the queries under EXPLAIN ANALYZE, in transactions that are rolled back")
+    parser.add_argument("--misestimate-factor", type=float, default=10.0,
+                        help="with --analyze, flag nodes whose row estimate is off by more than this factor")
+    parser.add_argument("--alternatives", action="store_true",
+                        help="compare each operator with the plan chosen when its enable_* setting is off")
+    parser.add_argument("--generic", action="store_true",
+                        help="PREPARE each query, which may use $1, $2, ... placeholders, and annotate its generic plan")
+    parser.add_argument("--parameters", metavar="FILE",
+                        help="with --generic, also compare the custom plans of the parameter sets in FILE, "
+                             "one JSON list of values per line")
+    parser.add_argument("--history",
+                        help="SQLite file to record every plan in, for comparison with later runs")
+    parser.add_argument("--dedupe", action="store_true",
+                        help="annotate each plan shape once; later queries whose plans only differ in their "
+                             "constants refer to the first query of their shape instead")
+    parser.add_argument("--index", metavar="FILE",
+                        help="save the plan shapes, with their queries and annotations, to FILE as JSON")
+    parser.add_argument("--top-shapes", type=int, default=0, metavar="N",
+                        help="print the N plan shapes with the highest cumulative estimated cost")
+    parser.add_argument("--chunksize", type=int, default=8,
+                        help="number of queries handed to a worker at a time")
+
+    plan_source = parser.add_mutually_exclusive_group()
+    plan_source.add_argument("--record", metavar="DIR",
+                             help="save every plan fetched from the database to DIR")
+    plan_source.add_argument("--replay", metavar="DIR",
+                             help="annotate the plans saved to DIR by --record, without a database")
+
+    args = parser.parse_args(argv)
+    if not args.replay and not (args.database and args.user):
+        parser.error("--database and --user are required unless --replay is given")
+    if args.workers is None:
+        args.workers = min(os.cpu_count() or 1, max(args.max_connections, 1))
+    if args.workers < 1 or args.max_connections < args.workers:
+        parser.error("--workers must be at least 1, and --max-connections at least --workers")
+    if args.generic and (args.analyze or args.alternatives):
+        parser.error("--generic cannot be combined with --analyze or --alternatives")
+    if args.parameters and not args.generic:
+        parser.error("--parameters requires --generic")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    annotated = 0
+    failed = 0
+    index = PlanIndex()
+
+    with ProcessPoolExecutor(max_workers=args.workers,
+                             initializer=init_worker,
+                             initargs=(args,)) as executor, \
+            open(args.output, "w", encoding="utf-8") as output:
+
+        # map keeps the input order, so the output lines up with the input files
+        for record in executor.map(annotate_query, read_queries(args.inputs),
+                                   chunksize=args.chunksize):
+            if "error" in record:
+                failed += 1
+                logging.error("%s [%d]: %s", record["source"], record["index"], record["error"])
+            else:
+                annotated += 1
+                origin = {"source": record["source"], "index": record["index"]}
+                entry = index.add(record["plan_fingerprint"], origin, record["query"], record["total_cost"],
+                                  record.get("annotation"))
+                if args.dedupe and entry.origin != origin:
+                    record.pop("annotation", None)
+                    record["same_shape_as"] = entry.origin
+            output.write(json.dumps(record) + "\n")
+
+    print(f"Annotated {annotated} queries in {len(index)} plan shapes, {failed} failed.", file=sys.stderr)
+    if args.top_shapes:
+        print(index.format_report(args.top_shapes), file=sys.stderr)
+    if args.index:
+        index.save(args.index)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
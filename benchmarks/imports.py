@@ -0,0 +1,84 @@
+"""Import-time benchmark: how long a fresh interpreter takes to import each
+entry point, and which heavy third-party packages that pulls in.
+
+The core library (annotation, batch, formatting, ...) must not import psycopg2,
+asyncpg, PySide6 or sql_formatter; they are only loaded once a live connection,
+the GUI or format_sql is actually used. The run fails if a core module loads any of them.
+
+Usage:
+    python benchmarks/imports.py [modules...] [--repeat N]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+HEAVY_PACKAGES = ["psycopg2", "asyncpg", "PySide6", "sql_formatter"]
+
+# Modules that must import with the standard library only
+CORE_MODULES = ["annotation", "plan", "expression", "highlight", "formatting", "plan_source", "qep_cache",
+                "history", "profiling", "prepared", "plan_index", "batch", "service", "workload"]
+
+# Modules expected to load heavy packages; only timed when those are installed
+FULL_MODULES = ["preprocessing", "interface"]
+
+# Run in a fresh interpreter, so that nothing is imported already
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(json.dumps({{"seconds": elapsed, "heavy": heavy}}))
+"""
+
+
+def time_import(module, repeat):
+    timings = []
+    heavy = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_PACKAGES)],
+                                cwd=ROOT_DIR, capture_output=True, text=True)
+        if result.returncode != 0:
+            # Last line of the traceback, e.g. ModuleNotFoundError: No module named 'PySide6'
+            return None, result.stderr.strip().splitlines()[-1]
+        probe = json.loads(result.stdout)
+        timings.append(probe["seconds"])
+        heavy = probe["heavy"]
+    return {"median": statistics.median(timings), "min": min(timings), "heavy": heavy}, None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Times importing each module in a fresh interpreter.")
+    parser.add_argument("modules", nargs="*", help="only time these modules")
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per module")
+    args = parser.parse_args(argv)
+
+    modules = args.modules or CORE_MODULES + FULL_MODULES
+    failures = []
+    print(f"{'module':<16}{'median ms':>12}{'min ms':>10}  heavy packages loaded")
+
+    for module in modules:
+        result, error = time_import(module, args.repeat)
+        if result is None:
+            print(f"{module:<16}{'-':>12}{'-':>10}  skipped: {error}")
+            continue
+
+        print(f"{module:<16}{result['median'] * 1000:>12.1f}{result['min'] * 1000:>10.1f}  "
+              f"{', '.join(result['heavy']) or '-'}")
+        if module in CORE_MODULES and result["heavy"]:
+            failures.append(module)
+
+    if failures:
+        print(f"\nCore module(s) importing heavy packages: {', '.join(failures)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+"""Offline benchmarks of the annotation pipeline; no database is needed.
+
+Each workload (a recorded TPC-H plan from fixtures/ or a synthetic plan) is
+timed stage by stage:
+    parse          PlanNode.from_json on the EXPLAIN text
+    annotate       annotate() with a cold condition cache
+    annotate+      annotate() with a warm condition cache, as in batch runs
+    annotate~      annotate() of the plan with one scan's filter edited, given an
+                   AnnotationCache of the unedited plan, as on Generate after Edit
+    format         format_sql on the query text, if sql_formatter is installed
+    format_tokens  the built-in single-pass formatter used for long queries
+    format+        format_query on an unchanged query, as on a repeated Generate
+    highlight      finding the highlight spans of every annotation in the query
+
+Usage:
+    python benchmarks/run.py                   # run and compare with baseline.json, if any
+    python benchmarks/run.py --save-baseline   # run and save the results as the new baseline
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+from annotation import AnnotationCache, annotate
+from expression import process_condition
+from formatting import format_query, format_tokens, get_format_sql
+from highlight import compile_highlights, find_highlights
+from plan import PlanNode
+from synthetic import SYNTHETIC_PLANS
+
+
+FIXTURES_DIR = os.path.join(BENCHMARKS_DIR, "fixtures")
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, "baseline.json")
+
+
+def load_workloads(names=None):
+    # Each workload is (name, query text or None, EXPLAIN JSON text)
+    workloads = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, "*.json"))):
+        with open(path, encoding="utf-8") as f:
+            fixture = json.load(f)
+        name = os.path.splitext(os.path.basename(path))[0]
+        workloads.append((name, fixture["query"], json.dumps(fixture["explain"])))
+
+    for name, generate in SYNTHETIC_PLANS.items():
+        workloads.append((name, None, json.dumps(generate())))
+
+    if names:
+        workloads = [workload for workload in workloads if workload[0] in names]
+    return workloads
+
+
+def edit_first_scan(explain_text):
+    # The EXPLAIN text with a filter added to the first leaf node, as if that predicate had been edited
+    explain = json.loads(explain_text)
+    node = explain[0]["Plan"]
+    while node.get("Plans"):
+        node = node["Plans"][0]
+    node["Filter"] = "(edited_column > 1)"
+    return json.dumps(explain)
+
+
+def get_stages(query, explain_text):
+    # Maps stage names to (setup, run); setup runs untimed before every run
+    plan = PlanNode.from_json(explain_text)
+    annotations = annotate(plan)
+
+    stages = {
+        "parse": (None, lambda: PlanNode.from_json(explain_text)),
+        "annotate": (process_condition.cache_clear, lambda: annotate(plan)),
+        "annotate+": (None, lambda: annotate(plan)),
+    }
+
+    edited_text = edit_first_scan(explain_text)
+    reannotate = {}
+
+    def prepare_reannotate():
+        reannotate["cache"] = AnnotationCache()
+        annotate(PlanNode.from_json(explain_text), cache=reannotate["cache"])
+        reannotate["plan"] = PlanNode.from_json(edited_text)
+
+    stages["annotate~"] = (prepare_reannotate, lambda: annotate(reannotate["plan"], cache=reannotate["cache"]))
+
+    if query is not None:
+        format_sql = get_format_sql()
+        if format_sql is not None:
+            stages["format"] = (None, lambda: format_sql(query))
+        stages["format_tokens"] = (None, lambda: format_tokens(query))
+        format_query(query)
+        stages["format+"] = (None, lambda: format_query(query))
+
+        def highlight():
+            for _, filters in annotations:
+                find_highlights(query, filters["table"], filters["cond"])
+
+        stages["highlight"] = (compile_highlights.cache_clear, highlight)
+
+    return stages, sum(1 for _ in plan.walk())
+
+
+def measure(setup, run, repeat):
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+
+    # Peak memory is measured on a separate run, as tracing slows everything down
+    if setup:
+        setup()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"median": statistics.median(timings), "min": min(timings), "peak_bytes": peak}
+
+
+def run_benchmarks(workloads, repeat):
+    results = {}
+    for name, query, explain_text in workloads:
+        stages, node_count = get_stages(query, explain_text)
+        for stage, (setup, run) in stages.items():
+            result = measure(setup, run, repeat)
+            result["nodes_per_second"] = node_count / result["median"] if result["median"] else None
+            results[f"{name}/{stage}"] = result
+    return results
+
+
+def report(results, baseline, threshold):
+    """Prints the results next to the baseline and returns the regressed benchmarks."""
+    regressions = []
+    print(f"{'benchmark':<32}{'median ms':>12}{'nodes/s':>14}{'peak KiB':>12}{'vs baseline':>14}")
+
+    for key, result in results.items():
+        comparison = ""
+        if key in baseline:
+            change = result["median"] / baseline[key]["median"] - 1
+            comparison = f"{change:+.0%}"
+            if change > threshold:
+                comparison += " SLOWER"
+                regressions.append(key)
+
+        nodes_per_second = f"{result['nodes_per_second']:,.0f}" if result["nodes_per_second"] else "-"
+        print(f"{key:<32}{result['median'] * 1000:>12.3f}{nodes_per_second:>14}"
+              f"{result['peak_bytes'] / 1024:>12.1f}{comparison:>14}")
+
+    if get_format_sql() is None:
+        print("\nformat stage skipped: sql_formatter is not installed.")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the annotation pipeline on recorded plans.")
+    parser.add_argument("workloads", nargs="*", help="only run these workloads (fixture or synthetic names)")
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs per stage")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline results to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as the baseline")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="fraction by which a median may exceed the baseline before it is a regression")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(load_workloads(args.workloads), args.repeat)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    regressions = report(results, baseline, args.threshold)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved baseline to {args.baseline}")
+
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""Generators of large plans in the EXPLAIN (FORMAT JSON) layout, for the shapes
+that stress annotation the most: deep join chains, wide appends and tables with
+many partitions."""
+
+
+def scan(relation, filter_string=None, parent="Outer"):
+    plan = {
+        "Node Type": "Seq Scan",
+        "Parent Relationship": parent,
+        "Relation Name": relation,
+        "Alias": relation,
+        "Startup Cost": 0.0,
+        "Total Cost": 1000.0,
+        "Plan Rows": 10000,
+        "Plan Width": 16
+    }
+    if filter_string:
+        plan["Filter"] = filter_string
+    return plan
+
+
+def deep_plan(depth=300):
+    """A left-deep chain of depth nested loop joins, each probing an index."""
+    plan = scan("t0", "(t0_value > 100)")
+    for i in range(1, depth + 1):
+        inner = {
+            "Node Type": "Index Scan",
+            "Parent Relationship": "Inner",
+            "Scan Direction": "Forward",
+            "Index Name": f"t{i}_pkey",
+            "Relation Name": f"t{i}",
+            "Alias": f"t{i}",
+            "Startup Cost": 0.42,
+            "Total Cost": 8.44,
+            "Plan Rows": 1,
+            "Plan Width": 16,
+            "Index Cond": f"(t{i}_id = t{i - 1}.t{i - 1}_ref)"
+        }
+        plan = {
+            "Node Type": "Nested Loop",
+            "Parent Relationship": "Outer",
+            "Join Type": "Inner",
+            "Startup Cost": 0.42,
+            "Total Cost": 1000.0 + i * 8.44,
+            "Plan Rows": 10000,
+            "Plan Width": 16,
+            "Plans": [plan, inner]
+        }
+    plan.pop("Parent Relationship")
+    return [{"Plan": plan}]
+
+
+def wide_plan(width=2000):
+    """An aggregate over an append of width scans of different relations."""
+    return [{"Plan": {
+        "Node Type": "Aggregate",
+        "Strategy": "Plain",
+        "Startup Cost": 0.0,
+        "Total Cost": width * 1000.0,
+        "Plan Rows": 1,
+        "Plan Width": 8,
+        "Plans": [{
+            "Node Type": "Append",
+            "Parent Relationship": "Outer",
+            "Startup Cost": 0.0,
+            "Total Cost": width * 1000.0,
+            "Plan Rows": width * 10000,
+            "Plan Width": 16,
+            "Plans": [scan(f"r{i}", f"((r{i}_flag = 'A'::bpchar) AND (r{i}_qty < '24'::numeric))", "Member")
+                      for i in range(width)]
+        }]
+    }}]
+
+
+def partitioned_plan(partitions=1000):
+    """A hash join of orders against every partition of a partitioned lineitem."""
+    partition_scans = [
+        scan(f"lineitem_p{i}", "(l_shipdate > '1995-03-15'::date)", "Member") for i in range(partitions)
+    ]
+    return [{"Plan": {
+        "Node Type": "Hash Join",
+        "Join Type": "Inner",
+        "Startup Cost": 5000.0,
+        "Total Cost": partitions * 1000.0 + 5000.0,
+        "Plan Rows": partitions * 10000,
+        "Plan Width": 24,
+        "Hash Cond": "(lineitem.l_orderkey = orders.o_orderkey)",
+        "Plans": [
+            {
+                "Node Type": "Append",
+                "Parent Relationship": "Outer",
+                "Startup Cost": 0.0,
+                "Total Cost": partitions * 1000.0,
+                "Plan Rows": partitions * 10000,
+                "Plan Width": 16,
+                "Plans": partition_scans
+            },
+            {
+                "Node Type": "Hash",
+                "Parent Relationship": "Inner",
+                "Startup Cost": 4072.0,
+                "Total Cost": 4072.0,
+                "Plan Rows": 72678,
+                "Plan Width": 8,
+                "Plans": [scan("orders", "(o_orderdate < '1995-03-15'::date)")]
+            }
+        ]
+    }}]
+
+
+SYNTHETIC_PLANS = {
+    "deep_300": lambda: deep_plan(300),
+    "wide_2000": lambda: wide_plan(2000),
+    "partitioned_1000": lambda: partitioned_plan(1000),
+}
@@ -0,0 +1,258 @@
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+
+# Tokenizer for the expressions PostgreSQL prints in EXPLAIN output, e.g.
+# "((l_shipdate >= '1994-01-01'::date) AND ((p_type)::text ~~ '%BRASS'::text))"
+NAME = r'(?:[A-Za-z_][\w$]*|"(?:[^"]|"")*")'
+
+TOKEN_REGEX = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<name>{name}(?:\.{name})*)
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<param>\$\d+)
+  | (?P<cast>::)
+  | (?P<open>[(\[])
+  | (?P<close>[)\]])
+  | (?P<comma>,)
+  | (?P<operator>[<>=!~+\-*/%^|&#@?]+)
+  | (?P<other>.)
+""".format(name=NAME), re.VERBOSE | re.DOTALL)
+
+# Words that may follow the first word of a type name, as in "timestamp without time zone"
+TYPE_NAME_CONTINUATIONS = {"varying", "precision", "without", "with", "time", "zone"}
+
+# Casts of quoted literals to these types are printed without the quotes
+NUMERIC_TYPES = {"numeric", "integer", "bigint", "smallint", "real", "double", "int", "int2", "int4", "int8",
+                 "float4", "float8", "decimal"}
+
+# Words that are part of the expression syntax rather than attribute names
+KEYWORDS = {"and", "or", "not", "is", "null", "true", "false", "in", "like", "ilike", "similar", "to",
+            "between", "any", "all", "some", "distinct", "from", "case", "when", "then", "else", "end",
+            "array", "row", "exists", "escape", "collate", "at", "time", "zone", "subplan", "initplan",
+            "hashed", "returns", "unknown", "asc", "desc", "nulls", "first", "last", "using"}
+
+Token = namedtuple("Token", ["kind", "text", "spaced"])
+
+# A parenthesised or bracketed part of an expression; close is None if it is never closed
+Group = namedtuple("Group", ["open", "items", "close"])
+
+# Result of processing one condition string:
+#   text: the whole condition without casts, with attributes qualified by relation name
+#   conjuncts: the conditions that are ANDed (or listed) at the top level
+#   join_conditions: the conjuncts that equate two attributes
+Condition = namedtuple("Condition", ["text", "conjuncts", "join_conditions"])
+
+
+def tokenize(expression):
+    tokens = []
+    spaced = False
+    for match in TOKEN_REGEX.finditer(expression):
+        kind = match.lastgroup
+        if kind == "space":
+            spaced = True
+            continue
+        tokens.append(Token(kind, match.group(), spaced))
+        spaced = False
+    return tokens
+
+
+def parse(expression):
+    """Parses an expression into a list of tokens and groups, where each group
+    holds the items between a pair of parentheses or brackets."""
+    root = []
+    # Each entry is (opening token, items of the enclosing level)
+    stack = []
+    items = root
+
+    for token in tokenize(expression):
+        if token.kind == "open":
+            stack.append((token, items))
+            items = []
+        elif token.kind == "close" and stack:
+            open_token, outer_items = stack.pop()
+            outer_items.append(Group(open_token, items, token))
+            items = outer_items
+        else:
+            items.append(token)
+
+    while stack:
+        open_token, outer_items = stack.pop()
+        outer_items.append(Group(open_token, items, None))
+        items = outer_items
+
+    return root
+
+
+##################################################################################################
+################################Rendering#########################################################
+##################################################################################################
+
+
+def is_token(item, kind, text=None):
+    return (isinstance(item, Token) and item.kind == kind
+            and (text is None or item.text.lower() == text))
+
+
+def skip_type_name(items, i):
+    # Returns the index after the type name starting at items[i] and the type's first word,
+    # followed by "[]" for array types
+    if i >= len(items) or not is_token(items[i], "name"):
+        return i, None
+
+    type_name = items[i].text.strip('"').lower()
+    i += 1
+    while i < len(items) and is_token(items[i], "name") and items[i].text.lower() in TYPE_NAME_CONTINUATIONS:
+        i += 1
+
+    # Type modifiers such as numeric(15,2)
+    if (i < len(items) and isinstance(items[i], Group) and items[i].open.text == "("
+            and not items[i].open.spaced
+            and all(is_token(item, "number") or is_token(item, "comma") for item in items[i].items)):
+        i += 1
+
+    # Array types such as text[]
+    while i < len(items) and isinstance(items[i], Group) and items[i].open.text == "[" and not items[i].items:
+        type_name += "[]"
+        i += 1
+
+    return i, type_name
+
+
+def should_qualify(items, i):
+    token = items[i]
+    if token.kind != "name" or "." in token.text or token.text.lower() in KEYWORDS:
+        return False
+    # Collations, as in "name COLLATE "C"", and fields of composite values, as in "(t.address).city"
+    previous_item = items[i - 1] if i > 0 else None
+    if is_token(previous_item, "name", "collate") or is_token(previous_item, "other", "."):
+        return False
+    # Function calls such as date_part(...)
+    next_item = items[i + 1] if i + 1 < len(items) else None
+    return not (isinstance(next_item, Group) and next_item.open.text == "(" and not next_item.open.spaced)
+
+
+def render(items, table_name, out, extract=False):
+    # extract is set for the arguments of EXTRACT(field FROM source), whose field is no attribute
+    i = 0
+    while i < len(items):
+        item = items[i]
+
+        if isinstance(item, Group):
+            out.append(" " + item.open.text if item.open.spaced else item.open.text)
+            render(item.items, table_name, out, i > 0 and is_token(items[i - 1], "name", "extract"))
+            if item.close is not None:
+                out.append(" " + item.close.text if item.close.spaced else item.close.text)
+            i += 1
+            continue
+
+        if item.kind == "cast":
+            i, _ = skip_type_name(items, i + 1)
+            continue
+
+        text = item.text
+        if item.kind == "string" and i + 1 < len(items) and is_token(items[i + 1], "cast"):
+            _, type_name = skip_type_name(items, i + 2)
+            if type_name in NUMERIC_TYPES:
+                text = text[1:-1]
+        elif table_name and not (extract and i == 0) and should_qualify(items, i):
+            text = f"{table_name}.{text}"
+
+        out.append(" " + text if item.spaced else text)
+        i += 1
+
+
+def render_items(items, table_name):
+    out = []
+    render(items, table_name, out)
+    return "".join(out).strip()
+
+
+def unwrap(items):
+    # Strips parentheses that enclose the whole expression
+    while len(items) == 1 and isinstance(items[0], Group) and items[0].open.text == "(":
+        items = items[0].items
+    return items
+
+
+def split_conjuncts(items):
+    conjuncts = [[]]
+    for item in unwrap(items):
+        if is_token(item, "name", "and") or is_token(item, "comma"):
+            conjuncts.append([])
+        else:
+            conjuncts[-1].append(item)
+    return [unwrap(conjunct) for conjunct in conjuncts if conjunct]
+
+
+def strip_casts(items):
+    stripped = []
+    i = 0
+    while i < len(items):
+        if is_token(items[i], "cast"):
+            i, _ = skip_type_name(items, i + 1)
+            continue
+        stripped.append(items[i])
+        i += 1
+    return stripped
+
+
+def is_attribute(item):
+    return is_token(item, "name") and item.text.lower() not in KEYWORDS
+
+
+def strip_operand(item):
+    # The attribute inside parentheses left around a cast, as in "(s_name)::text" or "((a.x)::text)::varchar"
+    while isinstance(item, Group) and item.open.text == "(":
+        items = strip_casts(item.items)
+        if len(items) != 1:
+            break
+        item = items[0]
+    return item
+
+
+def is_join_condition(conjunct):
+    # attribute = attribute, ignoring any casts on either side
+    conjunct = [strip_operand(item) for item in strip_casts(conjunct)]
+    return (len(conjunct) == 3 and is_attribute(conjunct[0])
+            and is_token(conjunct[1], "operator", "=") and is_attribute(conjunct[2]))
+
+
+# Literals and $n parameters, with the sign of negative numbers, and the names
+# that digits may be part of, which normalize_condition keeps
+LITERAL_REGEX = re.compile(r"""
+    (?P<name>{name}(?:\.{name})*)
+  | (?P<sign>(?:(?<=[<>=!~+\-*/%^|&#@?(\[,])|^)\s*-\s*(?=[\d.]))?
+    (?:'(?:[^']|'')*'|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?|\$\d+)
+""".format(name=NAME), re.VERBOSE)
+
+
+def replace_literal(match):
+    if match.lastgroup == "name":
+        return match.group()
+    sign = match.group("sign")
+    return " ?" if sign and sign[0].isspace() else "?"
+
+
+@lru_cache(maxsize=8192)
+def normalize_condition(condition_string):
+    """Replaces the literals and $n parameters of the condition with ?, so the
+    conditions of queries that only differ in their constants compare equal."""
+    return LITERAL_REGEX.sub(replace_literal, condition_string)
+
+
+@lru_cache(maxsize=8192)
+def process_condition(condition_string, table_name=None):
+    """Removes casts, qualifies attributes with table_name (if given) and splits
+    the condition into its conjuncts. Results are memoized per distinct input,
+    as the same conditions recur across plans."""
+    items = parse(condition_string)
+    conjuncts = split_conjuncts(items)
+
+    return Condition(
+        render_items(items, table_name),
+        tuple(render_items(conjunct, table_name) for conjunct in conjuncts),
+        tuple(render_items(conjunct, table_name) for conjunct in conjuncts if is_join_condition(conjunct))
+    )
@@ -0,0 +1,250 @@
+import re
+from array import array
+from collections import OrderedDict
+from threading import Lock
+
+from expression import TOKEN_REGEX
+
+
+# Queries longer than this are formatted by format_tokens, as format_sql slows down on them
+LARGE_QUERY_LENGTH = 20000
+
+FORMAT_CACHE_SIZE = 128
+
+# The expression tokenizer, with SQL comments kept as single tokens, and E'...' strings
+# (where a backslash escapes the quote) and $tag$...$tag$ strings as single literals
+SQL_TOKEN_REGEX = re.compile(r"""
+    (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<escape_string>(?<![\w$])[eE]'(?:[^'\\]|\\.|'')*')
+  | (?P<dollar_string>\$(?P<dollar_tag>(?:[A-Za-z_\x80-\uffff][\w\x80-\uffff]*)?)\$.*?\$(?P=dollar_tag)\$)
+  | """ + TOKEN_REGEX.pattern, re.VERBOSE | re.DOTALL)
+
+# Token kinds of SQL_TOKEN_REGEX that sql_tokens reports as "string"
+STRING_KINDS = {"escape_string", "dollar_string"}
+
+INDENT = "    "
+
+# Keywords starting a line of their own
+CLAUSE_KEYWORDS = {"select", "from", "where", "group", "order", "having", "limit", "offset", "fetch",
+                   "union", "intersect", "except", "values", "set", "returning", "window", "join",
+                   "inner", "left", "right", "full", "cross", "natural", "insert", "update", "delete"}
+
+# Words after which a clause keyword continues the line, as in "left outer join" or "delete from"
+CONTINUED_BY_CLAUSE = {"inner", "left", "right", "full", "cross", "natural", "outer", "delete", "union",
+                       "intersect", "except"}
+
+# Keywords opening a subquery when they follow a parenthesis
+SUBQUERY_KEYWORDS = {"select", "with", "values"}
+
+# Clauses listing one item per line
+LIST_CLAUSES = {"select", "group", "order"}
+
+# Clauses listing one condition per line
+CONDITION_CLAUSES = {"where", "having", "on"}
+
+# Printed in upper case, like format_sql does
+UPPER_KEYWORDS = CLAUSE_KEYWORDS | SUBQUERY_KEYWORDS | CONDITION_CLAUSES | {
+    "by", "all", "into", "outer", "as", "and", "or", "not", "in", "is", "null", "like", "ilike", "between",
+    "exists", "case", "when", "then", "else", "end", "distinct", "asc", "desc", "interval", "date", "any",
+    "some", "true", "false", "using", "nulls", "first", "last", "rows", "only", "recursive", "lateral"}
+
+
+##################################################################################################
+################################Formatting########################################################
+##################################################################################################
+
+
+def sql_tokens(query):
+    """Yields the (kind, text) of every token of query, whitespace included,
+    with every kind of string literal reported as "string"."""
+    for match in SQL_TOKEN_REGEX.finditer(query):
+        kind = match.lastgroup
+        yield "string" if kind in STRING_KINDS else kind, match.group()
+
+
+def needs_space(previous_kind, previous_text, kind, text):
+    if previous_kind == "open" or kind in ("close", "comma"):
+        return False
+    if kind == "cast" or previous_kind == "cast" or text in (".", ";") or previous_text == ".":
+        return False
+    # Function calls, but not "IN (" or "AS ("
+    if kind == "open" and previous_kind == "name" and previous_text.lower() not in UPPER_KEYWORDS:
+        return False
+    return True
+
+
+def format_tokens(query):
+    """Formats query in a single pass over its tokens, in the layout of format_sql:
+    clauses on lines of their own, select lists one item per line, conditions one
+    per line and subqueries indented. Only whitespace and the case of keywords
+    change, which is what align_offsets relies on."""
+    parts = []
+    # One entry per open parenthesis: (indent, clause) of the enclosing level, and whether it holds a subquery
+    levels = []
+    indent = ""
+    clause = None
+    in_between = False
+    previous_kind = previous_text = None
+    # Indentation of the line the next token must start, after a list comma or a line comment
+    line_break = None
+
+    for kind, text in sql_tokens(query):
+        if kind == "space":
+            continue
+
+        word = text.lower() if kind == "name" else None
+        line_start = None
+        pending_line_break, line_break = line_break, None
+
+        if word in SUBQUERY_KEYWORDS and previous_kind == "open" and levels:
+            levels[-1][2] = True
+            indent += INDENT
+            line_start = indent
+        elif word in CLAUSE_KEYWORDS and (previous_text or "").lower() not in CONTINUED_BY_CLAUSE:
+            line_start = indent
+        elif kind == "close" and levels and levels[-1][2]:
+            line_start = levels[-1][0]
+        elif word in ("and", "or") and clause in CONDITION_CLAUSES and not (word == "and" and in_between):
+            line_start = indent + INDENT
+        else:
+            line_start = pending_line_break
+
+        if line_start is not None and parts:
+            parts.append("\n" + line_start)
+        elif previous_kind is not None and needs_space(previous_kind, previous_text, kind, text):
+            parts.append(" ")
+        parts.append(text.upper() if word in UPPER_KEYWORDS else text)
+
+        if word in CLAUSE_KEYWORDS or word in CONDITION_CLAUSES:
+            clause = word
+            in_between = False
+        elif word == "between":
+            in_between = True
+        elif word == "and":
+            in_between = False
+
+        previous_kind, previous_text = kind, text
+        if kind == "open":
+            # Commas and conditions inside the parentheses of a function call are not split
+            levels.append([indent, clause, False])
+            clause = None
+        elif kind == "close" and levels:
+            indent, clause, _ = levels.pop()
+        elif kind == "comma" and clause in LIST_CLAUSES:
+            line_break = indent + INDENT
+        elif kind == "comment" and text.startswith("--"):
+            # The line comment must not swallow the tokens after it
+            line_break = indent
+
+    return "".join(parts).strip()
+
+
+def align_offsets(original, formatted):
+    """Maps every offset in original to the offset of the same character in
+    formatted, given that formatting only changed whitespace and letter case.
+    Returns None if the two texts differ in anything else."""
+    offsets = array("l", [0]) * (len(original) + 1)
+    j = 0
+    length = len(formatted)
+
+    for i, char in enumerate(original):
+        if char.isspace():
+            offsets[i] = j
+            continue
+        while j < length and formatted[j].isspace():
+            j += 1
+        if j == length or formatted[j].lower() != char.lower():
+            return None
+        offsets[i] = j
+        j += 1
+
+    offsets[len(original)] = length
+    return offsets
+
+
+class FormattedQuery:
+    """A query with its formatted text. The offset map from the original text to
+    the formatted one is built on first use, so spans found in the original query
+    can be highlighted in the formatted one."""
+
+    __slots__ = ("original", "text", "_offsets")
+
+    UNALIGNED = object()
+
+    def __init__(self, original, text):
+        self.original = original
+        self.text = text
+        self._offsets = self.UNALIGNED
+
+    @property
+    def offsets(self):
+        if self._offsets is self.UNALIGNED:
+            self._offsets = align_offsets(self.original, self.text)
+        return self._offsets
+
+    def to_formatted(self, offset):
+        offsets = self.offsets
+        if offsets is None or not 0 <= offset < len(offsets):
+            return None
+        return offsets[offset]
+
+    def map_spans(self, spans):
+        """Maps (kind, start, end) spans of the original text onto the formatted text."""
+        mapped = []
+        for kind, start, end in spans:
+            formatted_start = self.to_formatted(start)
+            # The end is mapped from the last character, so trailing whitespace is not included
+            formatted_end = self.to_formatted(end - 1)
+            if formatted_start is not None and formatted_end is not None:
+                mapped.append((kind, formatted_start, formatted_end + 1))
+        return mapped
+
+
+##################################################################################################
+################################Cached formatting#################################################
+##################################################################################################
+
+
+format_cache = OrderedDict()
+format_cache_lock = Lock()
+
+# sql_formatter is imported on the first query formatted, rather than with this module
+NOT_LOADED = object()
+format_sql_function = NOT_LOADED
+
+
+def get_format_sql():
+    """Returns sql_formatter's format_sql, or None if it is not installed."""
+    global format_sql_function
+    if format_sql_function is NOT_LOADED:
+        try:
+            from sql_formatter.core import format_sql
+        except ImportError:
+            format_sql = None
+        format_sql_function = format_sql
+    return format_sql_function
+
+
+def format_text(query):
+    format_sql = get_format_sql()
+    if format_sql is None or len(query) > LARGE_QUERY_LENGTH:
+        return format_tokens(query)
+    return format_sql(query)
+
+
+def format_query(query):
+    """Returns the FormattedQuery of query, formatting each distinct text once."""
+    with format_cache_lock:
+        formatted = format_cache.get(query)
+        if formatted is not None:
+            format_cache.move_to_end(query)
+            return formatted
+
+    formatted = FormattedQuery(query, format_text(query))
+
+    with format_cache_lock:
+        format_cache[query] = formatted
+        while len(format_cache) > FORMAT_CACHE_SIZE:
+            format_cache.popitem(last=False)
+
+    return formatted
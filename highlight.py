@@ -0,0 +1,56 @@
+import re
+from functools import lru_cache
+
+
+# Kinds of highlight, each shown with its own format
+TABLE = "table"
+CONDITION = "cond"
+
+QUALIFIER_REGEX = re.compile(r"[A-Za-z_]\w*\.(?=[A-Za-z_\"])")
+
+
+def condition_patterns(condition):
+    """Turns a condition from an annotation, e.g. "orders.o_custkey = customer.c_custkey",
+    into patterns matching it in the query text, in either operand order. Relation
+    qualifiers are dropped as the query may use aliases or bare attribute names."""
+    items = []
+    for item in condition.split():
+        if not item.startswith("'"):
+            item = QUALIFIER_REGEX.sub("", item.strip("()"))
+        if item:
+            items.append(re.escape(item))
+
+    if not items:
+        return []
+    return ['.*?'.join(items), '.*?'.join(reversed(items))]
+
+
+@lru_cache(maxsize=1024)
+def compile_highlights(table_names, conditions):
+    """Compiles the patterns of one annotation once. Both arguments are tuples so
+    that the result can be memoized; returns a tuple of (kind, compiled pattern)."""
+    patterns = []
+
+    if table_names:
+        # Lines of the FROM clause naming any of the tables
+        tables = '|'.join(re.escape(table_name) for table_name in table_names)
+        patterns.append((TABLE, re.compile(r'^.*from.*(?:' + tables + ').*$', re.IGNORECASE | re.MULTILINE)))
+
+    condition_alternatives = []
+    for condition in conditions:
+        condition_alternatives += condition_patterns(condition)
+    if condition_alternatives:
+        patterns.append((CONDITION, re.compile('(?:' + '|'.join(condition_alternatives) + ')', re.IGNORECASE)))
+
+    return tuple(patterns)
+
+
+def find_highlights(text, table_names, conditions):
+    """Returns the (kind, start, end) spans of text to highlight for an annotation."""
+    spans = []
+    for kind, pattern in compile_highlights(tuple(table_names), tuple(conditions)):
+        for match in pattern.finditer(text):
+            start, end = match.span()
+            if end > start:
+                spans.append((kind, start, end))
+    return spans
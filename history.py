@@ -0,0 +1,129 @@
+import json
+import os
+import sqlite3
+import time
+from collections import Counter, namedtuple
+from threading import Lock
+
+from annotation import JOIN_NODE_TYPES
+from qep_cache import query_fingerprint
+
+
+DEFAULT_HISTORY_PATH = os.path.join(os.path.expanduser("~"), ".qep_history.sqlite3")
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS plans (
+        id INTEGER PRIMARY KEY,
+        fingerprint TEXT NOT NULL,
+        query TEXT NOT NULL,
+        recorded_at REAL NOT NULL,
+        total_cost REAL,
+        node_types TEXT NOT NULL,
+        join_order TEXT NOT NULL,
+        plan TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS plans_fingerprint ON plans (fingerprint, recorded_at);
+"""
+
+# node_types is a list of [node type, alias or relation name or None], parents first
+PlanRecord = namedtuple("PlanRecord", ["id", "query", "recorded_at", "total_cost", "node_types", "join_order"])
+
+
+class PlanHistory:
+    """SQLite store of every plan generated for a query, used to spot plans that
+    got more expensive or changed operators since they were last generated."""
+
+    def __init__(self, path=DEFAULT_HISTORY_PATH):
+        self.lock = Lock()
+        # Plans are recorded from worker threads as well as the GUI thread
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def record(self, query, plan):
+        node_types = get_node_types(plan)
+
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO plans (fingerprint, query, recorded_at, total_cost, node_types, join_order, plan) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (query_fingerprint(query), query, time.time(), plan.total_cost,
+                 json.dumps(node_types), json.dumps(list(plan.table_names)), json.dumps(plan.to_dict())))
+
+    def latest(self, query, count=2):
+        """Returns up to count records of the query, newest first."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, query, recorded_at, total_cost, node_types, join_order FROM plans "
+                "WHERE fingerprint = ? ORDER BY recorded_at DESC, id DESC LIMIT ?",
+                (query_fingerprint(query), count)).fetchall()
+
+        return [PlanRecord(row_id, query_text, recorded_at, total_cost, json.loads(node_types), json.loads(join_order))
+                for row_id, query_text, recorded_at, total_cost, node_types, join_order in rows]
+
+    def compare_with_previous(self, query, regression_threshold=0.1):
+        records = self.latest(query)
+        if len(records) < 2:
+            return ["There is no earlier plan of this query to compare with."]
+
+        current, previous = records
+        return compare_plans(previous, current, regression_threshold)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def compare_plans(previous, current, regression_threshold=0.1):
+    """Describes how current differs from previous. Cost changes beyond
+    regression_threshold (a fraction of the previous cost) are reported."""
+    when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(previous.recorded_at))
+    changes = []
+
+    if previous.total_cost and current.total_cost is not None:
+        change = (current.total_cost - previous.total_cost) / previous.total_cost
+        if change > regression_threshold:
+            changes.append(f"REGRESSION: the estimated cost rose from {previous.total_cost:.2f} "
+                           f"to {current.total_cost:.2f} (+{change:.0%}) since {when}.")
+        elif change < -regression_threshold:
+            changes.append(f"The estimated cost fell from {previous.total_cost:.2f} "
+                           f"to {current.total_cost:.2f} ({change:.0%}) since {when}.")
+
+    changes += compare_operators(previous.node_types, current.node_types, previous.join_order, current.join_order)
+
+    if not changes:
+        changes.append(f"The plan has not changed since {when}.")
+
+    return changes
+
+
+def get_node_types(plan):
+    return [[node.node_type, node.alias or node.relation_name] for node in plan.walk()]
+
+
+def compare_operators(previous_node_types, current_node_types, previous_join_order, current_join_order):
+    """Describes the changes in scan methods, join methods and join order between two plans."""
+    changes = []
+
+    # Scan method of each relation, e.g. Index Scan -> Seq Scan
+    previous_scans = {name: node_type for node_type, name in previous_node_types if name}
+    current_scans = {name: node_type for node_type, name in current_node_types if name}
+    for name in sorted(previous_scans.keys() & current_scans.keys()):
+        if previous_scans[name] != current_scans[name]:
+            changes.append(f"{name} is now read with {current_scans[name]} instead of {previous_scans[name]}.")
+
+    previous_joins = Counter(node_type for node_type, _ in previous_node_types if node_type in JOIN_NODE_TYPES)
+    current_joins = Counter(node_type for node_type, _ in current_node_types if node_type in JOIN_NODE_TYPES)
+    if previous_joins != current_joins:
+        changes.append(f"The join methods changed from {format_counts(previous_joins)} "
+                       f"to {format_counts(current_joins)}.")
+
+    if previous_join_order != current_join_order:
+        changes.append(f"The join order changed from {', '.join(previous_join_order)} "
+                       f"to {', '.join(current_join_order)}.")
+
+    return changes
+
+
+def format_counts(counts):
+    return ", ".join(f"{count} {node_type}" for node_type, count in sorted(counts.items())) or "none"
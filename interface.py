@@ -2,22 +2,44 @@ import sys
 import random
 import logging
 import json
-import re
-
-from preprocessing import Preprocessing
-from annotation import annotate
+import difflib
+
+from history import PlanHistory
+from plan_source import RecordingPlanSource, ReplayPlanSource
+from highlight import CONDITION, TABLE, find_highlights
+from formatting import format_query
+from prepared import describe_parameter_plans
+from annotation import AnnotationCache, AnnotationContext, annotate
+from profiling import profiler
 from PySide6 import QtWidgets, QtGui, QtCore
-from sql_formatter.core import format_sql
 
 class GuiInterface(QtWidgets.QWidget):
   def __init__(self):
     super().__init__()
     self.setUI()
-    self.annotate_index = {}
+    self.highlight_spans = {}
+    self.highlight_formats = self.create_highlight_formats()
+    self.thread_pool = QtCore.QThreadPool.globalInstance()
+    self.request_id = 0
+    # Annotations of plan subtrees, reused when an edited query is generated again
+    self.annotation_cache = AnnotationCache()
     self.reformatter_index = {
 
     }
 
+  def create_highlight_formats(self):
+    # tableList format
+    tableList_format = QtGui.QTextCharFormat()
+    tableList_format.setForeground(QtCore.Qt.blue)
+    tableList_format.setFontWeight(QtGui.QFont.Bold)
+
+    # conList format
+    conList_format = QtGui.QTextCharFormat()
+    conList_format.setForeground(QtCore.Qt.red)
+    conList_format.setFontItalic(True)
+
+    return {TABLE: tableList_format, CONDITION: conList_format}
+
   def setUI(self):
     self.setWindowTitle('Query')
     
@@ -43,9 +65,23 @@ class GuiInterface(QtWidgets.QWidget):
     self.pw_tb.setEchoMode(QtWidgets.QLineEdit.Password)
     db_layout.addWidget(self.pw_tb, 2, 1)
 
+    # Where plans come from: the database, the database while saving every plan
+    # to the plans folder, or only the plans saved there earlier
+    self.source_lbl = QtWidgets.QLabel("Plans:", self)
+    db_layout.addWidget(self.source_lbl, 3, 0)
+    self.source_cb = QtWidgets.QComboBox(self)
+    self.source_cb.addItems(["Live", "Record", "Replay"])
+    db_layout.addWidget(self.source_cb, 3, 1)
+
+    self.plans_dir_lbl = QtWidgets.QLabel("Plans folder:", self)
+    db_layout.addWidget(self.plans_dir_lbl, 4, 0)
+    self.plans_dir_tb = QtWidgets.QLineEdit(self)
+    self.plans_dir_tb.setPlaceholderText("Used when recording or replaying plans")
+    db_layout.addWidget(self.plans_dir_tb, 4, 1)
+
     self.connect_button = QtWidgets.QPushButton('Connect to database', self)
     self.connect_button.clicked.connect(self.onclick_connect)
-    db_layout.addWidget(self.connect_button, 3, 0, 1, 2)
+    db_layout.addWidget(self.connect_button, 5, 0, 1, 2)
 
     db_container.setLayout(db_layout)
 
@@ -61,9 +97,39 @@ class GuiInterface(QtWidgets.QWidget):
     self.query_ta.setPlaceholderText("Enter query here.")
     query_layout.addWidget(self.query_ta, 1, 0)
 
+    # EXPLAIN ANALYZE options
+    analyze_layout = QtWidgets.QHBoxLayout()
+
+    self.analyze_cb = QtWidgets.QCheckBox("Run EXPLAIN ANALYZE (rolled back)", self)
+    analyze_layout.addWidget(self.analyze_cb)
+
+    self.misestimate_lbl = QtWidgets.QLabel("Flag row estimates off by more than:", self)
+    analyze_layout.addWidget(self.misestimate_lbl)
+    self.misestimate_sb = QtWidgets.QDoubleSpinBox(self)
+    self.misestimate_sb.setRange(1.0, 1000000.0)
+    self.misestimate_sb.setValue(10.0)
+    self.misestimate_sb.setSuffix("x")
+    analyze_layout.addWidget(self.misestimate_sb)
+
+    query_layout.addLayout(analyze_layout, 2, 0)
+
+    self.alternatives_cb = QtWidgets.QCheckBox("Compare with alternative plans (enable_* settings off)", self)
+    query_layout.addWidget(self.alternatives_cb, 3, 0)
+
+    # Prepared statements: the generic plan, and the custom plans of the parameter sets given
+    self.generic_cb = QtWidgets.QCheckBox("Generic plan of the query as a prepared statement ($1, $2, ...)", self)
+    self.generic_cb.toggled.connect(self.ontoggle_generic)
+    query_layout.addWidget(self.generic_cb, 4, 0)
+
+    self.parameters_ta = QtWidgets.QPlainTextEdit(self)
+    self.parameters_ta.setPlaceholderText('Parameter sets to compare, one JSON list per line, e.g. ["BRASS", 15]')
+    self.parameters_ta.setMaximumHeight(80)
+    self.parameters_ta.setVisible(False)
+    query_layout.addWidget(self.parameters_ta, 5, 0)
+
     self.generate_button = QtWidgets.QPushButton('Generate', self)
     self.generate_button.clicked.connect(self.onclick_generate)
-    query_layout.addWidget(self.generate_button, 2, 0)
+    query_layout.addWidget(self.generate_button, 6, 0)
 
     query_container.setLayout(query_layout)
 
@@ -75,15 +141,62 @@ class GuiInterface(QtWidgets.QWidget):
     self.annotate_lbl.setStyleSheet("font-size: 16px;")
     annotate_layout.addWidget(self.annotate_lbl, 0, 0)
 
-    self.annotate_ta = QtWidgets.QListWidget()
+    # Rows are painted by the delegate, and only when visible
+    self.annotation_model = AnnotationListModel(self)
+    self.annotate_ta = QtWidgets.QListView()
+    self.annotate_ta.setModel(self.annotation_model)
+    self.annotate_ta.setItemDelegate(AnnotationDelegate(self.annotate_ta))
+    self.annotate_ta.setResizeMode(QtWidgets.QListView.Adjust)
+    self.annotate_ta.setLayoutMode(QtWidgets.QListView.Batched)
+    self.annotate_ta.setWordWrap(True)
+    self.annotate_ta.selectionModel().currentRowChanged.connect(self.onselect_annotation)
     annotate_layout.addWidget(self.annotate_ta,1, 0)
 
+    # Busy indicator shown while a query is being explained and annotated
+    self.progress_bar = QtWidgets.QProgressBar(self)
+    self.progress_bar.setRange(0, 0)
+    self.progress_bar.setTextVisible(False)
+    self.progress_bar.hide()
+    annotate_layout.addWidget(self.progress_bar, 2, 0)
+
+    self.compare_button = QtWidgets.QPushButton('Compare with previous plan', self)
+    self.compare_button.clicked.connect(self.onclick_compare)
+    self.compare_button.setEnabled(False)
+    annotate_layout.addWidget(self.compare_button, 3, 0)
+
     annotate_container.setLayout(annotate_layout)
 
+    # Profiling container
+    profile_container = QtWidgets.QGroupBox()
+    profile_layout = QtWidgets.QGridLayout()
+
+    self.profile_cb = QtWidgets.QCheckBox("Profile stages", self)
+    self.profile_cb.setChecked(profiler.enabled)
+    self.profile_cb.toggled.connect(self.ontoggle_profile)
+    profile_layout.addWidget(self.profile_cb, 0, 0)
+
+    self.profile_reset_button = QtWidgets.QPushButton('Reset', self)
+    self.profile_reset_button.clicked.connect(self.onclick_profile_reset)
+    profile_layout.addWidget(self.profile_reset_button, 0, 1)
+
+    self.profile_export_button = QtWidgets.QPushButton('Export...', self)
+    self.profile_export_button.clicked.connect(self.onclick_profile_export)
+    profile_layout.addWidget(self.profile_export_button, 0, 2)
+
+    self.profile_ta = QtWidgets.QPlainTextEdit(self)
+    self.profile_ta.setReadOnly(True)
+    self.profile_ta.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+    self.profile_ta.setMaximumHeight(150)
+    self.profile_ta.setVisible(profiler.enabled)
+    profile_layout.addWidget(self.profile_ta, 1, 0, 1, 3)
+
+    profile_container.setLayout(profile_layout)
+
     # Calling all containers
     main_container.addWidget(db_container, 0, 0, 1, 2)
     main_container.addWidget(query_container, 1, 0)
     main_container.addWidget(annotate_container, 1, 1)
+    main_container.addWidget(profile_container, 2, 0, 1, 2)
     self.setLayout(main_container)
 
   # Button executable functions
@@ -91,7 +204,20 @@ class GuiInterface(QtWidgets.QWidget):
     database = self.db_tb.text()
     username = self.user_tb.text()
     password = self.pw_tb.text()
-    self.p = Preprocessing(database, username, password)
+    mode = self.source_cb.currentText()
+    plans_dir = self.plans_dir_tb.text()
+    try:
+      if mode == "Replay":
+        self.p = ReplayPlanSource(plans_dir)
+      else:
+        # psycopg2 is only loaded once a live connection is needed
+        from preprocessing import Preprocessing
+        self.p = Preprocessing(database, username, password, history=PlanHistory())
+        if mode == "Record":
+          self.p = RecordingPlanSource(self.p, plans_dir)
+    except Exception as e:
+      logging.error(e)
+      QtWidgets.QMessageBox.critical(self, 'Connection failed', str(e))
     
   def onclick_generate(self):
     if self.generate_button.text() == "Generate":
@@ -104,54 +230,21 @@ class GuiInterface(QtWidgets.QWidget):
 
       # Formats text with query_Nl function
       formatted_queryTxt = self.query_Nl(queryTxt)
-      self.formatted_doc = QtGui.QTextDocument(formatted_queryTxt)
-      self.query_ta.setDocument(self.formatted_doc)
+      self.current_query = formatted_queryTxt
+      self.flush_formatting()
+      self.query_ta.setPlainText(formatted_queryTxt)
       
 
-      #-------------FOR PROD-------------
-      annotation = self.get_annotation(formatted_queryTxt)
-      #-------------------------------------
-      
-      #-------------FOR TESTING-------------
-      # annotation = [
-      #   ('annotation_text_1fasdfasdvcasdca asdfascdsaca dascdsaferacdsac davcaefasdfca dacaesf asdf a dfadsfaw refasdfawr rafa dsf a', {'table':['supplier'],
-      #                         'cond':["supplier.s_acctbal > 100000"]}),
-      #   ('annotation_text_2', {'table':[],
-      #                         'cond':['partsupp.ps_suppkey = supplier.s_suppkey', 'partsupp.ps_availqty > 1000']}),
-      #   ('annotation_text_3', {'table':['partsupp'],
-      #                         'cond':[]})
-      # ]
-      #-------------------------------------
-
-      # Reads annotation list of tuples
-      # Format could be annotation = 
-      # [
-      #   ('annotation_text_1', {'table':['supplier'],
-      #                         'cond':['related_query_1', 'related_query_2']}),
-      #   ('annotation_text_2', {'table':[],
-      #                         'cond':['related_query_3']}),
-      #   ('annotation_text_3', {'table':['partsupp'],
-      #                         'cond':['partsupp.ps_suppkey = supplier.s_suppkey']})
-      # ]
-      self.buttons = QtWidgets.QButtonGroup(self)
-      for (idx, (annotate_button, highlights)) in enumerate(annotation):
-
-        # Populating annotate index
-        self.annotate_index[idx] = highlights
-
-        # Creating buttons then pushing them to QListWidget
-        widget_item = QtWidgets.QListWidgetItem(self.annotate_ta)
-
-        button = QtWidgets.QPushButton(f'{idx+1}. {annotate_button}', self)
-        button.setStyleSheet("text-align: left; padding: 10px; word-break: break-all")
-        
-        
-        self.buttons.addButton(button, idx)
-        widget_item.setSizeHint(button.sizeHint())
-        self.annotate_ta.addItem(widget_item)
-        self.annotate_ta.setItemWidget(widget_item, button)
-
-      self.buttons.idClicked.connect(self.show_highlights)
+      # EXPLAIN and annotate on the thread pool so the window stays responsive.
+      # A newer request supersedes this one, whose result is then dropped.
+      self.request_id += 1
+      worker = AnnotationWorker(self.request_id, self.get_annotation, formatted_queryTxt,
+                                self.analyze_cb.isChecked(), self.misestimate_sb.value(),
+                                self.alternatives_cb.isChecked(), self.generic_cb.isChecked(),
+                                self.parameters_ta.toPlainText())
+      worker.signals.finished.connect(self.populate_annotations)
+      self.progress_bar.show()
+      self.thread_pool.start(worker)
       
     else:
       #  Enables text editor while flushing all formatting
@@ -161,107 +254,264 @@ class GuiInterface(QtWidgets.QWidget):
 
       self.query_ta.setReadOnly(False)
 
-      # Flushes annotate QListWidget
-      self.annotate_ta.clear()
-      
+      # Drops the result of any request still in flight
+      self.request_id += 1
+      self.progress_bar.hide()
+      self.compare_button.setEnabled(False)
 
+      # Keeps the annotations, greyed out, so that generating again only updates the rows that change
+      self.annotate_ta.setCurrentIndex(QtCore.QModelIndex())
+      self.annotate_ta.setEnabled(False)
+
+  @profiler.timed("populate_annotations")
+  def populate_annotations(self, request_id, annotation):
+    if request_id != self.request_id:
+      return
+    self.progress_bar.hide()
+
+    if isinstance(annotation, str):
+      # get_annotation failed and returned an error message
+      annotation = [(annotation, {'table': [], 'cond': []})]
+    else:
+      # Replayed plans are not recorded in the plan history
+      self.compare_button.setEnabled(self.p.history is not None)
+
+    #-------------FOR TESTING-------------
+    # annotation = [
+    #   ('annotation_text_1fasdfasdvcasdca asdfascdsaca dascdsaferacdsac davcaefasdfca dacaesf asdf a dfadsfaw refasdfawr rafa dsf a', {'table':['supplier'],
+    #                         'cond':["supplier.s_acctbal > 100000"]}),
+    #   ('annotation_text_2', {'table':[],
+    #                         'cond':['partsupp.ps_suppkey = supplier.s_suppkey', 'partsupp.ps_availqty > 1000']}),
+    #   ('annotation_text_3', {'table':['partsupp'],
+    #                         'cond':[]})
+    # ]
+    #-------------------------------------
+
+    # Reads annotation list of tuples
+    # Format could be annotation = 
+    # [
+    #   ('annotation_text_1', {'table':['supplier'],
+    #                         'cond':['related_query_1', 'related_query_2']}),
+    #   ('annotation_text_2', {'table':[],
+    #                         'cond':['related_query_3']}),
+    #   ('annotation_text_3', {'table':['partsupp'],
+    #                         'cond':['partsupp.ps_suppkey = supplier.s_suppkey']})
+    # ]
+    self.annotation_model.set_annotations(annotation)
+    self.annotate_ta.setEnabled(True)
+    self.update_profile()
+
+  def onselect_annotation(self, current, previous):
+    if current.isValid():
+      self.show_highlights(current.row())
+
+  def ontoggle_generic(self, checked):
+    # Generic plans are estimated only, and re-planned without enable_* settings
+    self.parameters_ta.setVisible(checked)
+    self.analyze_cb.setEnabled(not checked)
+    self.alternatives_cb.setEnabled(not checked)
+
+  def ontoggle_profile(self, checked):
+    profiler.enabled = checked
+    self.profile_ta.setVisible(checked)
+    self.update_profile()
+
+  def onclick_profile_reset(self):
+    profiler.reset()
+    self.update_profile()
+
+  def onclick_profile_export(self):
+    path, selected_filter = QtWidgets.QFileDialog.getSaveFileName(
+      self, 'Export profile', 'profile.json', 'Summary (*.json);;Chrome trace (*.json)')
+    if not path:
+      return
+    try:
+      profiler.export(path, chrome_trace=selected_filter.startswith('Chrome'))
+    except OSError as e:
+      QtWidgets.QMessageBox.critical(self, 'Export failed', str(e))
+
+  def update_profile(self):
+    if profiler.enabled:
+      self.profile_ta.setPlainText(profiler.format_summary())
+
+  def onclick_compare(self):
+    changes = self.p.history.compare_with_previous(self.current_query)
+    QtWidgets.QMessageBox.information(self, 'Compared with previous plan', '\n\n'.join(changes))
 
   # Helper functions
-  def get_annotation(self, queryTxt):
+  def get_annotation(self, queryTxt, analyze=False, misestimate_factor=10.0, alternatives=False,
+                     generic=False, parameters=''):
       try:
-          parsed_plan = self.p.getQEP(queryTxt)
-          annotation = annotate(parsed_plan)
+          if generic:
+              return self.get_generic_annotation(queryTxt, parameters)
+          parsed_plan = self.p.getQEP(queryTxt, analyze=analyze)
+          alternative_plans = self.p.getAlternativeQEPs(queryTxt, parsed_plan) if alternatives else None
+          context = AnnotationContext(misestimate_factor=misestimate_factor, alternatives=alternative_plans)
+          annotation = annotate(parsed_plan, context, self.annotation_cache)
           return annotation
       except Exception as e:
           logging.error(e)
-          self.p.conn.rollback()
           return 'Invalid query input'
 
 
 
+  def get_generic_annotation(self, queryTxt, parameters):
+      # The differences between the generic and custom plans come first, then the generic plan's annotations
+      parameter_sets = [json.loads(line) for line in parameters.splitlines() if line.strip()]
+      generic_plan, custom_plans = self.p.getGenericQEPs(queryTxt, parameter_sets)
+      report = describe_parameter_plans(generic_plan, custom_plans, parameter_sets)
+      return ([(line, {'table': [], 'cond': []}) for line in report]
+              + annotate(generic_plan, AnnotationContext(), self.annotation_cache))
+
+  @profiler.timed("query_Nl")
   def query_Nl(self, queryTxt):
     """Formats query text by insertting new lines to increase readability.
     New lines are determined with keywords such as {select, where, from, group by, join, ...}
     https://www.w3schools.com/sql/sql_ref_keywords.asp
     https://pypi.org/project/sql-formatter/ 
+    Results are cached per query text, and long queries are formatted by formatting.format_tokens.
     """
-    formatted_query= format_sql(queryTxt)
-    return formatted_query
+    return format_query(queryTxt).text
 
 
+  @profiler.timed("show_highlights")
   def show_highlights(self, idx):
-    # print(f"{idx+1}. {self.annotate_index[idx]}")
-    self.format_involved(self.annotate_index[idx]['table'],
-                        self.annotate_index[idx]['cond'])
-
-    self.highlighter.setDocument(self.query_ta.document())
-    return
-  
-  def format_involved(self, tableList, conList):
-    # set up pattern matching parameters
-    self.highlighter = Highlighter()
+    # Spans only depend on the annotation while the query is read-only, so they are found once
+    if idx not in self.highlight_spans:
+      highlights = self.annotation_model.highlights(idx)
+      self.highlight_spans[idx] = find_highlights(self.query_ta.toPlainText(),
+                                                  highlights['table'],
+                                                  highlights['cond'])
+
+    # Highlights are overlays on the document rather than formatting in it
+    document = self.query_ta.document()
+    selections = []
+    for kind, start, end in self.highlight_spans[idx]:
+      selection = QtWidgets.QTextEdit.ExtraSelection()
+      selection.format = self.highlight_formats[kind]
+      selection.cursor = QtGui.QTextCursor(document)
+      selection.cursor.setPosition(start)
+      selection.cursor.setPosition(end, QtGui.QTextCursor.KeepAnchor)
+      selections.append(selection)
+
+    self.query_ta.setExtraSelections(selections)
 
-    # flush old formatting
-    self.flush_formatting()
-
-    # tableList format
-    tableList_format = QtGui.QTextCharFormat()
-    tableList_format.setForeground(QtCore.Qt.blue)
-    tableList_format.setFontWeight(QtGui.QFont.Bold)
-    if (tableList):
-      processed_tableString = '|'.join(tableList)
-      pattern = r'^.*from.*(?:'+str(processed_tableString)+').*$'
-      self.highlighter.add_mapping(pattern, tableList_format)
+  def flush_formatting(self):
+    self.query_ta.setExtraSelections([])
+    self.highlight_spans = {}
 
 
-    # conList format
-    conList_format = QtGui.QTextCharFormat()
-    conList_format.setForeground(QtCore.Qt.red)
-    conList_format.setFontItalic(True)
-    if (conList):
-      filtered_conList = self.filter_conList(conList)
-      processed_conString = '|'.join(filtered_conList)
-      pattern = r'(?:'+str(processed_conString)+')'
-      self.highlighter.add_mapping(pattern, conList_format)
-
-  def filter_conList(self, conList):
-    filtered_conList = []
-
-    for conditions in conList:
-      conItems = conditions.split()
-      if conItems[0].rfind('.'):
-        conItems[0] = conItems[0][conItems[0].rfind('.')+1:]
-        print(conItems[0])
-      
-      if conItems[2].rfind('.'):
-        conItems[2] = conItems[2][conItems[2].rfind('.')+1:]
-        print(conItems[2])
+class AnnotationListModel(QtCore.QAbstractListModel):
+  """Annotation tuples as rows; the row's text is its display role and its
+  highlights dict ({'table': [...], 'cond': [...]}) its user role."""
 
-      perm1_conItem = '.*?'.join(conItems)
-      perm2_conItem = '.*?'.join(reversed(conItems))
-      filtered_conList.append(perm1_conItem)
-      filtered_conList.append(perm2_conItem)
+  def __init__(self, parent = None):
+    super().__init__(parent)
+    self.annotations = []
+
+  def rowCount(self, parent = QtCore.QModelIndex()):
+    return 0 if parent.isValid() else len(self.annotations)
+
+  def data(self, index, role = QtCore.Qt.DisplayRole):
+    if not index.isValid():
+      return None
+    annotation_text, highlights = self.annotations[index.row()]
+    if role == QtCore.Qt.DisplayRole:
+      return f'{index.row()+1}. {annotation_text.strip()}'
+    if role == QtCore.Qt.UserRole:
+      return highlights
+    return None
+
+  def highlights(self, row):
+    return self.annotations[row][1]
+
+  def set_annotations(self, annotations):
+    """Replaces the rows with annotations, only removing, inserting and updating
+    the rows that differ, so the view keeps the layout of the unchanged ones."""
+    annotations = list(annotations)
+    matcher = difflib.SequenceMatcher(None, [self.row_key(row) for row in self.annotations],
+                                      [self.row_key(row) for row in annotations], autojunk=False)
+    first_moved = None
+
+    # Applied from the end, so the rows before each change keep their positions
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+      if tag == 'equal':
+        continue
+      replaced = min(i2 - i1, j2 - j1)
+      if replaced:
+        self.annotations[i1:i1 + replaced] = annotations[j1:j1 + replaced]
+        self.dataChanged.emit(self.index(i1), self.index(i1 + replaced - 1))
+      if i2 - i1 > replaced:
+        self.beginRemoveRows(QtCore.QModelIndex(), i1 + replaced, i2 - 1)
+        del self.annotations[i1 + replaced:i2]
+        self.endRemoveRows()
+        first_moved = i1
+      elif j2 - j1 > replaced:
+        self.beginInsertRows(QtCore.QModelIndex(), i1 + replaced, i1 + j2 - j1 - 1)
+        self.annotations[i1 + replaced:i1 + replaced] = annotations[j1 + replaced:j2]
+        self.endInsertRows()
+        first_moved = i1
+
+    # Rows after an insertion or removal are numbered differently
+    if first_moved is not None and first_moved < len(self.annotations):
+      self.dataChanged.emit(self.index(first_moved), self.index(len(self.annotations) - 1))
+
+  @staticmethod
+  def row_key(annotation):
+    annotation_text, highlights = annotation
+    return annotation_text, tuple(highlights['table']), tuple(highlights['cond'])
+
+  def clear(self):
+    self.set_annotations([])
+
+
+class AnnotationDelegate(QtWidgets.QStyledItemDelegate):
+  """Paints each annotation as word-wrapped text on a button-like panel."""
+
+  PADDING = 10
+  FLAGS = QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter | QtCore.Qt.TextWordWrap
+
+  def paint(self, painter, option, index):
+    self.initStyleOption(option, index)
+    style = option.widget.style() if option.widget else QtWidgets.QApplication.style()
+
+    # Background and selection, without the default text
+    text = option.text
+    option.text = ''
+    style.drawControl(QtWidgets.QStyle.CE_ItemViewItem, option, painter, option.widget)
+
+    painter.save()
+    if option.state & QtWidgets.QStyle.State_Selected:
+      painter.setPen(option.palette.highlightedText().color())
+    else:
+      painter.setPen(option.palette.text().color())
+    text_rect = option.rect.adjusted(self.PADDING, self.PADDING, -self.PADDING, -self.PADDING)
+    painter.drawText(text_rect, self.FLAGS, text)
+    painter.drawLine(option.rect.bottomLeft(), option.rect.bottomRight())
+    painter.restore()
 
-    return filtered_conList
+  def sizeHint(self, option, index):
+    text = index.data(QtCore.Qt.DisplayRole)
+    # Rows take the full width of the list, which re-lays them out when resized
+    width = self.parent().viewport().width()
+    bounds = QtCore.QRect(0, 0, max(width - 2 * self.PADDING, 1), 0)
+    height = option.fontMetrics.boundingRect(bounds, self.FLAGS, text).height()
+    return QtCore.QSize(width, height + 2 * self.PADDING)
 
-  def flush_formatting(self):
-    queryTxt = self.query_ta.toPlainText()
-    queryDoc = QtGui.QTextDocument(queryTxt)
-    self.query_ta.setDocument(queryDoc)
-    return
 
+class AnnotationSignals(QtCore.QObject):
+  finished = QtCore.Signal(int, object)
 
-class Highlighter(QtGui.QSyntaxHighlighter):
-  
-  def __init__(self, parent = None):
-    super().__init__(parent)
-    self.mapping = {}
 
-  def add_mapping(self, pattern, pattern_format):
-    self.mapping[pattern] = pattern_format
+class AnnotationWorker(QtCore.QRunnable):
 
-  def highlightBlock(self, text_block):
-    for pattern, fmt in self.mapping.items():
-      for match in re.finditer(pattern, text_block, re.IGNORECASE):
-        start, end = match.span()
-        self.setFormat(start, end-start, fmt)
\ No newline at end of file
+  def __init__(self, request_id, get_annotation, *args):
+    super().__init__()
+    self.request_id = request_id
+    self.get_annotation = get_annotation
+    self.args = args
+    self.signals = AnnotationSignals()
+
+  def run(self):
+    annotation = self.get_annotation(*self.args)
+    self.signals.finished.emit(self.request_id, annotation)
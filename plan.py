@@ -0,0 +1,266 @@
+import hashlib
+import json
+from itertools import chain
+from operator import attrgetter
+
+from expression import normalize_condition
+
+
+# Maps the EXPLAIN (FORMAT JSON) keys with fields of their own to those fields.
+# Every other key of a plan node is kept as-is in PlanNode.properties.
+FIELD_KEYS = {
+    "Node Type": "node_type",
+    "Parent Relationship": "parent_relationship",
+    "Relation Name": "relation_name",
+    "Alias": "alias",
+    "Index Name": "index_name",
+    "CTE Name": "cte_name",
+    "Strategy": "strategy",
+    "Join Type": "join_type",
+    "Startup Cost": "startup_cost",
+    "Total Cost": "total_cost",
+    "Plan Rows": "plan_rows",
+    "Plan Width": "plan_width",
+    "Filter": "filter",
+    "Join Filter": "join_filter",
+    "Index Cond": "index_cond",
+    "Recheck Cond": "recheck_cond",
+    "Hash Cond": "hash_cond",
+    "Merge Cond": "merge_cond",
+    "Group Key": "group_key",
+    "Sort Key": "sort_key",
+    "Presorted Key": "presorted_key",
+    "Cache Key": "cache_key",
+    "One-Time Filter": "one_time_filter",
+    "Subplan Name": "subplan_name",
+    "Parallel Aware": "parallel_aware",
+    "Workers Planned": "workers_planned",
+    # Only present with EXPLAIN ANALYZE
+    "Actual Startup Time": "actual_startup_time",
+    "Actual Total Time": "actual_total_time",
+    "Actual Rows": "actual_rows",
+    "Actual Loops": "actual_loops",
+    "Workers Launched": "workers_launched",
+}
+
+FLOAT_FIELDS = ("startup_cost", "total_cost", "plan_rows",
+                "actual_startup_time", "actual_total_time", "actual_rows", "actual_loops")
+
+TUPLE_FIELDS = ("group_key", "sort_key", "presorted_key")
+
+FIELD_SLOTS = tuple(FIELD_KEYS.values())
+
+get_fields = attrgetter(*FIELD_SLOTS)
+
+# What a node does and to which relation, without its costs, row counts or conditions
+SHAPE_FIELDS = ("node_type", "parent_relationship", "relation_name", "alias", "index_name", "join_type",
+                "strategy")
+
+get_shape_fields = attrgetter(*SHAPE_FIELDS)
+
+# Conditions and keys that a fingerprint includes, with their literals stripped
+CONDITION_FIELDS = ("filter", "join_filter", "index_cond", "recheck_cond", "hash_cond", "merge_cond",
+                    "one_time_filter", "cache_key", "subplan_name")
+
+get_condition_fields = attrgetter(*CONDITION_FIELDS)
+
+get_key_fields = attrgetter(*TUPLE_FIELDS)
+
+# Nodes whose subtree is run by several processes at once
+GATHER_NODE_TYPES = ("Gather", "Gather Merge")
+
+
+class PlanNode:
+    """One node of a query execution plan.
+
+    Text fields are str or None when absent from the plan, costs and row counts
+    are floats, plan_width and the worker counts are ints, parallel_aware is a
+    bool, and group_key, sort_key, presorted_key and children are tuples. The
+    actual_* fields and workers_launched are only set for plans from EXPLAIN
+    ANALYZE; as in EXPLAIN, the actual_* fields are averages per loop.
+    table_names holds the aliases (or relation names) of every relation scanned
+    in this node's subtree, computed once when the plan is loaded.
+    parallel_processes is the number of processes running a node below a
+    Gather at the same time, and None elsewhere."""
+
+    __slots__ = FIELD_SLOTS + ("children", "table_names", "properties", "parallel_processes", "_subtree_hash")
+
+    def __init__(self, fields, children=()):
+        for key, field in FIELD_KEYS.items():
+            value = fields.pop(key, None)
+            if value is not None:
+                if field in FLOAT_FIELDS:
+                    value = float(value)
+                elif field in TUPLE_FIELDS:
+                    value = tuple(value)
+            setattr(self, field, value)
+
+        self.children = tuple(children)
+        self.properties = fields
+        self.parallel_processes = None
+        self._subtree_hash = None
+
+        if self.node_type in GATHER_NODE_TYPES:
+            # The workers, and the leader too unless it only gathers their rows
+            processes = self.workers_launched if self.workers_launched is not None else self.workers_planned or 0
+            if not self.properties.get("Single Copy"):
+                processes += 1
+            for child in self.children:
+                for node in child.walk():
+                    node.parallel_processes = max(processes, 1)
+
+        # Scans with children of their own, such as a Bitmap Heap Scan, name their relation too
+        own_name = self.alias or self.relation_name
+        own_names = (own_name,) if own_name is not None else ()
+        if self.children:
+            self.table_names = own_names + tuple(chain.from_iterable(child.table_names for child in self.children))
+        else:
+            self.table_names = own_names
+
+    def __repr__(self):
+        return f"PlanNode({self.node_type!r}, children={len(self.children)})"
+
+    @property
+    def is_analyzed(self):
+        return self.actual_loops is not None
+
+    @property
+    def inclusive_time(self):
+        """Milliseconds spent in this node and its subtree, over all loops.
+        Below a Gather, the loops of the processes running at the same time
+        count once, as the time each process spent on average."""
+        if self.parallel_processes is None:
+            return self.actual_total_time * self.actual_loops
+        return self.actual_total_time * self.actual_loops / max(min(self.parallel_processes, self.actual_loops), 1.0)
+
+    @property
+    def exclusive_time(self):
+        """Milliseconds spent in this node itself, over all loops. Negative if
+        the children report more time than the node, which callers show as such."""
+        children_time = sum(child.inclusive_time for child in self.children if child.is_analyzed)
+        return self.inclusive_time - children_time
+
+    def get(self, key, default=None):
+        """Looks a node up by its EXPLAIN key, whether it has a field or not."""
+        field = FIELD_KEYS.get(key)
+        if field is None:
+            return self.properties.get(key, default)
+        value = getattr(self, field)
+        return default if value is None else value
+
+    @property
+    def subtree_hash(self):
+        """Hash of every field and property of the nodes in the subtree, so equal
+        subtrees of different plans hash alike. Computed on first use; like hash(),
+        it is only comparable within one process."""
+        if self._subtree_hash is None:
+            # Reversed, the walk reaches every child before its parent
+            for node in reversed(list(self.walk())):
+                if node._subtree_hash is not None:
+                    continue
+                children = tuple(child._subtree_hash for child in node.children)
+                try:
+                    node._subtree_hash = hash((get_fields(node), tuple(node.properties.items()), children))
+                except TypeError:
+                    # Properties holding lists or objects, such as Output or Workers, are hashed by their repr
+                    node._subtree_hash = hash((get_fields(node), repr(node.properties), children))
+        return self._subtree_hash
+
+    def shape(self):
+        """The SHAPE_FIELDS of every node of the subtree, nested as the nodes are.
+        Plans that only differ in their estimates or conditions have equal shapes."""
+        shapes = {}
+        # Reversed, the walk reaches every child before its parent
+        for node in reversed(list(self.walk())):
+            shapes[node] = (get_shape_fields(node), tuple(shapes.pop(child) for child in node.children))
+        return shapes[self]
+
+    def shape_fingerprint(self):
+        """Hex digest of the shape of the subtree and of its conditions and keys,
+        with literals stripped (see normalize_condition), so the plans of queries
+        that only differ in their constants share a fingerprint. Unlike
+        subtree_hash, it is the same in every process and run."""
+        digests = {}
+        # Reversed, the walk reaches every child before its parent
+        for node in reversed(list(self.walk())):
+            conditions = tuple(None if condition is None else normalize_condition(condition)
+                               for condition in get_condition_fields(node))
+            keys = tuple(None if key is None else tuple(map(normalize_condition, key))
+                         for key in get_key_fields(node))
+            children = tuple(digests.pop(child) for child in node.children)
+            text = repr((get_shape_fields(node), conditions, keys, children))
+            digests[node] = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return digests[self][:16]
+
+    def walk(self):
+        """Yields every node of the subtree, parents before their children."""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    ##############################################################################################
+    ################################Loading and saving############################################
+    ##############################################################################################
+
+    @classmethod
+    def from_json(cls, text):
+        """Loads the plan from the text of an EXPLAIN (FORMAT JSON) result.
+
+        The nodes are built while the JSON is decoded, children first, so the
+        decoded dicts never have to be walked again."""
+        def object_hook(fields):
+            if "Node Type" in fields:
+                return cls(fields, fields.pop("Plans", ()))
+            return fields
+
+        explain = json.loads(text, object_hook=object_hook)
+        return explain[0]["Plan"]
+
+    @classmethod
+    def from_dict(cls, plan):
+        """Builds the plan from already decoded EXPLAIN JSON (the "Plan" object)."""
+        # Each entry is (plan dict, whether its children have been built)
+        stack = [(plan, False)]
+        built = []
+        while stack:
+            plan, children_done = stack.pop()
+            children = plan.get("Plans", ())
+            if not children_done:
+                stack.append((plan, True))
+                stack.extend((child, False) for child in reversed(children))
+                continue
+
+            fields = dict(plan)
+            fields.pop("Plans", None)
+            node_children = built[len(built) - len(children):] if children else ()
+            del built[len(built) - len(children):]
+            built.append(cls(fields, node_children))
+
+        return built[0]
+
+    def to_dict(self):
+        """Converts the plan back to the EXPLAIN JSON layout."""
+        # Each entry is (node, whether its children have been converted)
+        stack = [(self, False)]
+        converted = []
+        while stack:
+            node, children_done = stack.pop()
+            if not children_done:
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(node.children))
+                continue
+
+            plan = {}
+            for key, field in FIELD_KEYS.items():
+                value = getattr(node, field)
+                if value is not None:
+                    plan[key] = list(value) if field in TUPLE_FIELDS else value
+            plan.update(node.properties)
+            if node.children:
+                plan["Plans"] = converted[len(converted) - len(node.children):]
+                del converted[len(converted) - len(node.children):]
+            converted.append(plan)
+
+        return converted[0]
@@ -0,0 +1,72 @@
+import json
+
+
+class ShapeEntry:
+    """The queries sharing one plan shape, and the annotation of the first of them."""
+
+    __slots__ = ("fingerprint", "origin", "query", "annotation", "origins", "total_cost")
+
+    def __init__(self, fingerprint, origin, query, annotation):
+        self.fingerprint = fingerprint
+        # Where the first query of the shape comes from, as given to PlanIndex.add
+        self.origin = origin
+        self.query = query
+        self.annotation = annotation
+        self.origins = []
+        # Estimated cost of the shape's plans, summed over its queries
+        self.total_cost = 0.0
+
+    @property
+    def count(self):
+        return len(self.origins)
+
+    def to_dict(self):
+        return {"fingerprint": self.fingerprint, "query": self.query, "count": self.count,
+                "total_cost": self.total_cost, "origins": self.origins, "annotation": self.annotation}
+
+
+class PlanIndex:
+    """Index from plan shape fingerprints (see PlanNode.shape_fingerprint) to the
+    queries with that shape. Queries that only differ in their constants share a
+    shape, so a workload of thousands of queries has a few dozen entries."""
+
+    def __init__(self):
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, fingerprint):
+        return self.entries.get(fingerprint)
+
+    def add(self, fingerprint, origin, query, total_cost, annotation=None):
+        """Indexes one query and returns the entry of its shape. The first query
+        added with a fingerprint stands for the shape, with its annotation."""
+        entry = self.entries.get(fingerprint)
+        if entry is None:
+            entry = self.entries[fingerprint] = ShapeEntry(fingerprint, origin, query, annotation)
+        entry.origins.append(origin)
+        entry.total_cost += total_cost or 0.0
+        return entry
+
+    def top(self, count):
+        # Costliest first, as the shapes worth tuning are those the workload spends the most on
+        return sorted(self.entries.values(), key=lambda entry: entry.total_cost, reverse=True)[:count]
+
+    def to_dict(self):
+        return {"shapes": [entry.to_dict() for entry in self.top(len(self.entries))]}
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def format_report(self, top=10):
+        queries = sum(entry.count for entry in self.entries.values())
+        lines = [f"{queries} quer{'y' if queries == 1 else 'ies'} in {len(self.entries)} plan shape(s).",
+                 "", f"{'fingerprint':<20}{'queries':>10}{'cumulative cost':>18}  first query"]
+        for entry in self.top(top):
+            query = " ".join(entry.query.split())
+            if len(query) > 60:
+                query = query[:57] + "..."
+            lines.append(f"{entry.fingerprint:<20}{entry.count:>10}{entry.total_cost:>18.2f}  {query}")
+        return "\n".join(lines)
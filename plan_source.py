@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+
+from plan import PlanNode
+from qep_cache import query_fingerprint
+
+
+class PlanSource:
+    """Where query plans come from.
+
+    Preprocessing is the live implementation, backed by PostgreSQL. The others
+    record the plans of another source to a folder, or replay recorded plans
+    without a database."""
+
+    # PlanHistory the plans are recorded in, if any
+    history = None
+
+    def getQEP(self, query, analyze=False):
+        raise NotImplementedError
+
+    def getAlternativeQEPs(self, query, qep):
+        """Maps planner settings to the plan chosen with that setting off."""
+        raise NotImplementedError
+
+    def getGenericQEPs(self, query, parameter_sets=()):
+        """Returns the generic plan of query, whose parameters are written $1, $2, ...,
+        and the list of the custom plans chosen for each of parameter_sets."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+##################################################################################################
+################################Recorded plans####################################################
+##################################################################################################
+
+# A recorded plan is saved as {"query": ..., "explain": [{"Plan": ...}]}, the layout of the
+# benchmark fixtures, in <folder>/<query fingerprint>[.<variant>].json, where the variant is
+# "analyze" for EXPLAIN ANALYZE plans, the planner setting turned off for alternative plans,
+# "generic" for generic plans or "custom.<hash of the parameters>" for custom plans.
+
+
+def custom_plan_variant(parameters):
+    text = json.dumps(list(parameters), default=str)
+    return "custom." + hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def recording_path(folder, query, variant=None):
+    name = query_fingerprint(query)
+    if variant:
+        name += "." + variant
+    return os.path.join(folder, name + ".json")
+
+
+class RecordingPlanSource(PlanSource):
+    """Passes plans through from another source, saving each one to folder."""
+
+    def __init__(self, source, folder):
+        self.source = source
+        self.folder = folder
+        self.history = source.history
+        os.makedirs(folder, exist_ok=True)
+
+    def getQEP(self, query, analyze=False):
+        qep = self.source.getQEP(query, analyze=analyze)
+        self.save(query, qep, "analyze" if analyze else None)
+        return qep
+
+    def getAlternativeQEPs(self, query, qep):
+        alternatives = self.source.getAlternativeQEPs(query, qep)
+        for setting, alternative_qep in alternatives.items():
+            self.save(query, alternative_qep, setting)
+        return alternatives
+
+    def getGenericQEPs(self, query, parameter_sets=()):
+        generic, custom_plans = self.source.getGenericQEPs(query, parameter_sets)
+        self.save(query, generic, "generic")
+        for parameters, custom_plan in zip(parameter_sets, custom_plans):
+            self.save(query, custom_plan, custom_plan_variant(parameters))
+        return generic, custom_plans
+
+    def save(self, query, qep, variant=None):
+        path = recording_path(self.folder, query, variant)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"query": query, "explain": [{"Plan": qep.to_dict()}]}, f)
+        os.replace(temp_path, path)
+
+    def close(self):
+        self.source.close()
+
+
+class ReplayPlanSource(PlanSource):
+    """Serves the plans saved by RecordingPlanSource, without a database."""
+
+    def __init__(self, folder):
+        if not os.path.isdir(folder):
+            raise FileNotFoundError(f"No recorded plans folder: {folder}")
+        self.folder = folder
+
+    def getQEP(self, query, analyze=False):
+        return self.load(query, "analyze" if analyze else None)
+
+    def getAlternativeQEPs(self, query, qep):
+        # Only the alternatives that were recorded are served
+        alternatives = {}
+        prefix = query_fingerprint(query) + ".enable_"
+        for file_name in os.listdir(self.folder):
+            if file_name.startswith(prefix) and file_name.endswith(".json"):
+                setting = file_name[len(prefix) - len("enable_"):-len(".json")]
+                alternatives[setting] = self.load(query, setting)
+        return alternatives
+
+    def getGenericQEPs(self, query, parameter_sets=()):
+        return (self.load(query, "generic"),
+                [self.load(query, custom_plan_variant(parameters)) for parameters in parameter_sets])
+
+    def load(self, query, variant=None):
+        path = recording_path(self.folder, query, variant)
+        try:
+            with open(path, encoding="utf-8") as f:
+                recorded = json.load(f)
+        except FileNotFoundError:
+            raise LookupError(f"No recorded plan for this query in {self.folder}") from None
+
+        return PlanNode.from_dict(recorded["explain"][0]["Plan"])
@@ -0,0 +1,63 @@
+import json
+
+from formatting import sql_tokens
+from history import compare_operators, get_node_types
+
+
+# Executions of a prepared statement that get custom plans before plan_cache_mode = auto
+# starts weighing the generic plan against them
+CUSTOM_PLAN_EXECUTIONS = 5
+
+
+def parameter_count(query):
+    """Returns the highest $n placeholder of query outside of literals and comments, or 0."""
+    count = 0
+    for kind, text in sql_tokens(query):
+        if kind == "param":
+            count = max(count, int(text[1:]))
+    return count
+
+
+def format_parameters(parameters):
+    return ", ".join(f"${number} = {json.dumps(value, default=str)}"
+                     for number, value in enumerate(parameters, start=1))
+
+
+def describe_parameter_plans(generic, custom_plans, parameter_sets):
+    """Groups parameter_sets by the shape (see PlanNode.shape) of their custom
+    plans, and describes how the plan of each group differs from the generic plan."""
+    lines = [f"The generic plan, which every execution of the prepared statement gets once the plan "
+             f"cache settles on it, costs {generic.total_cost:.2f}."]
+    if not custom_plans:
+        return lines
+
+    # Maps each plan shape to (its first custom plan, the parameter sets getting it)
+    groups = {}
+    for custom_plan, parameters in zip(custom_plans, parameter_sets):
+        groups.setdefault(custom_plan.shape(), (custom_plan, []))[1].append(parameters)
+
+    generic_shape = generic.shape()
+    generic_node_types = get_node_types(generic)
+    if len(groups) > 1:
+        lines.append(f"The {len(parameter_sets)} parameter sets get {len(groups)} differently shaped plans.")
+
+    for shape, (custom_plan, group) in groups.items():
+        values = "; ".join(f"({format_parameters(parameters)})" for parameters in group)
+        if shape == generic_shape:
+            lines.append(f"With {values}, the custom plan has the shape of the generic plan.")
+            continue
+
+        changes = compare_operators(generic_node_types, get_node_types(custom_plan),
+                                    list(generic.table_names), list(custom_plan.table_names))
+        if not changes:
+            changes = ["Its other operators differ."]
+        lines.append(f"With {values}, the custom plan differs from the generic plan. {' '.join(changes)}")
+
+    average_cost = sum(custom_plan.total_cost for custom_plan in custom_plans) / len(custom_plans)
+    if generic.total_cost <= average_cost:
+        outcome = "likely switches to the generic plan"
+    else:
+        outcome = "likely keeps getting custom plans"
+    lines.append(f"The custom plans cost {average_cost:.2f} on average, so under plan_cache_mode = auto, after "
+                 f"the first {CUSTOM_PLAN_EXECUTIONS} executions the prepared statement {outcome}.")
+    return lines
@@ -1,22 +1,277 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Lock
+
 import psycopg2
 from psycopg2 import sql
 from configparser import ConfigParser
 
-class Preprocessing:
-    def __init__(self, database, user, password):
-        self.conn = None
+from annotation import PLANNER_SETTINGS, get_planner_settings, get_relation_names
+from plan import PlanNode
+from plan_source import PlanSource
+from profiling import profiler
+from qep_cache import QEPCache, make_cache_key
+
+
+STATISTICS_QUERY = """
+    SELECT relname, greatest(last_analyze, last_autoanalyze)
+    FROM pg_stat_user_tables
+    WHERE relname = ANY(%s)
+"""
+
+# getGenericQEPs prepares the query under this name, and deallocates it before the connection is reused
+PREPARED_STATEMENT = "qep_prepared"
+
+PARAMETER_COUNT_QUERY = "SELECT cardinality(parameter_types) FROM pg_prepared_statements WHERE name = %s"
+
+# plan_cache_mode, which getGenericQEPs relies on, is new in PostgreSQL 12
+PLAN_CACHE_MODE_VERSION = 120000
+
+# json columns are fetched as text, so that plans are decoded once, straight into PlanNodes
+JSON_TEXT = psycopg2.extensions.new_type((114,), "JSON_TEXT", lambda value, cur: value)
+
+# Errors after which a connection is assumed to be broken rather than the statement invalid
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+class ConnectionPool:
+    """Bounded pool of connections that can be shared between threads.
+
+    Callers block while all max_connections are checked out. A connection that
+    has been idle for longer than health_check_interval seconds is pinged
+    before being handed out, and replaced if it no longer works."""
+
+    def __init__(self, max_connections=4, health_check_interval=30.0, **connect_kwargs):
+        self.connect_kwargs = connect_kwargs
+        self.health_check_interval = health_check_interval
+        self.slots = BoundedSemaphore(max_connections)
+        self.lock = Lock()
+        # Idle connections with the time they were last returned to the pool
+        self.idle = deque()
+
+    @contextmanager
+    def connection(self):
+        self.slots.acquire()
+        try:
+            conn = self.checkout()
+            try:
+                yield conn
+            except Exception:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                self.checkin(conn)
+        finally:
+            self.slots.release()
+
+    def checkout(self):
+        with self.lock:
+            idle = self.idle.popleft() if self.idle else None
+
+        if idle is not None:
+            conn, last_used = idle
+            if time.monotonic() - last_used < self.health_check_interval or self.is_healthy(conn):
+                return conn
+            self.discard(conn)
+
+        return psycopg2.connect(**self.connect_kwargs)
+
+    def checkin(self, conn):
+        if conn.closed:
+            return
+        with self.lock:
+            self.idle.append((conn, time.monotonic()))
+
+    def is_healthy(self, conn):
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except CONNECTION_ERRORS:
+            return False
+
+    def discard(self, conn):
         try:
-            print('Connecting to PostgreSQL ....')
-            self.conn = psycopg2.connect(dbname= database, user= user, password= password)
-            print('Connected.')
-            self.cur = self.conn.cursor()
-
-        except(Exception, psycopg2.DatabaseError) as error:
-            print(error)
-
-    def getQEP(self,query):
-        self.cur.execute("Explain (Format json) {}".format(query))
-        self.qep = self.cur.fetchall()
-        self.qep = self.qep[0][0][0]['Plan']
-        print(self.qep)
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def closeall(self):
+        with self.lock:
+            while self.idle:
+                self.discard(self.idle.popleft()[0])
+
+
+class Preprocessing(PlanSource):
+    """Live plan source, explaining queries on a PostgreSQL server."""
+
+    def __init__(self, database, user, password, cache_dir=None, statistics_ttl=5.0,
+                 max_connections=len(set(PLANNER_SETTINGS.values())) + 1, history=None):
+        self.database = database
+        self.cache = QEPCache(cache_dir=cache_dir)
+
+        # PlanHistory that every plan returned by getQEP is recorded in, if any
+        self.history = history
+
+        # Analyze times are re-probed at most once per statistics_ttl seconds,
+        # so repeated cache hits do not need a round-trip to the server
+        self.statistics_ttl = statistics_ttl
+        self.statistics = {}
+
+        # Connecting eagerly surfaces bad credentials to the caller straight away
+        print('Connecting to PostgreSQL ....')
+        self.pool = ConnectionPool(max_connections, dbname= database, user= user, password= password)
+        with self.pool.connection() as conn:
+            self.server_version = conn.server_version
+        print('Connected.')
+
+    @profiler.timed("execute")
+    def execute(self, statement, params=None, settings=None):
+        """Runs statement on a pooled connection and returns all rows. If the
+        connection turns out to be broken, it is retried once on a new one;
+        errors that leave the connection open, such as a cancelled statement,
+        are raised straight away.
+
+        settings maps configuration parameters to values that apply to this
+        statement only, like SET LOCAL, as the transaction is rolled back."""
+        for attempt in range(2):
+            conn = None
+            try:
+                with self.pool.connection() as conn:
+                    with conn.cursor() as cur:
+                        psycopg2.extensions.register_type(JSON_TEXT, cur)
+                        for name, value in (settings or {}).items():
+                            cur.execute("SELECT set_config(%s, %s, true)", (name, value))
+                        cur.execute(statement, params)
+                        rows = cur.fetchall()
+                    conn.rollback()
+                    return rows
+            except CONNECTION_ERRORS:
+                # OperationalError also covers statement timeouts and cancellations, which
+                # would fail again; conn is None if no connection could be opened at all
+                if attempt or (conn is not None and not conn.closed):
+                    raise
+                print('Connection lost, reconnecting ....')
+
+    def close(self):
+        self.pool.closeall()
+
+    @profiler.timed("getQEP")
+    def getQEP(self,query, analyze=False):
+        if analyze:
+            self.qep = self.getAnalyzedQEP(query)
+        else:
+            self.qep = self.getEstimatedQEP(query)
+
+        if self.history is not None:
+            self.history.record(query, self.qep)
         return self.qep
+
+    def getEstimatedQEP(self, query):
+        key = make_cache_key(query, self.database, self.server_version)
+        entry = self.cache.get(key)
+        if entry is not None:
+            if self.getStatistics(entry.statistics) == entry.statistics:
+                profiler.count("qep_cache.hit")
+                return entry.plan
+            self.cache.discard(key)
+        profiler.count("qep_cache.miss")
+
+        qep = self.execute("Explain (Format json) {}".format(query))
+        qep = PlanNode.from_json(qep[0][0])
+
+        statistics = self.getStatistics(get_relation_names(qep))
+        self.cache.put(key, qep, statistics)
+        return qep
+
+    def getAnalyzedQEP(self, query):
+        """Runs the query under EXPLAIN ANALYZE, with VERBOSE for the rows of each
+        parallel worker. Like every statement sent through execute, it runs in a
+        transaction that is rolled back, so data modifying queries leave no trace.
+        These plans are never cached."""
+        qep = self.execute("Explain (Analyze, Verbose, Format json) {}".format(query))
+        qep = PlanNode.from_json(qep[0][0])
+        return qep
+
+    @profiler.timed("getAlternativeQEPs")
+    def getAlternativeQEPs(self, query, qep):
+        """Re-plans the query with each planner setting relevant to qep turned
+        off, concurrently on pooled connections. Returns a dict mapping each
+        setting to the plan chosen without it."""
+        settings = get_planner_settings(qep)
+        if not settings:
+            return {}
+
+        def explain_without(setting):
+            rows = self.execute("Explain (Format json) {}".format(query), settings={setting: "off"})
+            return PlanNode.from_json(rows[0][0])
+
+        with ThreadPoolExecutor(max_workers=len(settings)) as executor:
+            return dict(zip(settings, executor.map(explain_without, settings)))
+
+    @profiler.timed("getGenericQEPs")
+    def getGenericQEPs(self, query, parameter_sets=()):
+        """PREPAREs query once and EXPLAINs EXECUTE of it on the same connection:
+        under plan_cache_mode = force_generic_plan for the generic plan, which
+        prepared statements settle on when it is not costlier than planning each
+        execution, and under force_custom_plan for each of parameter_sets.
+        Returns the generic plan and the list of custom plans."""
+        if self.server_version < PLAN_CACHE_MODE_VERSION:
+            raise ValueError("Generic plans need plan_cache_mode, which is new in PostgreSQL 12")
+
+        with self.pool.connection() as conn:
+            try:
+                with conn.cursor() as cur:
+                    psycopg2.extensions.register_type(JSON_TEXT, cur)
+                    cur.execute(f"PREPARE {PREPARED_STATEMENT} AS {query}")
+                    cur.execute(PARAMETER_COUNT_QUERY, (PREPARED_STATEMENT,))
+                    count = cur.fetchone()[0] or 0
+                    explain = f"Explain (Format json) EXECUTE {PREPARED_STATEMENT}"
+                    if count:
+                        explain += "({})".format(", ".join(["%s"] * count))
+
+                    # The generic plan does not depend on the values, so NULLs will do
+                    cur.execute("SELECT set_config('plan_cache_mode', 'force_generic_plan', true)")
+                    cur.execute(explain, [None] * count)
+                    generic = PlanNode.from_json(cur.fetchone()[0])
+
+                    cur.execute("SELECT set_config('plan_cache_mode', 'force_custom_plan', true)")
+                    custom_plans = []
+                    for parameters in parameter_sets:
+                        if len(parameters) != count:
+                            raise ValueError(f"The query takes {count} parameter(s), not {len(parameters)}: {parameters!r}")
+                        cur.execute(explain, list(parameters))
+                        custom_plans.append(PlanNode.from_json(cur.fetchone()[0]))
+            finally:
+                # Prepared statements outlive transactions, and the connection goes back to the pool
+                if not conn.closed:
+                    conn.rollback()
+                    with conn.cursor() as cur:
+                        cur.execute("DEALLOCATE ALL")
+                    conn.commit()
+
+        if self.history is not None:
+            self.history.record(query, generic)
+        return generic, custom_plans
+
+    def getStatistics(self, relations):
+        """Returns the last analyze time of each relation, probing the server
+        in one batch for those not checked within the last statistics_ttl seconds."""
+        now = time.monotonic()
+        stale = [relation for relation in relations
+                 if now - self.statistics.get(relation, (float("-inf"), None))[0] > self.statistics_ttl]
+
+        if stale:
+            analyzed = {relation: analyze_time
+                        for relation, analyze_time in self.execute(STATISTICS_QUERY, (stale,))}
+            for relation in stale:
+                analyze_time = analyzed.get(relation)
+                self.statistics[relation] = (now, analyze_time.isoformat() if analyze_time else None)
+
+        return {relation: self.statistics[relation][1] for relation in relations}
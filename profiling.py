@@ -0,0 +1,124 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+
+
+# Spans kept for export; older ones are dropped, the per-name totals are not
+MAX_EVENTS = 100000
+
+
+class Profiler:
+    """Timers and counters around the stages of generating an annotation.
+
+    Every span is kept (up to MAX_EVENTS) for export as a Chrome trace, which
+    chrome://tracing and Perfetto open, and summed per name for the status panel."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = Lock()
+        self.origin = time.perf_counter()
+        self.events = deque(maxlen=MAX_EVENTS)
+        # name -> [calls, total seconds, longest seconds]
+        self.totals = {}
+        self.counters = {}
+
+    @contextmanager
+    def timed_span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.perf_counter())
+
+    def timed(self, name):
+        """Decorator timing every call of the function as a span."""
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with self.timed_span(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add(self, name, start, end):
+        duration = end - start
+        with self.lock:
+            self.events.append((name, start, duration, threading.get_ident()))
+            total = self.totals.get(name)
+            if total is None:
+                self.totals[name] = [1, duration, duration]
+            else:
+                total[0] += 1
+                total[1] += duration
+                total[2] = max(total[2], duration)
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def reset(self):
+        with self.lock:
+            self.origin = time.perf_counter()
+            self.events.clear()
+            self.totals.clear()
+            self.counters.clear()
+
+    def summary(self):
+        """Returns {"spans": {name: {calls, total_ms, mean_ms, max_ms}}, "counters": {...}},
+        the spans ordered by total time, longest first."""
+        with self.lock:
+            totals = sorted(self.totals.items(), key=lambda item: item[1][1], reverse=True)
+            counters = dict(self.counters)
+
+        spans = {}
+        for name, (calls, total, longest) in totals:
+            spans[name] = {
+                "calls": calls,
+                "total_ms": total * 1000,
+                "mean_ms": total * 1000 / calls,
+                "max_ms": longest * 1000
+            }
+        return {"spans": spans, "counters": counters}
+
+    def format_summary(self):
+        summary = self.summary()
+        lines = [f"{'stage':<32}{'calls':>8}{'total ms':>12}{'mean ms':>10}{'max ms':>10}"]
+        for name, span in summary["spans"].items():
+            lines.append(f"{name:<32}{span['calls']:>8}{span['total_ms']:>12.2f}"
+                         f"{span['mean_ms']:>10.3f}{span['max_ms']:>10.3f}")
+        for name, value in sorted(summary["counters"].items()):
+            lines.append(f"{name:<32}{value:>8}")
+        return "\n".join(lines)
+
+    def chrome_trace(self):
+        """Returns the spans in the Chrome trace event format, times in microseconds."""
+        pid = os.getpid()
+        with self.lock:
+            events = list(self.events)
+            origin = self.origin
+            counters = dict(self.counters)
+
+        trace = [{"name": name, "ph": "X", "ts": (start - origin) * 1e6, "dur": duration * 1e6,
+                  "pid": pid, "tid": thread_id}
+                 for name, start, duration, thread_id in events]
+        if counters:
+            trace.append({"name": "counters", "ph": "C", "ts": 0, "pid": pid, "args": counters})
+        return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+    def export(self, path, chrome_trace=False):
+        data = self.chrome_trace() if chrome_trace else self.summary()
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=None if chrome_trace else 2)
+
+
+# Shared by every module; set QEP_PROFILE=1 to profile from the start
+profiler = Profiler(enabled=bool(os.environ.get("QEP_PROFILE")))
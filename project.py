@@ -1,5 +1,4 @@
 import sys
-from preprocessing import Preprocessing
 from interface import GuiInterface
 from PySide6 import QtWidgets
 
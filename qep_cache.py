@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from threading import Lock
+
+from formatting import sql_tokens
+from plan import PlanNode
+
+
+def normalize_query(query):
+    """Reduces query to its tokens, without comments or trailing semicolons, and
+    lowercases them outside of string literals and quoted identifiers, so that
+    differently spaced or cased spellings of a query, such as the GUI's
+    formatted text and the raw text batch.py reads, share one entry. String
+    literals of every kind, E'' and dollar-quoted ones included, are kept as is."""
+    tokens = []
+    for kind, text in sql_tokens(query):
+        if kind in ("space", "comment"):
+            continue
+        if kind == "name":
+            # Quoted identifiers are case sensitive; the parts between the quotes are not
+            parts = text.split('"')
+            parts[::2] = [part.lower() for part in parts[::2]]
+            text = '"'.join(parts)
+        elif kind != "string":
+            text = text.lower()
+        tokens.append(text)
+
+    while tokens and tokens[-1] == ";":
+        tokens.pop()
+    return " ".join(tokens)
+
+
+def query_fingerprint(query):
+    return hashlib.sha256(normalize_query(query).encode("utf-8")).hexdigest()
+
+
+def make_cache_key(query, database, server_version):
+    # Databases on one server can hold different tables under the same names
+    text = f"{database}\n{server_version}\n{normalize_query(query)}"
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class CacheEntry:
+    __slots__ = ("plan", "statistics")
+
+    def __init__(self, plan, statistics):
+        # statistics maps each relation in the plan to its last (auto)analyze time
+        self.plan = plan
+        self.statistics = statistics
+
+
+class QEPCache:
+    """In-memory LRU of query plans, optionally backed by a directory holding
+    one JSON file per plan."""
+
+    def __init__(self, max_entries=256, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+
+        entry = self.load(key)
+        if entry is not None:
+            self.remember(key, entry)
+        return entry
+
+    def put(self, key, plan, statistics):
+        entry = CacheEntry(plan, statistics)
+        self.remember(key, entry)
+        self.store(key, entry)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+        if self.cache_dir:
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def remember(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # On-disk tier
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def load(self, key):
+        if not self.cache_dir:
+            return None
+
+        try:
+            with open(self.path(key), encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        return CacheEntry(PlanNode.from_dict(data["plan"]), data["statistics"])
+
+    def store(self, key, entry):
+        if not self.cache_dir:
+            return
+
+        # Write to a temporary file first so concurrent readers never see half a plan
+        path = self.path(key)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"plan": entry.plan.to_dict(), "statistics": entry.statistics}, f)
+        os.replace(temp_path, path)
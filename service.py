@@ -0,0 +1,369 @@
+"""Local HTTP/JSON annotation service, for editors and dashboards that want
+annotations without the GUI. A single asyncio process serves every client,
+with at most --max-explains EXPLAINs running on the database at once.
+
+    POST /annotate   {"query": "...", "format": true, "analyze": false, "misestimate_factor": 10}
+    GET  /health
+
+/annotate returns {"query": ..., "annotations": [{"text", "tables", "conditions", "spans"}]},
+each span being {"kind": "table" or "cond", "start", "end"}, offsets into "query".
+With "format", "query" is the formatted query the spans refer to. Requests
+must name this machine and port in their Host header, e.g. localhost:8765.
+
+Usage:
+    python service.py -d <database> -u <username> [--port 8765]
+    python service.py --replay <folder>
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+from functools import partial
+from http import HTTPStatus
+
+from annotation import AnnotationCache, AnnotationContext, annotate
+from formatting import format_query
+from highlight import find_highlights
+from plan import PlanNode
+from plan_source import ReplayPlanSource
+from profiling import profiler
+
+
+DEFAULT_PORT = 8765
+
+MAX_CONCURRENT_EXPLAINS = 4
+
+MAX_BODY_SIZE = 1024 * 1024
+
+MAX_HEADERS = 100
+
+# Names that clients on this machine reach the service by, in the Host header
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "[::1]")
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class QueryError(Exception):
+    """The database rejected the query."""
+
+
+##################################################################################################
+################################Plan sources######################################################
+##################################################################################################
+
+
+class AsyncPlanSource:
+    """Where the service's plans come from; the asynchronous counterpart of PlanSource."""
+
+    async def start(self):
+        pass
+
+    async def getQEP(self, query, analyze=False):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class AsyncPostgresPlanSource(AsyncPlanSource):
+    """Explains queries on PostgreSQL through asyncpg, on a pool of up to max_connections."""
+
+    def __init__(self, database, user, password, max_connections=MAX_CONCURRENT_EXPLAINS):
+        self.connect_kwargs = {"database": database, "user": user, "password": password}
+        self.max_connections = max_connections
+        self.pool = None
+
+    async def start(self):
+        # asyncpg is only loaded once the service connects to a database
+        import asyncpg
+
+        # Each query is explained once in a while, so preparing and caching its statement does not pay off
+        self.pool = await asyncpg.create_pool(min_size=1, max_size=self.max_connections,
+                                              statement_cache_size=0, **self.connect_kwargs)
+
+    async def getQEP(self, query, analyze=False):
+        import asyncpg
+
+        statement = ("Explain (Analyze, Verbose, Format json) " if analyze else "Explain (Format json) ") + query
+        async with self.pool.acquire() as conn:
+            # Like Preprocessing.execute, the transaction is rolled back, so EXPLAIN ANALYZE leaves no trace
+            transaction = conn.transaction()
+            await transaction.start()
+            try:
+                # json columns are returned as text, which PlanNode.from_json decodes straight into nodes
+                explain_text = await conn.fetchval(statement)
+            except asyncpg.PostgresError as e:
+                raise QueryError(str(e)) from None
+            finally:
+                await transaction.rollback()
+
+        return PlanNode.from_json(explain_text)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+
+class AsyncReplayPlanSource(AsyncPlanSource):
+    """Serves the plans saved by RecordingPlanSource, without a database."""
+
+    def __init__(self, folder):
+        self.source = ReplayPlanSource(folder)
+
+    async def getQEP(self, query, analyze=False):
+        # Loading a recorded plan reads a file, which is kept off the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, partial(self.source.getQEP, query, analyze=analyze))
+
+
+##################################################################################################
+################################Annotation########################################################
+##################################################################################################
+
+
+def parse_options(body, allow_analyze):
+    try:
+        request = json.loads(body)
+    except ValueError:
+        raise HttpError(400, "The request body is not valid JSON") from None
+
+    if not isinstance(request, dict) or not isinstance(request.get("query"), str) or not request["query"].strip():
+        raise HttpError(400, 'The request must be a JSON object with a non-empty "query"')
+
+    options = {
+        "query": request["query"],
+        "format": request.get("format", False) is True,
+        "analyze": request.get("analyze", False) is True,
+        "misestimate_factor": request.get("misestimate_factor", 10.0),
+    }
+    if options["analyze"] and not allow_analyze:
+        raise HttpError(403, "EXPLAIN ANALYZE runs the query; start the service with --allow-analyze to permit it")
+    if not isinstance(options["misestimate_factor"], (int, float)) or options["misestimate_factor"] < 1:
+        raise HttpError(400, '"misestimate_factor" must be a number of at least 1')
+    return options
+
+
+@profiler.timed("service.annotate")
+def annotate_response(qep, options, cache):
+    """Annotates qep and finds the spans of each annotation in the (formatted) query."""
+    query = options["query"]
+    formatted = format_query(query) if options["format"] else None
+
+    context = AnnotationContext(misestimate_factor=options["misestimate_factor"])
+    annotations = []
+    for text, highlights in annotate(qep, context, cache):
+        spans = find_highlights(query, highlights["table"], highlights["cond"])
+        if formatted is not None:
+            # Spans are mapped onto the formatted text, unless formatting changed more than whitespace
+            if formatted.offsets is not None:
+                spans = formatted.map_spans(spans)
+            else:
+                spans = find_highlights(formatted.text, highlights["table"], highlights["cond"])
+
+        annotations.append({
+            "text": text.strip(),
+            "tables": list(highlights["table"]),
+            "conditions": list(highlights["cond"]),
+            "spans": [{"kind": kind, "start": start, "end": end} for kind, start, end in spans]
+        })
+
+    return {"query": query if formatted is None else formatted.text, "annotations": annotations}
+
+
+class AnnotationService:
+    """Answers the requests of every client, running at most max_explains
+    EXPLAINs at once; the others wait for one to finish."""
+
+    def __init__(self, source, max_explains=MAX_CONCURRENT_EXPLAINS, allow_analyze=False,
+                 host="127.0.0.1", port=DEFAULT_PORT):
+        self.source = source
+        # A web page can point a name of its own at 127.0.0.1 (DNS rebinding) and so talk to the
+        # service as its own origin, but its requests still carry that name in the Host header
+        names = set(LOCAL_HOSTS) | {f"[{host}]" if ":" in host else host}
+        self.allowed_hosts = {f"{name}:{port}" for name in names}
+        if port == 80:
+            self.allowed_hosts |= names
+        self.explains = asyncio.Semaphore(max_explains)
+        self.allow_analyze = allow_analyze
+        # Shared by all requests, so plans with parts in common are annotated faster
+        self.cache = AnnotationCache()
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                    if request is None:
+                        break
+                    method, path, headers, body, keep_alive = request
+                    status, payload = await self.dispatch(method, path, headers, body)
+                except HttpError as e:
+                    status, payload, keep_alive = e.status, {"error": e.message}, False
+
+                write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, path, headers, body):
+        if headers.get("host", "").lower() not in self.allowed_hosts:
+            raise HttpError(403, "The Host header must name this machine and port, e.g. localhost:<port>")
+
+        if path == "/health":
+            if method != "GET":
+                raise HttpError(405, "Use GET for /health")
+            return 200, {"status": "ok"}
+
+        if path != "/annotate":
+            raise HttpError(404, f"No such endpoint: {path}")
+        if method != "POST":
+            raise HttpError(405, "Use POST for /annotate")
+        # Browsers only send application/json to other origins after a preflight this service never
+        # answers; together with the Host check, web pages cannot make it explain queries behind the user's back
+        if headers.get("content-type", "").split(";")[0].strip().lower() != "application/json":
+            raise HttpError(415, "The Content-Type must be application/json")
+
+        options = parse_options(body, self.allow_analyze)
+        try:
+            async with self.explains:
+                qep = await self.source.getQEP(options["query"], analyze=options["analyze"])
+        except QueryError as e:
+            raise HttpError(400, str(e)) from None
+        except LookupError as e:
+            raise HttpError(404, str(e)) from None
+        except Exception as e:
+            logging.exception("Explaining the query failed")
+            raise HttpError(500, str(e)) from None
+
+        # Annotating is CPU work, kept off the event loop so other clients are still served
+        loop = asyncio.get_running_loop()
+        try:
+            return 200, await loop.run_in_executor(None, annotate_response, qep, options, self.cache)
+        except Exception:
+            logging.exception("Annotating the plan failed")
+            raise HttpError(500, "Annotating the plan failed; the service log has the details") from None
+
+
+##################################################################################################
+################################HTTP##############################################################
+##################################################################################################
+
+
+async def read_request(reader):
+    """Reads one HTTP/1.1 request and returns (method, path, headers, body,
+    keep_alive), or None if the client closed the connection instead."""
+    try:
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, target, version = request_line.decode("latin-1").split()
+        except ValueError:
+            raise HttpError(400, "Malformed request line") from None
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if len(headers) >= MAX_HEADERS:
+                raise HttpError(431, "Too many headers")
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+    except ValueError:
+        # A line longer than the reader's limit
+        raise HttpError(431, "Request line or header too long") from None
+
+    if "transfer-encoding" in headers:
+        raise HttpError(411, "Send the body with a Content-Length")
+    length = headers.get("content-length", "0")
+    if not length.isdigit():
+        raise HttpError(400, "Invalid Content-Length")
+    if int(length) > MAX_BODY_SIZE:
+        raise HttpError(413, f"The body is larger than {MAX_BODY_SIZE} bytes")
+    body = await reader.readexactly(int(length))
+
+    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+    return method, target.split("?", 1)[0], headers, body, keep_alive
+
+
+def write_response(writer, status, payload, keep_alive):
+    body = json.dumps(payload).encode("utf-8")
+    head = (f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+            "\r\n")
+    writer.write(head.encode("latin-1") + body)
+
+
+##################################################################################################
+################################Main method call##################################################
+##################################################################################################
+
+
+def create_plan_source(args):
+    if args.replay:
+        return AsyncReplayPlanSource(args.replay)
+    return AsyncPostgresPlanSource(args.database, args.user, args.password, max_connections=args.max_explains)
+
+
+async def serve(args):
+    source = create_plan_source(args)
+    await source.start()
+    service = AnnotationService(source, args.max_explains, args.allow_analyze, args.host, args.port)
+    try:
+        server = await asyncio.start_server(service.handle_client, args.host, args.port)
+        print(f"Serving annotations on http://{args.host}:{args.port}/annotate", file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+    finally:
+        await source.close()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Serves query annotations over HTTP/JSON on this machine.")
+    parser.add_argument("-d", "--database", help="required unless --replay is given")
+    parser.add_argument("-u", "--user", help="required unless --replay is given")
+    parser.add_argument("-p", "--password", default=os.environ.get("PGPASSWORD", ""),
+                        help="defaults to the PGPASSWORD environment variable")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on; the default only accepts local clients")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to listen on")
+    parser.add_argument("--max-explains", type=int, default=MAX_CONCURRENT_EXPLAINS,
+                        help="EXPLAINs run on the database at once, and size of the connection pool")
+    parser.add_argument("--allow-analyze", action="store_true",
+                        help='accept "analyze" requests, which run the query in a transaction that is rolled back')
+    parser.add_argument("--replay", metavar="DIR",
+                        help="serve the plans saved to DIR by batch.py --record, without a database")
+
+    args = parser.parse_args(argv)
+    if not args.replay and not (args.database and args.user):
+        parser.error("--database and --user are required unless --replay is given")
+    if args.max_explains < 1:
+        parser.error("--max-explains must be at least 1")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,176 @@
+import re
+from operator import attrgetter
+from string import Formatter
+
+from expression import process_condition
+
+
+# An annotation template is declared as a sequence of parts: strings, whose
+# "{index_name}" style fields are filled from the PlanNode, and the parts made
+# by when, condition_text and key_list below. Any function
+# part(qep, context, conditions), returning the text it renders and adding the
+# conditions to highlight to conditions, is a part too.
+#
+# compile_template binds every part to such a function once, so rendering a
+# node only calls them in turn and joins their texts.
+
+
+# Fields are attributes of the node, possibly followed by attribute access
+FIELD_REGEX = re.compile(r"[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*")
+
+CONVERSIONS = {"s": str, "r": repr, "a": ascii}
+
+
+def compile_template(name, parts):
+    """Compiles parts into a handler function(qep, context) returning
+    [(annotation text, highlights)]."""
+    parts = compile_parts(parts)
+
+    def handler(qep, context):
+        conditions = []
+        text = "".join([part(qep, context, conditions) for part in parts])
+        return [(text + "\n", {"table": list(qep.table_names), "cond": conditions})]
+
+    handler.__name__ = handler.__qualname__ = name.lower().replace(" ", "_")
+    return handler
+
+
+def compile_parts(parts):
+    compiled = []
+    constant = ""
+    for part in parts:
+        # Adjacent constant strings are rendered as one
+        if isinstance(part, str) and not has_fields(part):
+            constant += part
+            continue
+        if constant:
+            compiled.append(constant_text(constant))
+            constant = ""
+        compiled.append(field_text(part) if isinstance(part, str) else part)
+
+    if constant:
+        compiled.append(constant_text(constant))
+    return compiled
+
+
+##################################################################################################
+################################Parts#############################################################
+##################################################################################################
+
+
+def has_fields(text):
+    return any(field is not None for _, field, _, _ in Formatter().parse(text))
+
+
+def constant_text(text):
+    return lambda qep, context, conditions: text
+
+
+def field_text(text):
+    """Text with fields of the node, each bound to an attrgetter once."""
+    segments = []
+    for literal, field, spec, conversion in Formatter().parse(text):
+        if field is None:
+            segments.append((literal, None, None, ""))
+            continue
+        if not FIELD_REGEX.fullmatch(field):
+            raise ValueError(f"Template field {field!r} does not name a plan node attribute")
+        segments.append((literal, attrgetter(field), CONVERSIONS.get(conversion), spec or ""))
+
+    def part(qep, context, conditions):
+        pieces = []
+        for literal, getter, conversion, spec in segments:
+            pieces.append(literal)
+            if getter is not None:
+                value = getter(qep)
+                pieces.append(format(conversion(value) if conversion else value, spec))
+        return "".join(pieces)
+    return part
+
+
+def equals(field, value):
+    return lambda qep, context: getattr(qep, field) == value
+
+
+def when(predicate, *parts, otherwise=()):
+    """Renders parts if predicate(qep, context) holds, else the otherwise parts.
+    predicate may also be the name of a field, which holds if the node has it."""
+    if isinstance(otherwise, str):
+        otherwise = (otherwise,)
+    if isinstance(predicate, str):
+        predicate = field_is_set(predicate)
+    parts = compile_parts(parts)
+    otherwise = compile_parts(otherwise)
+
+    def part(qep, context, conditions):
+        chosen = parts if predicate(qep, context) else otherwise
+        return "".join([chosen_part(qep, context, conditions) for chosen_part in chosen])
+    return part
+
+
+def field_is_set(field):
+    getter = attrgetter(field)
+    return lambda qep, context: getter(qep) is not None
+
+
+def condition_text(field, text, otherwise="", qualify=True, join_conditions=True):
+    """Renders the condition in field into the "{}" of text, or otherwise if the
+    node has none. With qualify, attributes are qualified by the node's alias or
+    relation; with join_conditions, the equi-join conditions found are queued on
+    the context for the join above."""
+    if text.count("{}") != 1:
+        raise ValueError(f"Condition text {text!r} must have exactly one {{}}")
+    before, after = text.split("{}")
+    getter = attrgetter(field)
+
+    def part(qep, context, conditions):
+        condition_string = getter(qep)
+        if condition_string is None:
+            return otherwise
+        condition = process_condition(condition_string, (qep.alias or qep.relation_name) if qualify else None)
+        if join_conditions:
+            context.find_join_conditions(condition)
+        conditions += condition.conjuncts
+        return before + condition.text + after
+    return part
+
+
+def property_text(key, text):
+    """Renders the value of an EXPLAIN key without a field of its own (see
+    PlanNode.get) into the "{}" of text, if the node has it."""
+    if text.count("{}") != 1:
+        raise ValueError(f"Property text {text!r} must have exactly one {{}}")
+    before, after = text.split("{}")
+
+    def part(qep, context, conditions):
+        value = qep.get(key)
+        return "" if value is None else f"{before}{value}{after}"
+    return part
+
+
+def key_list(field, text, single=None):
+    """Renders the list of keys in field, separated by commas, into the "{}" of
+    text, or of single if there is only one key."""
+    getter = attrgetter(field)
+
+    def part(qep, context, conditions):
+        keys = getter(qep)
+        if not keys:
+            return ""
+
+        key_texts = []
+        for key in keys:
+            key_condition = process_condition(key)
+            key_texts.append(key_condition.text)
+            conditions += key_condition.conjuncts
+        return (single if single and len(keys) == 1 else text).format(", ".join(key_texts))
+    return part
+
+
+def bubbled_join_condition(qep, context, conditions):
+    # A join without conditions of its own highlights one found in the scans below it
+    if not conditions:
+        join_condition = context.get_join_condition()
+        if join_condition is not None:
+            conditions.append(join_condition)
+    return ""
@@ -0,0 +1,48 @@
+from annotation import AnnotationCache, AnnotationContext, alternative, annotate
+from plan import PlanNode
+
+
+def scan(relation, parent_relationship="Outer"):
+    return {"Node Type": "Seq Scan", "Relation Name": relation, "Alias": relation, "Total Cost": 10.0,
+            "Parent Relationship": parent_relationship}
+
+
+def join(node_type, outer, inner, cost):
+    return {"Node Type": node_type, "Total Cost": cost, "Plans": [outer, inner]}
+
+
+def test_alternative_matches_joins_on_the_relations_they_join():
+    plan = PlanNode.from_dict(join("Hash Join", join("Hash Join", scan("a"), scan("b", "Inner"), 50.0),
+                                   scan("c", "Inner"), 100.0))
+    # With hash joins off, a and b are still hash joined, but c is joined by a nested loop
+    alternative_plan = PlanNode.from_dict(join("Nested Loop", join("Hash Join", scan("a"), scan("b", "Inner"), 50.0),
+                                               scan("c", "Inner"), 150.0))
+    context = AnnotationContext(alternatives={"enable_hashjoin": alternative_plan})
+    context.total_cost = plan.total_cost
+
+    assert alternative(plan.children[0], context).startswith("The planner has no alternative to it")
+    assert alternative(plan, context) == ("With enable_hashjoin off, the cheapest plan would cost 150.00 "
+                                          "instead of 100.00 (+50%). ")
+
+
+def nested_loop(customer_filter):
+    customer = dict(scan("customer"), Alias="c", Filter=customer_filter)
+    orders = {"Node Type": "Index Scan", "Relation Name": "orders", "Alias": "o", "Index Name": "orders_custkey_idx",
+              "Scan Direction": "Forward", "Index Cond": "(o_custkey = c.c_custkey)", "Total Cost": 5.0,
+              "Parent Relationship": "Inner"}
+    return {"Node Type": "Nested Loop", "Join Type": "Inner", "Total Cost": 100.0, "Plans": [customer, orders]}
+
+
+def test_cached_annotations_match_uncached_ones():
+    cache = AnnotationCache()
+    first = PlanNode.from_dict(nested_loop("(c_acctbal > '0'::numeric)"))
+    # Shares the Index Scan, whose join condition the Nested Loop above it highlights, with first
+    second = PlanNode.from_dict({"Node Type": "Sort", "Sort Key": ["c.c_name"], "Total Cost": 120.0,
+                                 "Plans": [nested_loop("(c_mktsegment = 'BUILDING'::bpchar)")]})
+
+    assert annotate(first, cache=cache) == annotate(first)
+    annotations = annotate(second, cache=cache)
+    assert annotations == annotate(second)
+    assert "o.o_custkey = c.c_custkey" in annotations[2][1]["cond"]
+    # And once more with every subtree taken from the cache
+    assert annotate(second, cache=cache) == annotations
@@ -0,0 +1,54 @@
+from batch import split_statements
+
+
+def test_splits_on_semicolons():
+    assert split_statements("select 1; select 2;\n\nselect 3") == ["select 1", "select 2", "select 3"]
+
+
+def test_keeps_semicolons_in_literals_and_quoted_identifiers():
+    script = """select 'a;b', "c;d" from t; select 'it''s; here'"""
+    assert split_statements(script) == ["""select 'a;b', "c;d" from t""", "select 'it''s; here'"]
+
+
+def test_drops_comments():
+    script = "select 1; -- a comment; still a comment\nselect /* also; a comment */ 2"
+    assert split_statements(script) == ["select 1", "select  2"]
+
+
+def test_keeps_comment_markers_in_literals():
+    assert split_statements("select '--;', '/*;*/'; select 2") == ["select '--;', '/*;*/'", "select 2"]
+
+
+def test_escape_strings():
+    script = r"select E'it\'s; escaped', e'\\'; select 2"
+    assert split_statements(script) == [r"select E'it\'s; escaped', e'\\'", "select 2"]
+
+
+def test_backslashes_in_standard_strings_escape_nothing():
+    assert split_statements(r"select 'C:\'; select 2") == [r"select 'C:\'", "select 2"]
+    assert split_statements(r"select name'\'; select 2") == [r"select name'\'", "select 2"]
+
+
+def test_dollar_quoted_bodies():
+    script = """create function f() returns int as $$ select 1; $$ language sql;
+do $body$ begin perform 1; raise notice '$$;'; end $body$;
+select 3"""
+    assert split_statements(script) == [
+        "create function f() returns int as $$ select 1; $$ language sql",
+        "do $body$ begin perform 1; raise notice '$$;'; end $body$",
+        "select 3",
+    ]
+
+
+def test_nested_dollar_quotes_with_other_tags():
+    script = "select $outer$ $inner$ ; $inner$ ; $outer$; select 2"
+    assert split_statements(script) == ["select $outer$ $inner$ ; $inner$ ; $outer$", "select 2"]
+
+
+def test_parameters_and_identifiers_with_dollars_are_not_dollar_quotes():
+    assert split_statements("select $1, a$b$ from t; select 2") == ["select $1, a$b$ from t", "select 2"]
+
+
+def test_unterminated_quotes_run_to_the_end():
+    assert split_statements("select 'a; b") == ["select 'a; b"]
+    assert split_statements("select $$ a; b") == ["select $$ a; b"]
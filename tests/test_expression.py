@@ -0,0 +1,73 @@
+from expression import normalize_condition, process_condition
+
+
+def test_process_condition_removes_casts_and_splits_conjuncts():
+    condition = process_condition("((l_shipdate >= '1994-01-01'::date) AND ((p_type)::text ~~ '%BRASS'::text))")
+    assert condition.text == "((l_shipdate >= '1994-01-01') AND ((p_type) ~~ '%BRASS'))"
+    assert condition.conjuncts == ("l_shipdate >= '1994-01-01'", "(p_type) ~~ '%BRASS'")
+    assert condition.join_conditions == ()
+
+
+def test_process_condition_qualifies_attributes():
+    condition = process_condition("((o_orderdate < '1995-03-15'::date) AND (o_custkey = c.c_custkey))", "orders")
+    assert condition.conjuncts == ("orders.o_orderdate < '1995-03-15'", "orders.o_custkey = c.c_custkey")
+
+
+def test_process_condition_does_not_qualify_functions_or_keywords():
+    condition = process_condition("((upper(name) = 'X'::text) AND (note IS NOT NULL))", "t")
+    assert condition.conjuncts == ("upper(t.name) = 'X'", "t.note IS NOT NULL")
+
+
+def test_process_condition_finds_join_conditions():
+    condition = process_condition("((o_custkey = c_custkey) AND (o_totalprice > '100'::numeric))")
+    assert condition.join_conditions == ("o_custkey = c_custkey",)
+
+
+def test_process_condition_finds_join_conditions_on_cast_attributes():
+    assert process_condition("((s_name)::text = (n.n_name)::text)").join_conditions == ("(s_name) = (n.n_name)",)
+    assert process_condition("((a.x)::numeric = b.y)").join_conditions == ("(a.x) = b.y",)
+    assert process_condition("(((a.x)::text)::character varying = b.y)").join_conditions == ("((a.x)) = b.y",)
+
+
+def test_process_condition_ignores_comparisons_with_literals_or_expressions():
+    assert process_condition("((o_orderstatus)::text = 'F'::text)").join_conditions == ()
+    assert process_condition("((a.x + 1) = b.y)").join_conditions == ()
+    assert process_condition("((a.x)::text = upper(b.y))").join_conditions == ()
+    assert process_condition("(a.x < b.y)").join_conditions == ()
+
+
+def test_normalize_condition_strips_literals_and_parameters():
+    assert (normalize_condition("((l_shipdate >= '1994-01-01'::date) AND (l_quantity < $1))")
+            == "((l_shipdate >= ?::date) AND (l_quantity < ?))")
+    assert (normalize_condition("(n_name = ANY ('{FRANCE,GERMANY}'::bpchar[]))")
+            == "(n_name = ANY (?::bpchar[]))")
+    assert normalize_condition("(p_type ~~ 'it''s%'::text)") == "(p_type ~~ ?::text)"
+
+
+def test_normalize_condition_strips_signs_of_negative_numbers_only():
+    assert normalize_condition("(a > -5.5)") == "(a > ?)"
+    assert normalize_condition("(-3 < a)") == "(? < a)"
+    assert normalize_condition("(f(-1, 2e3))") == "(f(?, ?))"
+    assert normalize_condition("(a - 1 > b)") == "(a - ? > b)"
+    assert normalize_condition("(a-1)") == "(a-?)"
+
+
+def test_normalize_condition_keeps_names_with_digits():
+    assert normalize_condition('((t1.a2 = "col 3") AND (x = 4))') == '((t1.a2 = "col 3") AND (x = ?))'
+
+
+def test_conditions_differing_in_constants_normalize_alike():
+    assert normalize_condition("(p_size = 15)") == normalize_condition("(p_size = 42)")
+    assert normalize_condition("(p_size = 15)") != normalize_condition("(p_size > 15)")
+
+
+def test_process_condition_does_not_qualify_collations_fields_or_extract_fields():
+    assert process_condition("""((name)::text < 'b'::text COLLATE "C")""", "t").text == """((t.name) < 'b' COLLATE "C")"""
+    assert process_condition("((address).city = 'Paris'::text)", "t").text == "((t.address).city = 'Paris')"
+    assert (process_condition("(EXTRACT(year FROM o_orderdate) = '1995'::numeric)", "orders").text
+            == "(EXTRACT(year FROM orders.o_orderdate) = 1995)")
+
+
+def test_process_condition_keeps_quotes_on_array_literals():
+    assert process_condition("(a = ANY ('{1,2}'::integer[]))").text == "(a = ANY ('{1,2}'))"
+    assert process_condition("(a = '5'::integer)").text == "(a = 5)"
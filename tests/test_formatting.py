@@ -0,0 +1,45 @@
+import formatting
+from formatting import FormattedQuery, align_offsets, format_query, format_tokens, sql_tokens
+
+
+def test_format_tokens_lays_out_clauses():
+    assert (format_tokens("select a, b from t where x = 1 and y = 2")
+            == "SELECT a,\n    b\nFROM t\nWHERE x = 1\n    AND y = 2")
+
+
+def test_escape_strings_are_single_tokens():
+    tokens = [token for token in sql_tokens(r"select E'a\'b; c', e'\\'") if token[0] != "space"]
+    assert tokens == [("name", "select"), ("string", r"E'a\'b; c'"), ("comma", ","), ("string", r"e'\\'")]
+
+
+def test_dollar_quoted_strings_are_single_tokens():
+    tokens = [token for token in sql_tokens("select $$x;y$$, $tag$ a $$ b $tag$, $1, a$b$") if token[0] != "space"]
+    assert tokens == [("name", "select"), ("string", "$$x;y$$"), ("comma", ","), ("string", "$tag$ a $$ b $tag$"),
+                      ("comma", ","), ("param", "$1"), ("comma", ","), ("name", "a$b$")]
+
+
+def test_format_tokens_keeps_string_literals_intact():
+    formatted = format_tokens(r"select E'a\'b', $$x;y$$, $f$ select 1; $f$ from t where s = 'it''s'")
+    assert formatted == "SELECT E'a\\'b',\n    $$x;y$$,\n    $f$ select 1; $f$\nFROM t\nWHERE s = 'it''s'"
+
+
+def test_formatted_text_aligns_with_the_original():
+    query = "select E'a\\'b' from t"
+    formatted = FormattedQuery(query, format_tokens(query))
+    assert formatted.offsets is not None
+    assert formatted.text[formatted.to_formatted(query.index("E'")):].startswith("E'a\\'b'")
+
+
+def test_align_offsets_rejects_changes_other_than_whitespace_and_case():
+    assert align_offsets("select 'a'", "SELECT  'a'") is not None
+    assert align_offsets("select 'a'", "SELECT 'b'") is None
+
+
+def test_format_query_does_not_cache_its_output_as_already_formatted(monkeypatch):
+    # format_sql is not assumed to be idempotent, so the formatted text is formatted again when asked
+    monkeypatch.setattr(formatting, "format_cache", formatting.OrderedDict())
+    monkeypatch.setattr(formatting, "format_sql_function", lambda query: query.upper() + " -- formatted")
+    formatted = format_query("select 1")
+    assert formatted.text == "SELECT 1 -- formatted"
+    assert list(formatting.format_cache) == ["select 1"]
+    assert format_query(formatted.text).text == "SELECT 1 -- FORMATTED -- formatted"
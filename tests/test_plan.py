@@ -0,0 +1,60 @@
+from annotation import annotate
+from plan import PlanNode
+
+
+def node(node_type, total_time, loops, **fields):
+    return dict({"Node Type": node_type, "Startup Cost": 0.0, "Total Cost": 10.0, "Plan Rows": 10.0,
+                 "Plan Width": 4, "Actual Startup Time": 0.1, "Actual Total Time": total_time,
+                 "Actual Rows": 10, "Actual Loops": loops}, **fields)
+
+
+def parallel_plan(**gather_fields):
+    scan = node("Seq Scan", 3.0, 3, **{"Relation Name": "t", "Alias": "t", "Parent Relationship": "Outer",
+                                       "Parallel Aware": True})
+    return PlanNode.from_dict(node("Gather", 5.0, 1, **dict({"Workers Planned": 2, "Workers Launched": 2,
+                                                             "Plans": [scan]}, **gather_fields)))
+
+
+def test_loops_of_concurrent_processes_count_once():
+    gather = parallel_plan()
+    scan = gather.children[0]
+    assert scan.parallel_processes == 3
+    assert scan.inclusive_time == 3.0
+    assert gather.exclusive_time == 2.0
+
+
+def test_single_copy_gather_leaves_out_the_leader():
+    gather = parallel_plan(**{"Workers Launched": 1, "Single Copy": True})
+    assert gather.children[0].parallel_processes == 1
+    assert gather.children[0].inclusive_time == 9.0
+
+
+def test_loops_outside_gather_are_summed():
+    inner = node("Index Scan", 0.5, 4, **{"Relation Name": "u", "Alias": "u", "Parent Relationship": "Inner"})
+    outer = node("Seq Scan", 1.0, 1, **{"Relation Name": "t", "Alias": "t", "Parent Relationship": "Outer"})
+    loop = PlanNode.from_dict(node("Nested Loop", 4.0, 1, **{"Join Type": "Inner", "Plans": [outer, inner]}))
+    assert loop.children[1].parallel_processes is None
+    assert loop.children[1].inclusive_time == 2.0
+    assert loop.exclusive_time == 1.0
+
+
+def test_annotation_reports_gather_time():
+    texts = [text for text, highlights in annotate(parallel_plan())]
+    assert "took 2.000 ms itself" in texts[-1]
+
+
+def test_annotation_reports_children_exceeding_parent():
+    gather = parallel_plan(**{"Actual Total Time": 1.0})
+    assert gather.exclusive_time == -2.0
+    texts = [text for text, highlights in annotate(gather)]
+    assert "took 1.000 ms with the steps below it, which reported 2.000 ms more than that" in texts[-1]
+
+
+def test_table_names_include_scans_with_children():
+    index_scan = {"Node Type": "Bitmap Index Scan", "Index Name": "orders_idx", "Parent Relationship": "Outer"}
+    heap_scan = {"Node Type": "Bitmap Heap Scan", "Relation Name": "orders", "Alias": "o",
+                 "Parent Relationship": "Inner", "Plans": [index_scan]}
+    customer = {"Node Type": "Seq Scan", "Relation Name": "customer", "Parent Relationship": "Outer"}
+    join = PlanNode.from_dict({"Node Type": "Nested Loop", "Plans": [customer, heap_scan]})
+    assert join.children[1].table_names == ("o",)
+    assert join.table_names == ("customer", "o")
@@ -0,0 +1,46 @@
+from plan import PlanNode
+from prepared import describe_parameter_plans, parameter_count
+
+
+def test_parameter_count_is_the_highest_placeholder():
+    assert parameter_count("select * from t where a = $2 and b = $1") == 2
+    assert parameter_count("select 1") == 0
+
+
+def test_parameter_count_ignores_identifiers_literals_and_comments():
+    assert parameter_count("select a$1, $2 from t") == 2
+    assert parameter_count("select $1 from t where x = '$3' -- $4\n/* $5 */") == 1
+    assert parameter_count(r"select E'it\'s $3', $$ $4 $$, $tag$ $5 $tag$, $1") == 1
+
+
+def scan(node_type, cost):
+    return PlanNode.from_dict({"Node Type": node_type, "Relation Name": "orders", "Alias": "o", "Total Cost": cost})
+
+
+def test_custom_plans_with_the_generic_shape():
+    lines = describe_parameter_plans(scan("Seq Scan", 100.0), [scan("Seq Scan", 90.0), scan("Seq Scan", 110.0)],
+                                     [[1], ["a"]])
+    assert lines == [
+        "The generic plan, which every execution of the prepared statement gets once the plan cache settles "
+        "on it, costs 100.00.",
+        'With ($1 = 1); ($1 = "a"), the custom plan has the shape of the generic plan.',
+        "The custom plans cost 100.00 on average, so under plan_cache_mode = auto, after the first 5 "
+        "executions the prepared statement likely switches to the generic plan.",
+    ]
+
+
+def test_custom_plans_differing_from_the_generic_plan():
+    lines = describe_parameter_plans(scan("Seq Scan", 100.0), [scan("Index Scan", 8.0), scan("Seq Scan", 100.0)],
+                                     [[5], [500]])
+    assert lines[1:] == [
+        "The 2 parameter sets get 2 differently shaped plans.",
+        "With ($1 = 5), the custom plan differs from the generic plan. "
+        "o is now read with Index Scan instead of Seq Scan.",
+        "With ($1 = 500), the custom plan has the shape of the generic plan.",
+        "The custom plans cost 54.00 on average, so under plan_cache_mode = auto, after the first 5 "
+        "executions the prepared statement likely keeps getting custom plans.",
+    ]
+
+
+def test_only_the_generic_plan():
+    assert len(describe_parameter_plans(scan("Seq Scan", 100.0), [], [])) == 1
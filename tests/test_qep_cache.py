@@ -0,0 +1,20 @@
+from qep_cache import make_cache_key, normalize_query
+
+
+def test_ignores_case_spacing_comments_and_semicolons():
+    assert normalize_query("SELECT  a\nFROM T -- note\n;") == normalize_query("select a from t")
+
+
+def test_keeps_case_in_literals_and_quoted_identifiers():
+    assert normalize_query("""SELECT 'ABC', "Col" FROM T""") == """select 'ABC' , "Col" from t"""
+
+
+def test_keeps_escape_and_dollar_quoted_literals_whole():
+    assert normalize_query(r"SELECT E'It\'s ABC'") == r"select E'It\'s ABC'"
+    assert normalize_query("SELECT $$ABC -- Def$$, $tag$X 'Y'$tag$") == "select $$ABC -- Def$$ , $tag$X 'Y'$tag$"
+    assert normalize_query("SELECT $$ABC$$") != normalize_query("SELECT $$abc$$")
+
+
+def test_cache_key_depends_on_database():
+    assert make_cache_key("select 1", "a", 150000) != make_cache_key("select 1", "b", 150000)
+    assert make_cache_key("SELECT 1;", "a", 150000) == make_cache_key("select 1", "a", 150000)
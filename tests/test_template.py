@@ -0,0 +1,70 @@
+from annotation import AnnotationContext
+from plan import PlanNode
+from template import (bubbled_join_condition, compile_template, condition_text, equals, key_list, property_text,
+                      when)
+
+
+def render(handler, fields, context=None):
+    [(text, highlights)] = handler(PlanNode.from_dict(fields), context or AnnotationContext())
+    return text, highlights
+
+
+SCAN = compile_template("Seq Scan", [
+    "A scan on {relation_name}",
+    when("alias", " as {alias}"),
+    condition_text("filter", ", keeping rows where {}", otherwise=", keeping every row"),
+    property_text("Sampling Method", " sampled by {}"),
+    ". ",
+])
+
+
+def test_node_with_optional_fields():
+    text, highlights = render(SCAN, {"Node Type": "Seq Scan", "Relation Name": "orders", "Alias": "o",
+                                     "Filter": "(o_totalprice > '100'::numeric)", "Sampling Method": "bernoulli"})
+    assert text == "A scan on orders as o, keeping rows where (o.o_totalprice > 100) sampled by bernoulli. \n"
+    assert highlights == {"table": ["o"], "cond": ["o.o_totalprice > 100"]}
+
+
+def test_node_without_optional_fields():
+    text, highlights = render(SCAN, {"Node Type": "Seq Scan", "Relation Name": "orders"})
+    assert text == "A scan on orders, keeping every row. \n"
+    assert highlights == {"table": ["orders"], "cond": []}
+
+
+def test_when_with_otherwise():
+    handler = compile_template("Join", [
+        when(equals("join_type", "Inner"), "An inner join", otherwise=("A {join_type} join",)),
+        ". ",
+    ])
+    assert render(handler, {"Node Type": "Hash Join", "Join Type": "Inner"})[0] == "An inner join. \n"
+    assert render(handler, {"Node Type": "Hash Join", "Join Type": "Left"})[0] == "A Left join. \n"
+
+
+def test_key_list():
+    handler = compile_template("Sort", [key_list("sort_key", "Sorted on the keys {}. ", single="Sorted on {}. ")])
+    text, highlights = render(handler, {"Node Type": "Sort", "Sort Key": ["o_orderdate"]})
+    assert text == "Sorted on o_orderdate. \n"
+    assert highlights["cond"] == ["o_orderdate"]
+
+    text, highlights = render(handler, {"Node Type": "Sort", "Sort Key": ["a", "(b)::text DESC"]})
+    assert text == "Sorted on the keys a, (b) DESC. \n"
+    assert highlights["cond"] == ["a", "(b) DESC"]
+
+    assert render(handler, {"Node Type": "Sort"})[0] == "\n"
+
+
+def test_join_without_conditions_highlights_one_found_below():
+    handler = compile_template("Nested Loop", [
+        condition_text("join_filter", "Joined where {}. ", otherwise="Joined. "),
+        bubbled_join_condition,
+    ])
+    context = AnnotationContext()
+    render(SCAN, {"Node Type": "Seq Scan", "Relation Name": "orders", "Filter": "(o_custkey = c.c_custkey)"},
+           context)
+
+    text, highlights = render(handler, {"Node Type": "Nested Loop"}, context)
+    assert text == "Joined. \n"
+    assert highlights["cond"] == ["orders.o_custkey = c.c_custkey"]
+
+    # Once taken, the condition is not highlighted again
+    assert render(handler, {"Node Type": "Nested Loop"}, context)[1]["cond"] == []
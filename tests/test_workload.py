@@ -0,0 +1,81 @@
+import io
+import json
+import os
+
+from plan import PlanNode
+from workload import detect_format, process_workload, read_workloads
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+CSVLOG = os.path.join(FIXTURES, "postgresql.csv")
+STDERR_LOG = os.path.join(FIXTURES, "postgresql.log")
+PG_STAT_STATEMENTS = os.path.join(FIXTURES, "pg_stat_statements.csv")
+
+
+def read(path):
+    return [(item.query, item.plan is not None, item.calls, item.total_ms) for item in read_workloads([path])]
+
+
+def test_detects_formats():
+    assert [detect_format(path) for path in (CSVLOG, STDERR_LOG, PG_STAT_STATEMENTS)] == [
+        "csvlog", "stderr", "pg_stat_statements"]
+
+
+def test_reads_csvlog():
+    assert read(CSVLOG) == [
+        ("select * from orders where o_totalprice > 100", True, 1, 3.0),
+        ("select c_name\nfrom customer", False, 1, None),
+        ("vacuum orders", False, 1, 0.5),
+    ]
+
+
+def test_reads_stderr_log():
+    assert read(STDERR_LOG) == [
+        ("select c_name\nfrom customer\nwhere c_custkey = 7", False, 1, 1.25),
+        ("select 1", False, 1, None),
+    ]
+    assert [item.origin for item in read_workloads([STDERR_LOG])] == [f"{STDERR_LOG}:1", f"{STDERR_LOG}:7"]
+
+
+def test_reads_pg_stat_statements():
+    assert read(PG_STAT_STATEMENTS) == [
+        ("select * from orders where o_orderkey = $1", False, 12, 30.5),
+        ("select c_name\nfrom customer", False, 3, 1.5),
+    ]
+
+
+class FixedPlanSource:
+    """Plans every query as an index scan on customer, or generically on orders."""
+
+    def getQEP(self, query):
+        return PlanNode.from_dict({"Node Type": "Index Scan", "Relation Name": "customer", "Alias": "customer",
+                                   "Index Name": "customer_pkey", "Total Cost": 8.0})
+
+    def getGenericQEPs(self, query):
+        return PlanNode.from_dict({"Node Type": "Index Scan", "Relation Name": "orders", "Alias": "orders",
+                                   "Index Name": "orders_pkey", "Total Cost": 8.0}), None
+
+
+def test_process_workload_without_plan_source_annotates_logged_plans():
+    output = io.StringIO()
+    summary = process_workload(read_workloads([CSVLOG, STDERR_LOG]), None, output)
+
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [record["query"] for record in records] == ["select * from orders where o_totalprice > 100"]
+    assert records[0]["annotation"][0][1] == {"table": ["orders"], "cond": ["orders.o_totalprice > 100"]}
+    assert summary.statements == 1
+    assert summary.skipped == {"no plan logged": 3, "not explainable": 1}
+    assert summary.operators["Seq Scan"].to_dict() == {"nodes": 1, "calls": 1, "statement_ms": 3.0,
+                                                       "actual_ms": 2.5}
+
+
+def test_process_workload_sums_operators_by_relation():
+    summary = process_workload(read_workloads([CSVLOG, PG_STAT_STATEMENTS]), FixedPlanSource(), io.StringIO())
+
+    assert summary.statements == 4
+    assert summary.skipped == {"not explainable": 1}
+    assert summary.operators["Index Scan"].to_dict() == {"nodes": 3, "calls": 16, "statement_ms": 32.0,
+                                                         "actual_ms": 0.0}
+    assert summary.relations[("customer", "Index Scan")].to_dict() == {"nodes": 2, "calls": 4,
+                                                                        "statement_ms": 1.5, "actual_ms": 0.0}
+    assert summary.relations[("orders", "Index Scan")].calls == 12
+    assert summary.relations[("orders", "Seq Scan")].actual_ms == 2.5
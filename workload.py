@@ -0,0 +1,375 @@
+"""Annotates the statements that actually ran, read from PostgreSQL logs or
+pg_stat_statements exports, and sums up the operators they used by type and
+by relation.
+
+Inputs are read as streams, entry by entry, so files of any size (gzipped or
+not) are processed in bounded memory:
+    csvlog              logs written with log_destination = 'csvlog'
+    stderr              plain text logs, as written with log_destination = 'stderr'
+    pg_stat_statements  CSV exports of the view, with a header row
+
+Statements are taken from log_statement and log_min_duration_statement entries.
+Plans logged by auto_explain with auto_explain.log_format = json are annotated as
+logged; other statements are explained through a database (or recorded plans).
+pg_stat_statements queries, whose constants are $1, $2, ..., get their generic plans.
+
+Usage:
+    python workload.py -o annotations.jsonl [-d <database> -u <username>] <files>
+"""
+import argparse
+import csv
+import gzip
+import json
+import logging
+import os
+import re
+import sys
+from collections import Counter, namedtuple
+
+from annotation import AnnotationCache, AnnotationContext, annotate
+from plan import PlanNode
+from plan_source import ReplayPlanSource
+from prepared import parameter_count
+from profiling import profiler
+
+
+FORMATS = ("csvlog", "stderr", "pg_stat_statements")
+
+# Column of the message in csvlog lines, the same in every PostgreSQL version
+CSVLOG_MESSAGE = 13
+CSVLOG_SEVERITY = 11
+
+# Plans logged by auto_explain easily exceed the csv module's default field limit
+MAX_FIELD_SIZE = 256 * 1024 * 1024
+
+DURATION_REGEX = re.compile(r"duration: (?P<duration>\d+(?:\.\d+)?) ms\s*")
+
+# Messages carrying a statement, e.g. "statement: SELECT ..." or "execute <unnamed>: SELECT ..."
+STATEMENT_REGEX = re.compile(r"(?:statement|execute [^:]*): ", re.DOTALL)
+
+# Start of the message in a line of a plain text log, after its log_line_prefix
+STDERR_LOG_REGEX = re.compile(r"\bLOG:  ")
+
+# Statements EXPLAIN accepts, by their first word
+EXPLAINABLE_KEYWORDS = {"select", "insert", "update", "delete", "with", "values", "table", "merge"}
+
+# One statement of the workload. plan is the decoded "Plan" of a logged plan, or
+# None; calls and total_ms are the executions the entry stands for and their time.
+WorkloadItem = namedtuple("WorkloadItem", ["origin", "query", "plan", "calls", "total_ms"])
+
+
+##################################################################################################
+################################Reading workloads#################################################
+##################################################################################################
+
+
+def open_text(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace", newline="")
+    return open(path, encoding="utf-8", errors="replace", newline="")
+
+
+def detect_format(path):
+    name = path[:-len(".gz")] if path.endswith(".gz") else path
+    if not name.endswith(".csv"):
+        return "stderr"
+    with open_text(path) as f:
+        header = next(csv.reader(f), [])
+    return "pg_stat_statements" if "query" in header and "calls" in header else "csvlog"
+
+
+def parse_message(origin, message):
+    """Returns the WorkloadItem of a log message, or None if it holds no statement or plan."""
+    duration = None
+    match = DURATION_REGEX.match(message)
+    if match:
+        duration = float(match.group("duration"))
+        message = message[match.end():]
+
+    if message.startswith("plan:"):
+        text = message[len("plan:"):].strip()
+        # Plans in auto_explain's text, xml or yaml formats are not read
+        if not text.startswith("{"):
+            return None
+        try:
+            explain = json.loads(text)
+        except ValueError:
+            logging.warning("%s: the logged plan is not valid JSON", origin)
+            return None
+        return WorkloadItem(origin, explain.get("Query Text"), explain.get("Plan"), 1, duration)
+
+    match = STATEMENT_REGEX.match(message)
+    if match:
+        return WorkloadItem(origin, message[match.end():], None, 1, duration)
+    return None
+
+
+def read_csvlog(path):
+    with open_text(path) as f:
+        reader = csv.reader(f)
+        for row in reader:
+            if len(row) > CSVLOG_MESSAGE and row[CSVLOG_SEVERITY] == "LOG":
+                item = parse_message(f"{path}:{reader.line_num}", row[CSVLOG_MESSAGE])
+                if item is not None:
+                    yield item
+
+
+def read_stderr_log(path):
+    # An entry is a line with a log_line_prefix, followed by lines continuing it, which start with a tab
+    with open_text(path) as f:
+        origin = None
+        lines = []
+        for line_number, line in enumerate(f, start=1):
+            if line.startswith("\t"):
+                # Continuations of entries other than LOG ones, such as the STATEMENT of an error, are skipped
+                if origin is not None:
+                    lines.append(line[1:])
+                continue
+
+            if origin is not None:
+                item = parse_message(origin, "".join(lines).rstrip("\n"))
+                if item is not None:
+                    yield item
+                origin = None
+
+            match = STDERR_LOG_REGEX.search(line)
+            if match:
+                origin = f"{path}:{line_number}"
+                lines = [line[match.end():]]
+
+        if origin is not None:
+            item = parse_message(origin, "".join(lines).rstrip("\n"))
+            if item is not None:
+                yield item
+
+
+def read_pg_stat_statements(path):
+    with open_text(path) as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            # Named total_time before PostgreSQL 13
+            total_ms = row.get("total_exec_time") or row.get("total_time")
+            yield WorkloadItem(f"{path}:{reader.line_num}", row["query"], None, int(row["calls"] or 0),
+                               float(total_ms) if total_ms else None)
+
+
+READERS = {
+    "csvlog": read_csvlog,
+    "stderr": read_stderr_log,
+    "pg_stat_statements": read_pg_stat_statements,
+}
+
+
+def read_workloads(paths, workload_format=None):
+    csv.field_size_limit(MAX_FIELD_SIZE)
+    for path in paths:
+        yield from READERS[workload_format or detect_format(path)](path)
+
+
+##################################################################################################
+################################Planning##########################################################
+##################################################################################################
+
+
+def is_explainable(query):
+    words = query.split(None, 1) if query else ()
+    return bool(words) and words[0].lower().lstrip("(") in EXPLAINABLE_KEYWORDS
+
+
+def plan_workload(items, plan_source, summary):
+    """Yields (item, PlanNode) for each item whose plan was logged or can be
+    explained by plan_source, which may be None. The others are counted in summary."""
+    for item in items:
+        if item.plan is not None:
+            yield item, PlanNode.from_dict(item.plan)
+            continue
+
+        if not is_explainable(item.query):
+            summary.skipped["not explainable"] += 1
+            continue
+        if plan_source is None:
+            summary.skipped["no plan logged"] += 1
+            continue
+
+        try:
+            # Normalized pg_stat_statements queries, among others, have placeholders instead of constants
+            if parameter_count(item.query):
+                qep, _ = plan_source.getGenericQEPs(item.query)
+            else:
+                qep = plan_source.getQEP(item.query)
+        except Exception as e:
+            logging.warning("%s: %s", item.origin, e)
+            summary.skipped["explain failed"] += 1
+            continue
+        yield item, qep
+
+
+##################################################################################################
+################################Aggregation#######################################################
+##################################################################################################
+
+
+class OperatorStats:
+    """Totals of one operator type, over the whole workload or on one relation."""
+
+    __slots__ = ("nodes", "calls", "statement_ms", "actual_ms")
+
+    def __init__(self):
+        self.nodes = 0
+        # Executions of the statements using the operator
+        self.calls = 0
+        # Time of those statements, as logged or exported
+        self.statement_ms = 0.0
+        # Time spent in the operator itself, from plans logged with auto_explain.log_analyze
+        self.actual_ms = 0.0
+
+    def to_dict(self):
+        return {"nodes": self.nodes, "calls": self.calls,
+                "statement_ms": self.statement_ms, "actual_ms": self.actual_ms}
+
+
+class WorkloadSummary:
+    """Operators used by the workload, by node type and by relation and node type."""
+
+    def __init__(self):
+        self.statements = 0
+        self.skipped = Counter()
+        self.operators = {}
+        self.relations = {}
+
+    def add(self, item, qep):
+        self.statements += 1
+        counted = set()
+        for node in qep.walk():
+            keys = [(self.operators, node.node_type)]
+            if node.relation_name is not None:
+                keys.append((self.relations, (node.relation_name, node.node_type)))
+
+            for totals, key in keys:
+                stats = totals.get(key)
+                if stats is None:
+                    stats = totals[key] = OperatorStats()
+                stats.nodes += 1
+                if node.is_analyzed:
+                    stats.actual_ms += max(node.exclusive_time, 0.0) * item.calls
+                # A statement counts once for each operator it uses, however many nodes use it
+                if key not in counted:
+                    counted.add(key)
+                    stats.calls += item.calls
+                    stats.statement_ms += item.total_ms or 0.0
+
+    def to_dict(self):
+        return {
+            "statements": self.statements,
+            "skipped": dict(self.skipped),
+            "operators": {node_type: stats.to_dict() for node_type, stats in self.operators.items()},
+            "relations": [dict(relation=relation, node_type=node_type, **stats.to_dict())
+                          for (relation, node_type), stats in self.relations.items()],
+        }
+
+    def format_report(self, top=20):
+        lines = [f"Annotated {self.statements} statement(s)"
+                 + "".join(f", skipped {count} {reason}" for reason, count in sorted(self.skipped.items())) + "."]
+
+        lines += ["", f"{'operator':<40}{'nodes':>10}{'calls':>12}{'statement ms':>16}{'actual ms':>14}"]
+        for node_type, stats in self.top(self.operators, top):
+            lines.append(f"{node_type:<40}{stats.nodes:>10}{stats.calls:>12}"
+                         f"{stats.statement_ms:>16.1f}{stats.actual_ms:>14.1f}")
+
+        lines += ["", f"{'relation / operator':<40}{'nodes':>10}{'calls':>12}{'statement ms':>16}{'actual ms':>14}"]
+        for (relation, node_type), stats in self.top(self.relations, top):
+            name = f"{relation} / {node_type}"
+            lines.append(f"{name:<40}{stats.nodes:>10}{stats.calls:>12}"
+                         f"{stats.statement_ms:>16.1f}{stats.actual_ms:>14.1f}")
+        return "\n".join(lines)
+
+    @staticmethod
+    def top(totals, count):
+        # Heaviest first: by the time of the statements involved, then by how often they ran
+        return sorted(totals.items(), key=lambda item: (item[1].statement_ms, item[1].calls),
+                      reverse=True)[:count]
+
+
+##################################################################################################
+################################Main method call##################################################
+##################################################################################################
+
+
+def create_plan_source(args):
+    # Without a database or recorded plans, only the plans in the logs are annotated
+    if args.replay:
+        return ReplayPlanSource(args.replay)
+    if not args.database:
+        return None
+
+    from preprocessing import Preprocessing
+
+    return Preprocessing(args.database, args.user, args.password, cache_dir=args.cache_dir)
+
+
+@profiler.timed("workload")
+def process_workload(items, plan_source, output):
+    """Annotates every item, writing one JSON line each to output, and returns the WorkloadSummary."""
+    summary = WorkloadSummary()
+    # Logs repeat the same statements over and over, which the cache annotates once
+    cache = AnnotationCache()
+
+    for item, qep in plan_workload(items, plan_source, summary):
+        record = {
+            "origin": item.origin,
+            "query": item.query,
+            "calls": item.calls,
+            "total_ms": item.total_ms,
+            "annotation": annotate(qep, AnnotationContext(), cache)
+        }
+        output.write(json.dumps(record) + "\n")
+        summary.add(item, qep)
+
+    return summary
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Annotates the statements in PostgreSQL logs or pg_stat_statements exports.")
+    parser.add_argument("inputs", nargs="+", help="log files or pg_stat_statements CSV exports, optionally gzipped")
+    parser.add_argument("-o", "--output", required=True, help="JSONL file to write the annotations to")
+    parser.add_argument("--format", choices=FORMATS,
+                        help="format of every input; by default guessed from each file")
+    parser.add_argument("-d", "--database", help="database to explain statements without a logged plan on")
+    parser.add_argument("-u", "--user")
+    parser.add_argument("-p", "--password", default=os.environ.get("PGPASSWORD", ""),
+                        help="defaults to the PGPASSWORD environment variable")
+    parser.add_argument("--cache-dir", help="directory for the on-disk plan cache")
+    parser.add_argument("--replay", metavar="DIR",
+                        help="take the plans of statements from those saved to DIR by batch.py --record")
+    parser.add_argument("--summary", metavar="FILE", help="also save the summary by operator and relation as JSON")
+    parser.add_argument("--top", type=int, default=20, help="rows of each table of the printed summary")
+
+    args = parser.parse_args(argv)
+    if args.database and not args.user:
+        parser.error("--user is required with --database")
+    if args.database and args.replay:
+        parser.error("--database and --replay cannot be combined")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    plan_source = create_plan_source(args)
+
+    try:
+        with open(args.output, "w", encoding="utf-8") as output:
+            summary = process_workload(read_workloads(args.inputs, args.format), plan_source, output)
+    finally:
+        if plan_source is not None:
+            plan_source.close()
+
+    print(summary.format_report(args.top))
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            json.dump(summary.to_dict(), f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())